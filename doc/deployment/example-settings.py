@@ -66,6 +66,21 @@ DATABASE_PORT = ''
 BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis'
 
+# With USE_RENDER_QUEUES set in objavi/config.py, renders go to light
+# and heavy queues.  This routes the tasks that are started without an
+# explicit queue.
+CELERY_ROUTES = ('objavi.classic.routing.TaskRouter',)
+
+# Identical concurrent requests are sent to the same job through the
+# cache (see USE_REQUEST_COALESCING in objavi/config.py), so it needs
+# to be shared between the web processes.
+#CACHES = {
+#    'default': {
+#        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#        'LOCATION': '127.0.0.1:11211',
+#    }
+#}
+
 
 ##
 # Django
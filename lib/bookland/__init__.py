@@ -34,6 +34,7 @@ MAINTAINER = "bookland-bugs@cgpp.com"
 from bookland.productcode import *
 import copy
 import sys
+import zlib
 
 class PostscriptError(Exception):
     pass
@@ -100,15 +101,31 @@ BOOKLANDDICT = """
 		exch
 		rmoveto show } def"""
 
+# PDF output can't rely on the Postscript interpreter to measure
+# strings, and OCR-B is not one of the fonts every PDF reader has, so
+# it is drawn as Courier (like OCR-B, monospaced and unambiguous).
+# Courier glyphs are 0.6 em wide, and digits are about 0.62 em tall.
+PDFFONTS = {"OCRB": "Courier"}
+PDFCHARWIDTH = 0.6
+PDFCHARHEIGHT = 0.62
+
+def pdfString(s):
+    return "(%s)" % s.replace("\\","\\\\").replace("(","\\(").replace(")","\\)")
+
 class Postscript:
     x0 = 0
     y0 = 0
     bb = 4*[0]
     width = 0
     height = 0
+    ops = []
+    fonts = []
     def __add__(self,other):
         rval = Postscript()
         rval.lines = self.lines + other.lines
+        rval.ops = self.ops + other.ops
+        rval.fonts = self.fonts + [f for f in other.fonts
+                                   if f not in self.fonts]
         rval.bb[0] = min(self.bb[0]+self.x0,
                          other.bb[0]+other.x0)
         rval.bb[1] = min(self.bb[1]+self.y0,
@@ -121,11 +138,9 @@ class Postscript:
         rval.height = rval.bb[3]-rval.bb[1]    
         return rval
 
-    def eps(self,creator="",title="",cmyk=(0,0,0,1),comments="",
-            padding=(1,1,1,1), position=None):
-        if max(cmyk)>1 or min(cmyk)<0:
-            raise PostscriptError("cmyk value out of range")
-
+    def placement(self,padding=(1,1,1,1),position=None):
+        # Returns the bounding box on the page, and the offset of the
+        # symbol's origin.
         bbox = map(int,self.bb)
         # int truncates towards zero.
         for i in range(len(bbox)):
@@ -154,6 +169,14 @@ class Postscript:
             bbox[i] += x0
         for i in [1,3]:
             bbox[i] += y0
+        return bbox,x0,y0
+
+    def eps(self,creator="",title="",cmyk=(0,0,0,1),comments="",
+            padding=(1,1,1,1), position=None):
+        if max(cmyk)>1 or min(cmyk)<0:
+            raise PostscriptError("cmyk value out of range")
+
+        bbox,x0,y0 = self.placement(padding,position)
 
         lines=[ "%!PS-Adobe-2.0 EPSF-1.2",
                 "%%%%Creator: %s" % creator,
@@ -171,6 +194,53 @@ class Postscript:
                       "showpage","% Good luck!\n"])
         return "\n".join(lines)
 
+    def pdf(self,title="",cmyk=(0,0,0,1),padding=(1,1,1,1),
+            position=None):
+        # A one page PDF file with the symbol drawn on it. The page
+        # is the size given in position, or US letter.
+        if max(cmyk)>1 or min(cmyk)<0:
+            raise PostscriptError("cmyk value out of range")
+
+        bbox,x0,y0 = self.placement(padding,position)
+        if position is None:
+            width, height = 612, 792
+        else:
+            width, height = position[1:3]
+
+        content = [ "%s %s %s %s k" % tuple(cmyk),
+                    "1 0 0 1 %s %s cm" % (x0,y0) ]
+        content.extend(self.ops)
+        content = zlib.compress("\n".join(content))
+
+        fonts = " ".join(["/%s << /Type /Font /Subtype /Type1 "
+                          "/BaseFont /%s /Encoding /WinAnsiEncoding >>" %
+                          (f, PDFFONTS.get(f,f)) for f in self.fonts])
+        objects = [
+            "<< /Type /Catalog /Pages 2 0 R >>",
+            "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %s %s] "
+            "/Resources << /Font << %s >> >> /Contents 4 0 R >>" %
+            (width, height, fonts),
+            "<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream" %
+            (len(content), content),
+            "<< /Title %s /Producer (%s %s) >>" %
+            (pdfString(title), MYNAME, MYVERSION) ]
+
+        out = [ "%PDF-1.4\n%\xe2\xe3\xcf\xd3\n" ]
+        pos = len(out[0])
+        offsets = []
+        for i, obj in enumerate(objects):
+            s = "%d 0 obj\n%s\nendobj\n" % (i+1, obj)
+            offsets.append(pos)
+            out.append(s)
+            pos += len(s)
+        out.append("xref\n0 %d\n0000000000 65535 f \n" % (len(objects)+1))
+        out.extend(["%010d 00000 n \n" % x for x in offsets])
+        out.append("trailer\n<< /Size %d /Root 1 0 R /Info %d 0 R >>\n"
+                   "startxref\n%d\n%%%%EOF\n" % (len(objects)+1,
+                                                  len(objects), pos))
+        return "".join(out)
+
     def __repr__(self):
         return "\n".join(self.lines)
 
@@ -214,6 +284,33 @@ class Bars(Postscript):
         self.lines.append(line)
         self.lines.append("grestore")
 
+        # The same bars as filled rectangles, for PDF:
+        self.ops = [ "q 1 0 0 1 %s %s cm" % (x0,y0) ]
+        x = 0
+        for bit, group in groupBits(bits):
+            w = len(group)*moduleWidth
+            if bit != "0":
+                if bit == "L":
+                    y, h = -5, moduleHeight+5
+                else:
+                    y, h = 0, moduleHeight
+                self.ops.append("%.4f %s %.4f %s re f" %
+                                (x+barWidthReduction/2., y,
+                                 w-barWidthReduction, h))
+            x += w
+        self.ops.append("Q")
+
+
+def groupBits(bits):
+    # Split bits into runs of the same value: [(bit, run), ...]
+    groups = []
+    for bit in bits:
+        if groups and groups[-1][0] == bit:
+            groups[-1][1].append(bit)
+        else:
+            groups.append((bit,[bit]))
+    return groups
+
 
 class setfont(Postscript):
     def __init__(self,font,size=None,fitwidth=None,fitstring=None):
@@ -223,10 +320,14 @@ class setfont(Postscript):
         self.fitstring=fitstring
         if size:
             self.lines = [ "/%s findfont %s scalefont setfont" % (font,size) ]
+            self.pdfsize = size
         elif fitwidth and fitstring:
             self.lines = [ "%s (%s) /%s fitstring" % (fitwidth,fitstring,font) ]
+            self.pdfsize = float(fitwidth)/(PDFCHARWIDTH*len(fitstring))
         else:
             raise PostscriptError("couldn't set font")
+        self.ops = [ "/%s %.4f Tf" % (font,self.pdfsize) ]
+        self.fonts = [ font ]
 
 class Text(Postscript):
     def __init__(self,s,sf,x0=0,y0=0,anchor=0):
@@ -261,6 +362,18 @@ class Text(Postscript):
         self.lines.extend(sf.lines)
         self.lines.extend([ "(%s) %s anchorstring" % (s,anchor),
                             "grestore" ])
+
+        # For PDF the string's size comes from the nominal font
+        # metrics rather than its outline.
+        self.fonts = sf.fonts
+        if s.strip():
+            w = len(s)*PDFCHARWIDTH*sf.pdfsize
+            h = PDFCHARHEIGHT*sf.pdfsize
+            self.ops = [ "BT", sf.ops[0],
+                         "%.4f %.4f Td" % (x0+ndx*w/2, y0+ndy*h/2),
+                         "%s Tj" % pdfString(s), "ET" ]
+        else:
+            self.ops = []
         
 class EAN13Symbol(Postscript):
 
@@ -321,6 +434,8 @@ class EAN13Symbol(Postscript):
 
         ps = rightDigits + leftDigits + firstDigit + bars + quietZone
         self.lines = ps.lines
+        self.ops = ps.ops
+        self.fonts = ps.fonts
         self.bb = ps.bb
         self.width = ps.width
         self.height = ps.height
@@ -414,6 +529,8 @@ class Bookland(Postscript):
         self.width = ps.width
         self.height = ps.height
         self.lines = ps.lines
+        self.ops = ps.ops
+        self.fonts = ps.fonts
 
 def rgbtocmyk(rgb):
     r,g,b = rgb
@@ -20,11 +20,17 @@ General utility functions.
 """
 
 import os, sys
+import errno
 import shutil
+import tempfile
 import time, re
 import fnmatch
+import threading
+import select
+import signal
+from hashlib import sha1
 from subprocess import Popen, PIPE
-from urllib2 import urlopen, HTTPError
+from urllib2 import urlopen, Request, HTTPError
 import htmlentitydefs
 
 #from objavi.fmbook import log
@@ -148,16 +154,266 @@ def get_number_localiser(locale):
     return _localiser
 
 
-def run(cmd):
+class RunResult(int):
+    """The return code of a command run by run(), as an int (negative
+    if it was killed by a signal), with these attributes:
+
+    cmd          the command
+    wall         seconds it took
+    user_cpu     user CPU seconds used by it and its waited-for children
+    sys_cpu      system CPU seconds likewise
+    max_rss_kb   peak resident memory of it or its largest child
+    stdout       the output (at most config.RUN_CAPTURE_LIMIT bytes of it)
+    stderr       the error output, likewise
+    truncated    True if some of stdout or stderr was dropped
+    timed_out    True if it was killed for taking too long
+    """
+    def __new__(cls, returncode, **kwargs):
+        self = int.__new__(cls, returncode)
+        self.__dict__.update(kwargs)
+        return self
+
+
+class _Capture(object):
+    """Keeps the beginning and end of a stream, up to <limit> bytes
+    in all."""
+    def __init__(self, limit):
+        self.head_limit = limit // 2
+        self.tail_limit = limit - self.head_limit
+        self.head = []
+        self.head_size = 0
+        self.tail = ''
+        self.dropped = 0
+
+    def add(self, s):
+        if self.head_size < self.head_limit:
+            n = self.head_limit - self.head_size
+            self.head.append(s[:n])
+            self.head_size += len(s[:n])
+            s = s[n:]
+        tail = self.tail + s
+        if len(tail) > self.tail_limit:
+            self.dropped += len(tail) - self.tail_limit
+            tail = tail[len(tail) - self.tail_limit:]
+        self.tail = tail
+
+    def value(self):
+        if self.dropped:
+            return '%s\n[... %s bytes dropped ...]\n%s' % (''.join(self.head), self.dropped, self.tail)
+        return ''.join(self.head) + self.tail
+
+
+_run_watchers = set()
+_run_watchers_lock = threading.Lock()
+
+def add_run_watcher(f):
+    """Have f(result) called with the RunResult of every command that
+    run() runs (in any thread) until remove_run_watcher(f)."""
+    with _run_watchers_lock:
+        _run_watchers.add(f)
+
+def remove_run_watcher(f):
+    with _run_watchers_lock:
+        _run_watchers.discard(f)
+
+
+def _command_limits(cmd, timeout, cpu_limit, memory_limit):
+    limits = {'timeout': config.RUN_TIMEOUT,
+              'cpu_limit': config.RUN_CPU_LIMIT,
+              'memory_limit': config.RUN_MEMORY_LIMIT}
+    limits.update(config.RUN_COMMAND_LIMITS.get(os.path.basename(cmd[0]), {}))
+    for k, v in (('timeout', timeout), ('cpu_limit', cpu_limit),
+                 ('memory_limit', memory_limit)):
+        if v is not None:
+            limits[k] = v
+    return limits['timeout'], limits['cpu_limit'], limits['memory_limit']
+
+
+def _kill_group(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except OSError:
+        pass
+
+
+def _wrap_command(cmd, cpu_limit, memory_limit):
+    """Prefix the command with setsid and prlimit, which put it in a
+    new process group and set its limits.  This is done by helper
+    programs rather than in a preexec_fn, which isn't safe to use in
+    a process with threads."""
+    wrapped = [config.SETSID]
+    limits = []
+    if cpu_limit:
+        limits.append('--cpu=%d:%d' % (int(cpu_limit), int(cpu_limit) + 5))
+    if memory_limit:
+        limits.append('--as=%d' % memory_limit)
+    if limits:
+        wrapped += [config.PRLIMIT] + limits + ['--']
+    return wrapped + list(cmd)
+
+
+def run(cmd, timeout=None, cpu_limit=None, memory_limit=None):
+    """Run the command, logging what it says, and return its exit
+    status as a RunResult.
+
+    The command runs in a process group of its own (as setsid makes
+    the group when it is started from a non-leader, the group id is
+    the command's pid).  If it takes more
+    than <timeout> seconds, the group is sent SIGTERM and then, after
+    config.RUN_KILL_GRACE seconds, SIGKILL.  <cpu_limit> (seconds) and
+    <memory_limit> (bytes of address space) are set as rlimits.  These
+    default to config.RUN_TIMEOUT etc., or the entry for the command
+    in config.RUN_COMMAND_LIMITS; None means no limit.
+
+    stdout and stderr are read as they are produced, but only the
+    start and end of each are kept (see config.RUN_CAPTURE_LIMIT)."""
+    timeout, cpu_limit, memory_limit = _command_limits(cmd, timeout, cpu_limit, memory_limit)
+
+    start = time.time()
     try:
-        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-        out, err = p.communicate()
+        p = Popen(_wrap_command(cmd, cpu_limit, memory_limit),
+                  stdout=PIPE, stderr=PIPE, close_fds=True)
     except Exception:
         log("Failed on command: %r" % cmd)
         raise
-    log("%s\n%s returned %s and produced\nstdout:%s\nstderr:%s" %
-        (' '.join(cmd), cmd[0], p.poll(), out, err))
-    return p.poll()
+
+    captures = {p.stdout: _Capture(config.RUN_CAPTURE_LIMIT),
+                p.stderr: _Capture(config.RUN_CAPTURE_LIMIT)}
+    streams = [p.stdout, p.stderr]
+    status = usage = None
+    timed_out = False
+    deadline = None
+    if timeout:
+        deadline = start + timeout
+    try:
+        while True:
+            now = time.time()
+            if status is None:
+                pid, st, ru = os.wait4(p.pid, os.WNOHANG)
+                if pid:
+                    status, usage = st, ru
+                    #stray grandchildren could hold the pipes open
+                    #indefinitely, so don't wait long for the last output.
+                    drain_until = now + 1
+            if status is not None and (not streams or now > drain_until):
+                break
+            if status is None and deadline is not None and now > deadline:
+                if not timed_out:
+                    log("%s has run for %s seconds; killing it" % (cmd[0], timeout))
+                    timed_out = True
+                    _kill_group(p.pid, signal.SIGTERM)
+                else:
+                    _kill_group(p.pid, signal.SIGKILL)
+                deadline = now + config.RUN_KILL_GRACE
+            if streams:
+                try:
+                    ready = select.select(streams, [], [], 0.1)[0]
+                except select.error, e:
+                    #a signal (e.g. SIGCHLD) arrived; just go round again.
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    continue
+                for f in ready:
+                    s = os.read(f.fileno(), 1 << 16)
+                    if s:
+                        captures[f].add(s)
+                    else:
+                        streams.remove(f)
+            else:
+                time.sleep(0.01)
+    finally:
+        if status is None:
+            #interrupted (e.g. by the task being revoked): don't leave
+            #the command running.
+            log("abandoning %s; killing it" % cmd[0])
+            _kill_group(p.pid, signal.SIGKILL)
+            try:
+                os.waitpid(p.pid, 0)
+            except OSError:
+                pass
+        p.stdout.close()
+        p.stderr.close()
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    p.returncode = returncode
+
+    out = captures[p.stdout]
+    err = captures[p.stderr]
+    result = RunResult(returncode, cmd=cmd,
+                       wall=time.time() - start,
+                       user_cpu=usage.ru_utime, sys_cpu=usage.ru_stime,
+                       max_rss_kb=usage.ru_maxrss,
+                       stdout=out.value(), stderr=err.value(),
+                       truncated=bool(out.dropped or err.dropped),
+                       timed_out=timed_out)
+    log("%s\n%s returned %s after %.1fs (cpu %.1fs, rss %skB)%s and produced\nstdout:%s\nstderr:%s" %
+        (' '.join(cmd), cmd[0], returncode, result.wall,
+         result.user_cpu + result.sys_cpu, result.max_rss_kb,
+         ' TIMED OUT' if timed_out else '', result.stdout, result.stderr))
+    with _run_watchers_lock:
+        watchers = list(_run_watchers)
+    for f in watchers:
+        f(result)
+    return result
+
+def run_stages(stages, max_workers=1):
+    """Run a set of interdependent functions, in parallel where the
+    dependencies allow, but never more than <max_workers> at once.
+
+    <stages> is a sequence of (name, function, dependencies) tuples,
+    where dependencies is a sequence of the names of stages that must
+    finish before this one starts.  When there is a choice, stages are
+    started in the order given.  If a stage raises an exception, no
+    more stages are started, and once the running ones have finished
+    the first exception is raised again."""
+    pending = list(stages)
+    names = set(x[0] for x in pending)
+    for name, func, deps in pending:
+        for d in deps:
+            if d not in names:
+                raise ObjaviError("stage %r depends on unknown stage %r" % (name, d))
+    finished = set()
+    failures = []
+    running = []
+    cond = threading.Condition()
+
+    def work(name, func):
+        try:
+            func()
+        except Exception:
+            log("stage %s failed" % name)
+            with cond:
+                failures.append(sys.exc_info())
+        with cond:
+            finished.add(name)
+            running.remove(name)
+            cond.notify()
+
+    with cond:
+        while True:
+            if not failures:
+                for stage in pending[:]:
+                    name, func, deps = stage
+                    if len(running) >= max_workers:
+                        break
+                    if all(d in finished for d in deps):
+                        pending.remove(stage)
+                        running.append(name)
+                        t = threading.Thread(target=work, args=(name, func),
+                                             name='stage-%s' % name)
+                        t.daemon = True
+                        t.start()
+            if not running:
+                break
+            cond.wait()
+
+    if failures:
+        etype, value, tb = failures[0]
+        raise etype, value, tb
+    if pending:
+        raise ObjaviError("stages %s could never start" % [x[0] for x in pending])
 
 def shift_file(fn, dir, backup='~'):
     """Shift a file and save backup (only works on same filesystem)"""
@@ -206,6 +462,59 @@ def url_fetch(url, suppress_error=False):
             raise
     #returns None is error is suppressed
 
+def url_save_conditional(url, filename, etag=None, last_modified=None,
+                         blocksize=1 << 16):
+    """Save the url to <filename>, reading it in blocks so the whole
+    response is never in memory, unless the server says it hasn't
+    changed since the version with the given ETag or Last-Modified
+    header.  The file is written under a temporary name and renamed,
+    so it is never seen half written.
+
+    Returns a tuple (saved, validators).  If the server responded with
+    304 Not Modified, saved is None; otherwise it is a tuple (size,
+    sha1 hex digest) of the saved file.  validators is a dictionary
+    with 'etag' and 'last_modified' keys, for the next request."""
+    req = Request(url)
+    if etag:
+        req.add_header('If-None-Match', etag)
+    if last_modified:
+        req.add_header('If-Modified-Since', last_modified)
+    try:
+        f = urlopen(req)
+    except HTTPError, e:
+        if e.code == 304:
+            log("'%s' is not modified" % url)
+            return None, {'etag': etag, 'last_modified': last_modified}
+        log("HTTPError '%s' trying to fetch '%s'" % (e, url))
+        raise
+    try:
+        headers = f.info()
+        h = sha1()
+        size = 0
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            out = os.fdopen(fd, 'wb')
+            try:
+                while True:
+                    s = f.read(blocksize)
+                    if not s:
+                        break
+                    h.update(s)
+                    size += len(s)
+                    out.write(s)
+            finally:
+                out.close()
+            #mkstemp makes files only the owner can read
+            os.chmod(tmp, 0644)
+            os.rename(tmp, filename)
+        except:
+            os.remove(tmp)
+            raise
+    finally:
+        f.close()
+    return (size, h.hexdigest()), {'etag': headers.get('ETag'),
+                                   'last_modified': headers.get('Last-Modified')}
+
 def url_fetch2(url, suppress_error=False):
     try:
         f = urlopen(url)
@@ -0,0 +1,183 @@
+# Part of Objavi2, which turns html manuals into books.
+# This serves finished books without holding them in memory.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Descriptions of finished files, and responses that serve them.
+
+Tasks don't return the books they make, which can be hundreds of
+megabytes and would otherwise be pickled through the result backend.
+Instead they return a small dictionary describing the file (see
+describe_file), and the web process turns that into a response with
+serve().  The file is read in blocks as the response is sent, or
+handed to the front end server with X-Sendfile or X-Accel-Redirect
+(see config.SENDFILE_HEADER).  Single byte ranges are supported, so
+interrupted downloads can be resumed.
+
+The ETag is made from the file's size and modification time, as web
+servers do, rather than a digest of its contents, which would mean
+reading the whole book again.  Published files are never modified in
+place, and render cache hits are hard links to the cached file, so
+they keep its ETag.
+"""
+
+import os
+import re
+
+from django.http import HttpResponse
+
+from objavi import config
+from objavi.book_utils import log
+
+
+def describe_file(path, mimetype, filename=None):
+    """A picklable description of the file at <path>, to be served
+    as <filename> (by default its own name)."""
+    if filename is None:
+        filename = os.path.basename(path)
+    st = os.stat(path)
+    return {
+        "path"     : path,
+        "size"     : st.st_size,
+        "mimetype" : mimetype,
+        "etag"     : '"%x-%x"' % (st.st_size, int(st.st_mtime * 1000000)),
+        "filename" : filename,
+        }
+
+
+def describe_text(text, mimetype="text/plain; charset=utf-8"):
+    """A short response body that doesn't live in a file."""
+    return {"text" : text, "mimetype" : mimetype}
+
+
+def _file_blocks(path, start, length, blocksize=1 << 16):
+    f = open(path, "rb")
+    try:
+        f.seek(start)
+        while length > 0:
+            s = f.read(min(blocksize, length))
+            if not s:
+                break
+            length -= len(s)
+            yield s
+    finally:
+        f.close()
+
+
+def parse_range(header, size):
+    """Find the (start, end) byte positions (inclusive) asked for by a
+    Range header.  Returns None if the whole file should be sent, as
+    it is when there is no header or it asks for several ranges, and
+    raises ValueError if the range can't be satisfied."""
+    m = re.match(r'^bytes=(\d*)-(\d*)$', (header or '').strip())
+    if m is None:
+        return None
+    first, last = m.groups()
+    if first:
+        start = int(first)
+        end = size - 1
+        if last:
+            end = min(int(last), end)
+    elif last:
+        start = max(size - int(last), 0)
+        end = size - 1
+    else:
+        return None
+    if start > end or start >= size:
+        raise ValueError("unsatisfiable range %r for %s bytes" % (header, size))
+    return start, end
+
+
+def etag_matches(header, etag):
+    """Whether an If-None-Match header lists <etag>.  The header is a
+    comma separated list, and the comparison is weak (W/ prefixes are
+    ignored)."""
+    if not header:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def _sendfile_location(path):
+    """The url or path to give the front end server for the file, or
+    None if it can't serve it."""
+    if config.SENDFILE_HEADER == 'X-Sendfile':
+        return path
+    path = os.path.abspath(path)
+    for directory, url in config.SENDFILE_URL_MAP:
+        directory = os.path.join(os.path.abspath(directory), '')
+        if path.startswith(directory):
+            return url.rstrip('/') + '/' + path[len(directory):]
+
+
+def serve(request, descriptor):
+    """Make a response from a task's description of its result."""
+    if "text" in descriptor:
+        return HttpResponse(descriptor["text"], content_type = descriptor["mimetype"])
+
+    path = descriptor["path"]
+    size = descriptor["size"]
+    etag = descriptor["etag"]
+
+    if etag_matches(request.META.get("HTTP_IF_NONE_MATCH"), etag):
+        response = HttpResponse(status = 304)
+        response["ETag"] = etag
+        return response
+
+    if config.SENDFILE_HEADER:
+        location = _sendfile_location(path)
+        if location is not None:
+            #the front end server deals with ranges
+            response = HttpResponse(content_type = descriptor["mimetype"])
+            response[config.SENDFILE_HEADER] = location
+            response["Content-Disposition"] = "attachment; filename=%s" % descriptor["filename"]
+            response["ETag"] = etag
+            return response
+        log("%s can't serve %s; streaming it" % (config.SENDFILE_HEADER, path))
+
+    byte_range = None
+    if request.META.get("HTTP_IF_RANGE", etag) == etag:
+        try:
+            byte_range = parse_range(request.META.get("HTTP_RANGE"), size)
+        except ValueError, e:
+            log(e)
+            response = HttpResponse(status = 416)
+            response["Content-Range"] = "bytes */%s" % size
+            return response
+
+    if byte_range is None:
+        start, end = 0, size - 1
+        status = 200
+    else:
+        start, end = byte_range
+        status = 206
+
+    length = end - start + 1
+    response = HttpResponse(_file_blocks(path, start, length),
+                            content_type = descriptor["mimetype"], status = status)
+    response["Content-Disposition"] = "attachment; filename=%s" % descriptor["filename"]
+    response["Content-Length"] = str(length)
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    if status == 206:
+        response["Content-Range"] = "bytes %s-%s/%s" % (start, end, size)
+    return response
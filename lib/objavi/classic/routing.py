@@ -0,0 +1,107 @@
+# Part of Objavi2, which turns html manuals into books.
+# This decides which celery queue a render goes to.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Routing of render tasks to light and heavy queues.
+
+A bookizip or epub takes seconds, while a newspaper PDF of a long book
+can take many minutes.  If they share a queue the quick jobs wait
+behind the slow ones, so when config.USE_RENDER_QUEUES is set each
+render is given a rough cost, and goes to config.LIGHT_QUEUE or
+config.HEAVY_QUEUE accordingly.  Each queue should have workers of its
+own (see doc/deployment/example-supervisor.conf).
+
+The cost is the mode's weight (config.RENDER_MODE_COST) multiplied by
+the size of the book: its chapter count plus its image bytes in units
+of config.RENDER_COST_IMAGE_BYTES.  The size is read from the book's
+info.json in the local booki-zip store if the book has been fetched
+before, otherwise config.RENDER_COST_DEFAULT_SIZE is assumed.
+"""
+
+import json
+import zipfile
+import sqlite3
+
+from objavi import config
+from objavi.book_utils import log
+from objavi.zipstore import ZipStore
+
+
+def book_size(server, book):
+    """Estimate the size of the book from its last saved booki-zip,
+    in chapters (with images counting as chapters too).  Returns None
+    if there is no saved zip to look at."""
+    try:
+        latest = ZipStore().latest(server, book)
+        if latest is None:
+            return None
+        z = zipfile.ZipFile(latest['path'])
+        try:
+            info = json.loads(z.read('info.json'))
+            image_bytes = 0
+            for zi in z.infolist():
+                if zi.filename.startswith('static/') and not zi.filename.endswith('.css'):
+                    image_bytes += zi.file_size
+        finally:
+            z.close()
+    except (IOError, OSError, KeyError, ValueError,
+            sqlite3.Error, zipfile.BadZipfile), e:
+        log("can't estimate the size of %s/%s: %s" % (server, book, e))
+        return None
+    return len(info.get('spine', ())) + float(image_bytes) / config.RENDER_COST_IMAGE_BYTES
+
+
+def estimate_cost(mode, args):
+    """A rough guess at how much work the render will be."""
+    server = args.get('server') or config.DEFAULT_SERVER
+    size = None
+    if args.get('book'):
+        size = book_size(server, args.get('book'))
+    if size is None:
+        size = config.RENDER_COST_DEFAULT_SIZE
+    return config.RENDER_MODE_COST.get(mode, 1.0) * size
+
+
+def queue_options(mode, args):
+    """The apply_async() options (queue and priority) for a render in
+    <mode> with the request arguments <args>.  Empty if render queues
+    aren't being used."""
+    if not config.USE_RENDER_QUEUES:
+        return {}
+    cost = estimate_cost(mode, args)
+    if cost <= config.LIGHT_JOB_MAX_COST:
+        queue = config.LIGHT_QUEUE
+    else:
+        queue = config.HEAVY_QUEUE
+    log("%s render of %s has estimated cost %.1f: using %s" %
+        (mode, args.get('book'), cost, queue))
+    options = {'queue': queue}
+    priority = config.RENDER_QUEUE_PRIORITY.get(queue)
+    if priority is not None:
+        options['priority'] = priority
+    return options
+
+
+class TaskRouter(object):
+    """For CELERY_ROUTES.  Tasks started without queue_options() (e.g.
+    ingress_epub) are routed by name alone."""
+    def route_for_task(self, task, args=None, kwargs=None):
+        if not config.USE_RENDER_QUEUES:
+            return None
+        if task in config.LIGHT_TASKS:
+            return {'queue': config.LIGHT_QUEUE}
+        if task in config.HEAVY_TASKS:
+            return {'queue': config.HEAVY_QUEUE}
@@ -15,11 +15,12 @@
 # along with Objavi.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import hashlib
 
 import celery
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.core.cache import cache
 
 from objavi import form_config
 from objavi import constants
@@ -27,8 +28,11 @@ from objavi import config
 from objavi import fmbook
 from objavi import book_utils
 from objavi import bookjs
+from objavi import render_cache
+from objavi import metrics
 
 import forms
+from downloads import describe_file, describe_text
 
 
 class RequestError(Exception):
@@ -44,6 +48,38 @@ class RequestError(Exception):
         return "; ".join(lines)
 
 
+def current_task_info():
+    """The running task, its id, and its job key (see views.submit),
+    or Nones if this isn't running in a task.  celery.current_task is
+    a proxy that is only set in the task's own thread, so the task
+    itself is returned, to be used from other threads."""
+    task = celery.current_task._get_current_object()
+    if task is None or task.request.id is None:
+        return None, None, None
+    return task, task.request.id, (task.request.kwargs or {}).get("job_key")
+
+
+def job_key(mode, args):
+    """The cache key under which the job for a request is found by
+    identical requests (see views.submit)."""
+    canonical = render_cache.canonical_args(dict(args.items()),
+                                            ignored = config.COALESCE_IGNORED_ARGS)
+    return "objavi-job-%s" % hashlib.sha1(("%s\0%s" % (mode, canonical)).encode("utf-8")).hexdigest()
+
+
+def renew_job(key, job_id):
+    """Keep the job findable while it runs, if it still owns the key."""
+    if cache.get(key) == job_id:
+        cache.set(key, job_id, config.COALESCE_TIMEOUT)
+
+
+def release_job(key, job_id):
+    """Stop identical requests joining the job, if it still owns the
+    key."""
+    if cache.get(key) == job_id:
+        cache.delete(key)
+
+
 class ObjaviRequest(object):
     def __init__(self, args):
         self.bookid = args.get('book')
@@ -63,6 +99,11 @@ class ObjaviRequest(object):
         self.details_url, self.s3url = fmbook.find_archive_urls(self.bookid, self.bookname)
         self.booki_group = args.get('booki_group')
         self.booki_user = args.get('booki_user')
+        self.timer = metrics.StageTimer(self.bookname)
+
+        #the notifiers can be called from a book's stage threads,
+        #where there is no current task, so it is noted here.
+        self.task, self.task_id, self.job_key = current_task_info()
 
     def finish(self, book):
         #book.publish_shared(self.booki_group, self.booki_user)
@@ -73,8 +114,17 @@ class ObjaviRequest(object):
     def log_notifier(self, message):
         print('*** MESSAGE: "%s"' % message)
 
+    def progress_notifier(self, message):
+        """Record the latest stage in the result store, for anyone
+        polling the job."""
+        if self.task is not None:
+            self.task.update_state(task_id = self.task_id, state = "PROGRESS",
+                                   meta = {"stage" : message})
+            if self.job_key is not None:
+                renew_job(self.job_key, self.task_id)
+
     def get_watchers(self):
-        return set([self.log_notifier])
+        return set([self.log_notifier, self.progress_notifier, self.timer])
 
 
 def parse_request(request):
@@ -137,6 +187,7 @@ def make_book(context, args):
         book_args["title"] = args.get("title")
 
     book = fmbook.Book(context.bookid, context.server, context.bookname, **book_args)
+    context.timer.book = book
 
     toc_header = args.get("toc_header")
     if toc_header:
@@ -145,16 +196,47 @@ def make_book(context, args):
     return book
 
 
+def publish_cached(context, args, book):
+    """If an identical render of this book is in the render cache,
+    publish that instead.  Returns True if it did.
+    """
+    context.cache_key = None
+    if not config.USE_RENDER_CACHE or book.bookizip_file is None:
+        return False
+
+    context.cache_key = render_cache.make_key(book.bookizip_file, context.mode, args)
+    context.cache_publish_file = book.publish_file
+    published = render_cache.fetch(context.cache_key, book.publish_file)
+    if published is None:
+        return False
+
+    book.publish_file = published
+    book.notify_watcher('render_cache_hit')
+    return True
+
+
+def cache_render(context, book):
+    """Put the freshly published book in the render cache.
+    """
+    if getattr(context, 'cache_key', None) is not None:
+        try:
+            render_cache.store(context.cache_key, context.cache_publish_file, book.publish_file)
+        except (IOError, OSError), e:
+            book_utils.log("could not cache %s: %s" % (book.publish_file, e))
+
+
 def make_response(context):
+    """Describes the task's result for the web process to serve (see
+    downloads.serve), rather than carrying the book itself back
+    through the result backend.
+    """
     if context.destination == "nowhere":
-        return HttpResponse(context.bookurl)
+        descriptor = describe_text(context.bookurl)
     else:
         content_type = form_config.CGI_MODES.get(context.mode)[2]
-        response = HttpResponse(content_type = content_type)
-        response["Content-Disposition"] = "attachment; filename=%s" % context.bookname
-        with open(context.publish_file, "rb") as f:
-            response.write(f.read())
-        return response
+        descriptor = describe_file(context.publish_file, content_type, context.bookname)
+    descriptor["metrics"] = context.timer.report()
+    return descriptor
 
 
 
@@ -172,7 +254,14 @@ def task(func):
     """
     @celery.task(base = Task, name = func.__name__)
     def decorated_func(request, *args, **kwargs):
-        return func(request, *args, **kwargs)
+        #job_key is set by views.submit for jobs that identical
+        #requests may join.
+        key = kwargs.pop("job_key", None)
+        try:
+            return func(request, *args, **kwargs)
+        finally:
+            if key is not None:
+                release_job(key, decorated_func.request.id)
     return decorated_func
 
 
@@ -182,18 +271,20 @@ def render_bookjs_pdf(request):
     context = ObjaviRequest(args)
 
     with make_book(context, args) as book:
-        book.spawn_x()
-        book.load_book()
+        if not publish_cached(context, args, book):
+            book.spawn_x()
+            book.load_book()
 
-        page_config = bookjs.make_pagination_config(args)
-        custom_css  = args.get("css", "")
+            page_config = bookjs.make_pagination_config(args)
+            custom_css  = args.get("css", "")
 
-        book.add_section_titles()
-        book.make_body_html()
+            book.add_section_titles()
+            book.make_body_html()
 
-        bookjs.render(book.body_html_file, book.pdf_file, custom_css=custom_css, page_config=page_config)
+            bookjs.render(book.body_html_file, book.pdf_file, custom_css=custom_css, page_config=page_config)
 
-        book.publish_pdf()
+            book.publish_pdf()
+            cache_render(context, book)
         context.finish(book)
 
     return make_response(context)
@@ -205,14 +296,16 @@ def render_bookjs_zip(request):
     context = ObjaviRequest(args)
 
     with make_book(context, args) as book:
-        book.load_book()
+        if not publish_cached(context, args, book):
+            book.load_book()
 
-        custom_css  = bookjs.make_page_settings_css(args)
-        custom_css += "\n"
-        custom_css += args.get("css", "")
+            custom_css  = bookjs.make_page_settings_css(args)
+            custom_css += "\n"
+            custom_css += args.get("css", "")
 
-        book.add_section_titles()
-        book.make_bookjs_zip(custom_css)
+            book.add_section_titles()
+            book.make_bookjs_zip(custom_css)
+            cache_render(context, book)
 
         context.finish(book)
 
@@ -225,28 +318,30 @@ def render_book(request):
     context = ObjaviRequest(args)
 
     with make_book(context, args) as book:
-        book.spawn_x()
-        book.load_book()
+        if not publish_cached(context, args, book):
+            book.spawn_x()
+            book.load_book()
 
-        if not args.get('allow-breaks'):
-            book.fake_no_break_after()
+            if not args.get('allow-breaks'):
+                book.fake_no_break_after()
 
-        book.add_css(args.get('css'), context.mode)
-        book.add_section_titles()
+            book.add_css(args.get('css'), context.mode)
+            book.add_section_titles()
 
-        if context.mode == 'book':
-            book.make_book_pdf()
-        elif context.mode in ('web', 'newspaper'):
-            book.make_simple_pdf(context.mode, cover_url = args.get("cover_url"))
+            if context.mode == 'book':
+                book.make_book_pdf()
+            elif context.mode in ('web', 'newspaper'):
+                book.make_simple_pdf(context.mode, cover_url = args.get("cover_url"))
 
-        if args.get("rotate"):
-            book.rotate180()
+            if args.get("rotate"):
+                book.rotate180()
 
-        if args.get('embed-fonts'):
-            log("embedding fonts!")
-            book.embed_fonts()
+            if args.get('embed-fonts'):
+                log("embedding fonts!")
+                book.embed_fonts()
 
-        book.publish_pdf()
+            book.publish_pdf()
+            cache_render(context, book)
         context.finish(book)
 
     return make_response(context)
@@ -258,11 +353,13 @@ def render_openoffice(request):
     context = ObjaviRequest(args)
 
     with make_book(context, args) as book:
-        book.spawn_x()
-        book.load_book()
-        book.add_css(args.get('css'), 'openoffice')
-        book.add_section_titles()
-        book.make_oo_doc(cover_url = args.get("cover_url"))
+        if not publish_cached(context, args, book):
+            book.spawn_x()
+            book.load_book()
+            book.add_css(args.get('css'), 'openoffice')
+            book.add_section_titles()
+            book.make_oo_doc(cover_url = args.get("cover_url"))
+            cache_render(context, book)
         context.finish(book)
 
     return make_response(context)
@@ -288,7 +385,9 @@ def render_templated_html(request):
     template = args.get('html_template')
 
     with make_book(context, args) as book:
-        book.make_templated_html(template = template)
+        if not publish_cached(context, args, book):
+            book.make_templated_html(template = template)
+            cache_render(context, book)
         context.finish(book)
 
     return make_response(context)
@@ -309,9 +408,11 @@ def render_epub(request):
     output_profile = args.get("output_profile")
 
     with make_book(context, args) as book:
-        book.make_epub(**epub_args)
-        if output_format and output_profile:
-            book.convert_with_calibre(output_profile, output_format)
+        if not publish_cached(context, args, book):
+            book.make_epub(**epub_args)
+            if output_format and output_profile:
+                book.convert_with_calibre(output_profile, output_format)
+            cache_render(context, book)
         context.finish(book)
 
     return make_response(context)
@@ -339,13 +440,7 @@ def ingress_epub(request):
     file_name = source_function(book)
     file_path = os.path.join(config.BOOKI_BOOK_DIR, file_name)
 
-    response = HttpResponse(content_type = constants.BOOKIZIP_MIMETYPE)
-    response["Content-Disposition"] = "attachment; filename=%s" % (file_name, )
-
-    with open(file_path, "rb") as f:
-        response.write(f.read())
-
-    return response
+    return describe_file(file_path, constants.BOOKIZIP_MIMETYPE, file_name)
 
 
 __all__ = (
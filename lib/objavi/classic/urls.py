@@ -23,4 +23,7 @@ urlpatterns = patterns('',
     url(r'^booklist$',        "objavi.classic.views.fetch_booklist"),
     url(r'^fontlist$',        "objavi.classic.views.fetch_fontlist"),
     url(r'^espri$',           "objavi.classic.views.espri"),
+    url(r'^metrics$',         "objavi.classic.views.fetch_metrics"),
+    url(r'^job/(?P<job_id>[\w-]+)$',          "objavi.classic.views.job_status"),
+    url(r'^job/(?P<job_id>[\w-]+)/download$', "objavi.classic.views.job_download"),
 )
@@ -15,8 +15,16 @@
 # along with Objavi.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import time
+import json
+
+from celery.exceptions import TimeoutError
+from celery.result import AsyncResult
+from celery.utils import uuid
 
 from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
 from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import render_to_response
 from django.template import RequestContext
@@ -28,22 +36,19 @@ from objavi import book_utils
 from objavi import cgi_utils
 from objavi import booki_wrapper
 from objavi import twiki_wrapper
+from objavi import metrics
 
 import tasks
 import forms
+import downloads
+import routing
 
 
 def fetch_fontlist(request):
     script = request.REQUEST.get("script", "latin")
 
-    response = HttpResponse(content_type = "application/pdf")
-    response["Content-Disposition"] = "attachment; filename=font-list.pdf"
-
     pdfname = fontlist.create_fontlist(script)
-    with open(pdfname, "r") as f:
-        response.write(f.read())
-
-    return response
+    return downloads.serve(request, downloads.describe_file(pdfname, "application/pdf", "font-list.pdf"))
 
 
 def fetch_booklist(request):
@@ -79,6 +84,19 @@ def show_form(request):
     return render_to_response("form.html", context, context_instance=RequestContext(request))
 
 
+RENDER_TASKS = {
+    "book"           : tasks.render_book,
+    "newspaper"      : tasks.render_book,
+    "web"            : tasks.render_book,
+    "bookjs/pdf"     : tasks.render_bookjs_pdf,
+    "bookjs/zip"     : tasks.render_bookjs_zip,
+    "openoffice"     : tasks.render_openoffice,
+    "bookizip"       : tasks.render_bookizip,
+    "templated_html" : tasks.render_templated_html,
+    "epub"           : tasks.render_epub,
+    }
+
+
 def default(request):
     mode = request.REQUEST.get("mode")
 
@@ -87,37 +105,151 @@ def default(request):
     elif mode == "booklist":
         return fetch_booklist(request)
 
+    method = request.REQUEST.get("method", "sync")
+    if method == "poll":
+        return job_status(request, request.REQUEST.get("job"))
+
     book = request.REQUEST.get("book")
 
     if book and not mode:
         mode = "book"
 
-    def call_task(task):
-        result = task.delay(request.REQUEST)
-        return result.get()
-        #return task(request.REQUEST)
-
-    if mode in ("book", "newspaper", "web"):
-        return call_task(tasks.render_book)
-    elif mode == "bookjs/pdf":
-        return call_task(tasks.render_bookjs_pdf)
-    elif mode == "bookjs/zip":
-        return call_task(tasks.render_bookjs_zip)
-    elif mode == "openoffice":
-        return call_task(tasks.render_openoffice)
-    elif mode == "bookizip":
-        return call_task(tasks.render_bookizip)
-    elif mode == "templated_html":
-        return call_task(tasks.render_templated_html)
-    elif mode == "epub":
-        return call_task(tasks.render_epub)
-    else:
+    task = RENDER_TASKS.get(mode)
+    if task is None:
         return show_form(request)
 
+    result = submit(task, mode, request.REQUEST)
+    if method == "async":
+        response = job_response(request, result)
+        response.status_code = 202
+        response["Location"] = job_url(request, "job_status", result.id)
+        return response
+    try:
+        descriptor = result.get(timeout = config.JOB_SYNC_TIMEOUT)
+    except TimeoutError:
+        book_utils.log("gave up waiting for job %s" % result.id)
+        response = job_response(request, result)
+        response.status_code = 504
+        response["Location"] = job_url(request, "job_status", result.id)
+        return response
+    return downloads.serve(request, descriptor)
+
+
+def submit(task, mode, args):
+    """Start the task, unless an identical request is already being
+    worked on, in which case its job is shared.  Finished jobs aren't
+    shared, so a repeated request gets a fresh render (which the
+    render cache will usually make cheap).
+
+    The job is found through a cache entry that the task renews at
+    each stage and removes when it ends (see tasks.renew_job and
+    tasks.release_job), so a job that dies without finishing stops
+    being joined after config.COALESCE_TIMEOUT seconds.
+
+    The queue is only chosen (which can mean reading the book's zip)
+    when a job is actually started."""
+    if not config.USE_REQUEST_COALESCING:
+        return task.apply_async(args = [args], **routing.queue_options(mode, args))
+
+    key = tasks.job_key(mode, args)
+    for attempt in range(3):
+        job_id = uuid()
+        if cache.add(key, job_id, config.COALESCE_TIMEOUT):
+            try:
+                return task.apply_async(args = [args], kwargs = {"job_key" : key},
+                                        task_id = job_id,
+                                        **routing.queue_options(mode, args))
+            except:
+                tasks.release_job(key, job_id)
+                raise
+        job_id = cache.get(key)
+        if job_id is not None:
+            result = AsyncResult(job_id)
+            if not result.ready():
+                book_utils.log("joining job %s for an identical request" % job_id)
+                return result
+            tasks.release_job(key, job_id)
+    return task.apply_async(args = [args], **routing.queue_options(mode, args))
+
+
+def job_url(request, view, job_id):
+    return request.build_absolute_uri(
+        reverse("objavi.classic.views.%s" % view, args=[job_id]))
+
+
+def job_response(request, result):
+    """A JSON description of the job's state, with the urls for
+    polling it and (once it is done) downloading the result."""
+    state = result.state
+    info = {
+        "job"        : result.id,
+        "state"      : state,
+        "status_url" : job_url(request, "job_status", result.id),
+        }
+    if state == "PROGRESS" and isinstance(result.info, dict):
+        info["stage"] = result.info.get("stage")
+    elif state == "SUCCESS":
+        info["download_url"] = job_url(request, "job_download", result.id)
+        if isinstance(result.result, dict) and "metrics" in result.result:
+            info["metrics"] = result.result["metrics"]
+    elif state == "FAILURE":
+        info["error"] = str(result.info)
+    return HttpResponse(json.dumps(info), content_type = "application/json")
+
+
+def job_status(request, job_id):
+    """Report the state of a job started with method=async.  With a
+    'wait' parameter this is a long poll: the response is delayed
+    until the job's state or stage differs from the 'state' and
+    'stage' parameters (what the client last saw), or the wait (in
+    seconds, at most config.JOB_LONG_POLL_MAX) is over."""
+    if not job_id:
+        raise Http404
+    result = AsyncResult(job_id)
+    try:
+        wait = min(float(request.REQUEST.get("wait", 0)), config.JOB_LONG_POLL_MAX)
+    except ValueError:
+        wait = 0
+    seen = (request.REQUEST.get("state"), request.REQUEST.get("stage"))
+
+    def current():
+        state = result.state
+        stage = None
+        if state == "PROGRESS" and isinstance(result.info, dict):
+            stage = result.info.get("stage")
+        return state, stage
+
+    end = time.time() + wait
+    while current() == seen and not result.ready() and time.time() < end:
+        time.sleep(config.JOB_POLL_INTERVAL)
+    return job_response(request, result)
+
+
+def job_download(request, job_id):
+    """The finished job's book, as the synchronous method would have
+    returned it."""
+    result = AsyncResult(job_id)
+    if not result.ready():
+        response = job_response(request, result)
+        response.status_code = 409
+        return response
+    if not result.successful():
+        #result.get() would raise the task's exception again
+        response = job_response(request, result)
+        response.status_code = 500
+        return response
+    return downloads.serve(request, result.result)
+
+
+def fetch_metrics(request):
+    """Stage timings of all renders so far, for Prometheus."""
+    return HttpResponse(metrics.prometheus_text(),
+                        content_type = "text/plain; version=0.0.4")
+
 
 def espri(request):
     if request.GET.get("mode", "html") != "html":
-        return tasks.ingress_epub(request.GET)
+        return downloads.serve(request, tasks.ingress_epub(request.GET))
 
     result = ""
     if request.GET:
@@ -155,4 +287,4 @@ def run_espri(source, book):
     return book_link
 
 
-__all__ = [fetch_fontlist, fetch_booklist, fetch_css, default, espri]
+__all__ = [fetch_fontlist, fetch_booklist, fetch_css, default, job_status, job_download, fetch_metrics, espri]
@@ -88,6 +88,12 @@ from objavi.constants import BOOKIZIP_MIMETYPE
 BOOKI_BOOK_DIR = '%s/booki-books' % DATA_ROOT
 BOOKI_BOOK_URL = '%s/booki-books' % DATA_URL
 
+# sqlite index of the zips in BOOKI_BOOK_DIR, and limits for evicting
+# them.  Zips used in the last BOOKI_ZIP_STORE_MIN_AGE seconds are kept.
+BOOKI_ZIP_INDEX = '%s/index.sqlite' % BOOKI_BOOK_DIR
+BOOKI_ZIP_STORE_MAX_SIZE = 10 * 1024 * 1024 * 1024
+BOOKI_ZIP_STORE_MIN_AGE = 3600
+
 PUBLISH_DIR = '%s/books' % DATA_ROOT
 PUBLISH_URL = '%s/books' % DATA_URL
 
@@ -96,25 +102,113 @@ HTML_PUBLISH_DIR = '%s/published' % DATA_ROOT
 BOOKI_SHARED_DIRECTORY = '%s/shared' % DATA_ROOT
 BOOKI_SHARED_LONELY_USER_PREFIX = 'lonely-user-'
 
+# finished renders, keyed on bookizip hash and request arguments.
+# Increment RENDER_ENGINE_VERSION whenever a change in the code or the
+# external tools would change the output for the same input.
+USE_RENDER_CACHE = True
+RENDER_CACHE_DIR = os.path.join(CACHE_DIR, 'renders')
+RENDER_CACHE_MAX_AGE = 7 * 24 * 3600
+# once the cached renders take more than this many bytes, the least
+# recently used ones are removed
+RENDER_CACHE_MAX_SIZE = 20 * 1024 * 1024 * 1024
+RENDER_ENGINE_VERSION = '1'
+# request arguments that don't change the rendered output
+RENDER_CACHE_IGNORED_ARGS = ('destination', 'max_age', 'booki_group', 'booki_user')
+
+# ISBN barcode pages, keyed on the code, page size, margins and corner
+BARCODE_CACHE_DIR = os.path.join(CACHE_DIR, 'barcodes')
+
 
 ##
 # external tools
 #
 
 TIMEOUT_CMD = 'timeout'
+# book_utils.run starts commands through these (from util-linux)
+SETSID = 'setsid'
+PRLIMIT = 'prlimit'
+
+# limits on the commands run by book_utils.run.  After RUN_TIMEOUT
+# seconds a command's process group is sent SIGTERM, and SIGKILL
+# RUN_KILL_GRACE seconds later.  RUN_CPU_LIMIT (CPU seconds) and
+# RUN_MEMORY_LIMIT (bytes of address space) are set as rlimits (with
+# PRLIMIT, so it must be installed if they are used).  None
+# means no limit.  RUN_COMMAND_LIMITS overrides these for particular
+# commands, e.g. {'pdfedit': {'timeout': 300, 'memory_limit': 2 << 30}}
+RUN_TIMEOUT = 1800
+RUN_KILL_GRACE = 5
+RUN_CPU_LIMIT = None
+RUN_MEMORY_LIMIT = None
+RUN_COMMAND_LIMITS = {}
+# at most this many bytes of each of a command's stdout and stderr are
+# kept (half from the start and half from the end)
+RUN_CAPTURE_LIMIT = 64 * 1024
 WIKIBOOKS_TIMEOUT = '600'
 WIKIBOOKS_CACHE = '%s/wikibooks' % CACHE_DIR
 WIKIBOOKS_CMD = '%s/wikibooks2epub' % TOOL_DIR
 
 PDFNUP   = '%s/pdfnup'   % TOOL_DIR
 HTML2ODT = '%s/html2odt' % TOOL_DIR
+# socket of a resident `html2odt --server`; if nothing is listening,
+# html2odt is run for each book instead.  Set to None to never try.
+HTML2ODT_SOCKET = os.path.join(OBJAVI_DIR, 'html2odt.sock')
+HTML2ODT_TIMEOUT = 600
 
 WKHTMLTOPDF = 'wkhtmltopdf'
 WKHTMLTOPDF_EXTRA_COMMANDS = []
 
+# How wkhtmltopdf waits for javascript.  Documents without scripts
+# are printed as soon as they have loaded.  Documents with scripts
+# get a script that sets window.status to WKHTMLTOPDF_READY_STATUS
+# after the load event, and wkhtmltopdf waits for that (the script
+# is added to the boilerplate footers too).  If the installed wkhtmltopdf
+# lacks --window-status, set WKHTMLTOPDF_USE_WINDOW_STATUS to False,
+# and documents with scripts get a fixed delay of
+# WKHTMLTOPDF_SCRIPT_DELAY milliseconds instead.
+WKHTMLTOPDF_USE_WINDOW_STATUS = True
+WKHTMLTOPDF_READY_STATUS = 'objavi-ready'
+WKHTMLTOPDF_SCRIPT_DELAY = 2000
+
+# The body, end matter and barcode of a book pdf are made in parallel,
+# with up to this many at once (the preamble needs the body's page
+# numbers, so it waits).
+PDF_STAGE_WORKERS = 3
+
+# Each worker process keeps up to XVFB_POOL_SIZE idle Xvfb displays,
+# replacing each one after it has been used for XVFB_MAX_USES books.
+XVFB_POOL_SIZE = 1
+XVFB_MAX_USES = 100
+XVFB_START_TIMEOUT = 10
+# Each display the pools start is recorded by a pidfile in this
+# directory, so that displays left by dead workers can be stopped (see
+# xvfb.reap_orphans)
+XVFB_PID_DIR = os.path.join(DATA_ROOT, 'tmp', 'xvfb')
+
 
 #use hacked version of wkhtmltopdf that writes outline to a file
 USE_DUMP_OUTLINE = True
+
+#wkhtmltopdf turns <a name="__WKANCHOR_..."> into a named destination
+#in the PDF.  Chapter headings get one of these, so their pages can be
+#found if the outline is missing.
+HEADING_ANCHOR_NAME = '__WKANCHOR_objavi_h1_%s'
+
+#Long books can be split at section boundaries into BODY_CHUNKS parts,
+#which are rendered by wkhtmltopdf (up to PDF_STAGE_WORKERS at a time)
+#and then joined.
+#Books with fewer than BODY_CHUNK_MIN_CHAPTERS chapters are rendered
+#whole, as are multi-column books.
+BODY_CHUNKS = 1
+BODY_CHUNK_MIN_CHAPTERS = 30
+#links between chunks are made into URIs with this prefix and a named
+#anchor, and turned back into links when the chunks are joined.
+BODY_CHUNK_LINK_PREFIX = 'objavi-dest:'
+BODY_CHUNK_ANCHOR_NAME = '__WKANCHOR_objavi_id_%s'
+
+#read page counts and outlines, and join, rotate, reshape and n-up
+#PDFs, with objavi.pdf_utils rather than pdfinfo, pdftk, gs, pdfedit
+#and pdfnup (which are still used if that fails)
+USE_NATIVE_PDF = True
 CONTENTS_DEPTH = 1
 
 #CGITB_DOMAINS = ('203.97.236.46', '202.78.240.7')
@@ -151,9 +245,25 @@ TEMPLATING_INDEX_MODES = {  # contents file, first file
 }
 TAR_TEMPLATED_HTML = True
 
+# Chapters are parsed in this many threads when the book is loaded
+# (1 parses them one by one).
+CONCAT_HTML_THREADS = 4
+
+# Parsed chapters are kept in memory, keyed by their CRC32 in the zip,
+# so that unchanged chapters don't need to be parsed again by the same
+# worker.  This limits the memory they use, which is estimated as the
+# size of the source plus CHAPTER_CACHE_ELEMENT_BYTES for each element
+# (lxml trees take 5 to 20 times the size of their html).
+CHAPTER_CACHE_MAX_BYTES = 256 * 1024 * 1024
+CHAPTER_CACHE_ELEMENT_BYTES = 500
+
 POLL_NOTIFY_PATH = 'htdocs/progress/%s.txt'
 #POLL_NOTIFY_URL = 'http://%(HTTP_HOST)s/progress/%(bookname)s.txt'
 
+# remember the ETag and Last-Modified headers of fetched booki-zips,
+# and only download them again if the server says they have changed.
+USE_CONDITIONAL_ZIP_FETCH = True
+
 ZIP_URLS = {
     'TWiki':   'http://objavi.booki.cc/booki-twiki-gateway.cgi?server=%(server)s&book=%(book)s&mode=zip',
     'Booki':   'http://%(server)s/export/%(book)s/export',
@@ -384,6 +494,75 @@ NOWHERE_TEMPLATE        = os.path.join(OBJAVI_SOURCE_DIR, 'templates/nowhere.txt
 
 FINISHED_MESSAGE = 'FINISHED'
 
+# method=async returns a job id at once; method=poll (or job/<id>)
+# reports the job's state, waiting up to ?wait= seconds (at most
+# JOB_LONG_POLL_MAX) for it to change.  method=sync waits up to
+# JOB_SYNC_TIMEOUT seconds for the book.
+JOB_LONG_POLL_MAX = 30
+JOB_POLL_INTERVAL = 0.5
+JOB_SYNC_TIMEOUT = 1800
+
+# Identical render requests made while one is running share its job
+# rather than starting another.  The running jobs are found through
+# Django's cache, which must be shared by all the web processes
+# (e.g. memcached) for this to work across them.  A job's cache entry
+# lasts COALESCE_TIMEOUT seconds, and is renewed at each stage of the
+# render, so it should be longer than the slowest stage.
+USE_REQUEST_COALESCING = True
+COALESCE_TIMEOUT = 600
+# request arguments that don't change the job
+COALESCE_IGNORED_ARGS = ('method', 'job', 'wait', 'state', 'stage')
+
+# Send quick renders and slow ones to separate celery queues, so the
+# quick ones don't wait behind the slow (see objavi.classic.routing).
+# Each queue needs its own workers, e.g. "celery worker -Q objavi-light".
+USE_RENDER_QUEUES = False
+LIGHT_QUEUE = 'objavi-light'
+HEAVY_QUEUE = 'objavi-heavy'
+# priority given to jobs in each queue (the meaning of the numbers
+# depends on the broker), or nothing
+RENDER_QUEUE_PRIORITY = {}
+# the estimated cost of a render is its mode's weight times the book's
+# size in chapters, with every RENDER_COST_IMAGE_BYTES of images
+# counting as a chapter.  Books that haven't been fetched before are
+# assumed to be RENDER_COST_DEFAULT_SIZE chapters.
+RENDER_MODE_COST = {
+    'bookizip': 0,
+    'templated_html': 0.1,
+    'bookjs/zip': 0.1,
+    'epub': 0.2,
+    'web': 1,
+    'book': 1.5,
+    'bookjs/pdf': 1.5,
+    'openoffice': 2,
+    'newspaper': 2.5,
+}
+RENDER_COST_IMAGE_BYTES = 2 * 1024 * 1024
+RENDER_COST_DEFAULT_SIZE = 20
+LIGHT_JOB_MAX_COST = 10
+# tasks routed by name (for CELERY_ROUTES = ('objavi.classic.routing.TaskRouter',))
+LIGHT_TASKS = ('render_bookizip', 'render_templated_html', 'render_bookjs_zip',
+               'render_epub', 'ingress_epub')
+HEAVY_TASKS = ('render_book', 'render_bookjs_pdf', 'render_openoffice')
+
+# time the stages of each render (see objavi.metrics).  A JSON report
+# for each book is kept in METRICS_DIR for METRICS_REPORT_MAX_AGE
+# seconds, and the totals are served in Prometheus format at /metrics.
+USE_METRICS = True
+METRICS_DIR = os.path.join(OBJAVI_DIR, 'metrics')
+METRICS_DB = os.path.join(METRICS_DIR, 'metrics.sqlite')
+METRICS_REPORT_MAX_AGE = 7 * 24 * 3600
+# histogram buckets for stage times, in seconds
+METRICS_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+# Finished books can be handed to the front end server rather than
+# sent by Django: set SENDFILE_HEADER to 'X-Sendfile' (Apache
+# mod_xsendfile, lighttpd) or 'X-Accel-Redirect' (nginx).  For
+# X-Accel-Redirect, SENDFILE_URL_MAP pairs local directories with the
+# internal locations that serve them, e.g. ((PUBLISH_DIR, '/internal/books'),)
+SENDFILE_HEADER = None
+SENDFILE_URL_MAP = ()
+
 
 S3_SECRET = '/home/luka/s3.archive.org-secret'
 S3_ACCESSKEY = '/home/luka/s3.archive.org-accesskey'
@@ -26,7 +26,7 @@ import re, time
 import random
 import shutil
 import copy
-from subprocess import Popen, check_call, PIPE
+from subprocess import check_call
 from cStringIO import StringIO
 from urllib2 import urlopen, HTTPError
 import zipfile
@@ -34,6 +34,9 @@ import traceback
 from string import ascii_letters
 from pprint import pformat
 import mimetypes
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from django.utils.encoding import smart_unicode
 
@@ -47,21 +50,70 @@ from lxml import etree
 
 from objavi import config, epub_utils
 from objavi.book_utils import log, run, make_book_name, guess_lang, guess_text_dir, url_fetch, url_fetch2
+from objavi.book_utils import url_save_conditional
 from objavi.book_utils import ObjaviError, log_types, guess_page_number_style, get_number_localiser
-from objavi.book_utils import get_server_defaults
+from objavi.book_utils import get_server_defaults, run_stages
 from objavi.pdf import PageSettings, count_pdf_pages, concat_pdfs, concat_pdfs_gs, rotate_pdf
-from objavi.pdf import parse_outline, parse_extracted_outline, embed_all_fonts
+from objavi.pdf import overlay_pdf
+from objavi.pdf import parse_outline, parse_extracted_outline, embed_all_fonts, find_anchor_pages
 from objavi.epub import add_guts, _find_tag
 from objavi.xhtml_utils import EpubChapter, split_tree, empty_html_tree
-from objavi.xhtml_utils import utf8_html_parser, localise_local_links
-from objavi.cgi_utils import path2url, try_to_kill
+from objavi.xhtml_utils import utf8_html_parser, LinkLocaliser
+from objavi.cgi_utils import path2url
 from objavi.constants import DC, DCNS, FM, OPF, OPFNS
-from objavi import cover
+from objavi import cover, xvfb, odtserver
+from objavi.zipstore import ZipStore
 
 from booki.bookizip import get_metadata, add_metadata
 
 
 
+_thread_parsers = threading.local()
+
+
+class ChapterCache(object):
+    """A least recently used cache of parsed chapters, shared by all
+    the books made in this process.  Chapters are keyed by the CRC32,
+    size and mimetype of their zip member, so a chapter that hasn't
+    changed between versions of a book is found again.  Trees are
+    copied on the way in and out, because the callers modify them.
+    Their sizes are estimated (see config.CHAPTER_CACHE_ELEMENT_BYTES),
+    as a parsed tree is much bigger than its html."""
+    def __init__(self, max_bytes=config.CHAPTER_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.trees = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.trees
+
+    def get(self, key):
+        with self.lock:
+            entry = self.trees.pop(key, None)
+            if entry is None:
+                return None
+            self.trees[key] = entry
+        return copy.deepcopy(entry[0])
+
+    def put(self, key, tree):
+        elements = sum(1 for e in tree.iter())
+        size = key[1] + elements * config.CHAPTER_CACHE_ELEMENT_BYTES
+        if size > self.max_bytes:
+            return
+        tree = copy.deepcopy(tree)
+        with self.lock:
+            if key in self.trees:
+                return
+            self.trees[key] = (tree, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                k, (t, s) = self.trees.popitem(last=False)
+                self.size -= s
+
+_chapter_cache = ChapterCache()
+
+
 def find_archive_urls(bookid, bookname):
     s3url = 'http://s3.us.archive.org/booki-%s/%s' % (bookid, bookname)
     detailsurl = 'http://archive.org/details/booki-%s' % (bookid,)
@@ -84,6 +136,15 @@ def _add_initial_number(e, n, localiser=str):
     e.text = ''
     initial.text = "%s." % localiser(n)
 
+def _insert_anchor(e, name):
+    """Put an empty <a name="name"> at the beginning of element e,
+    returning it."""
+    a = e.makeelement('a', {'name': name})
+    a.tail = e.text
+    e.text = None
+    e.insert(0, a)
+    return a
+
 def expand_toc(toc, depth=1, index=0):
     """Reformat toc slightly for convenience"""
     for item in toc:
@@ -158,12 +219,18 @@ class Book(object):
                 message = traceback.extract_stack(None, 2)[0][2]
             log("notify_watcher called with '%s'" % message)
             for w in self.watchers:
-                w(message)
+                #a broken watcher shouldn't spoil the book
+                try:
+                    w(message)
+                except Exception:
+                    log("watcher %r failed on %r:\n%s" % (w, message, traceback.format_exc()))
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.notify_watcher("ERROR: %s" % exc_value)
         self.notify_watcher(config.FINISHED_MESSAGE)
         self.cleanup()
         #could deal with exceptions here and return true
@@ -183,16 +250,16 @@ class Book(object):
         self.server = server
         self.cookie = ''.join(random.sample(ascii_letters, 10))
         try:
-            blob, self.bookizip_file = fetch_zip(server, book, save=True, max_age=max_age)
+            self.bookizip_file = fetch_zip(server, book, max_age=max_age)
         except HTTPError, e:
             traceback.print_exc()
             self.notify_watcher("ERROR:\n Couldn't get %r\n %s %s" % (e.url, e.code, e.msg))
             #not much to do?
             #raise 502 Bad Gateway ?
             sys.exit()
-        f = StringIO(blob)
         self.notify_watcher('fetch_zip')
-        self.store = zipfile.ZipFile(f, 'r')
+        #members are read from the file as they are needed
+        self.store = zipfile.ZipFile(self.bookizip_file, 'r')
         self.info = json.loads(self.store.read('info.json'))
         for k in ('manifest', 'metadata', 'spine', 'TOC'):
             if k not in self.info:
@@ -289,28 +356,108 @@ class Book(object):
 
     def get_tree_by_id(self, id):
         """get an HTML tree from the given manifest ID"""
+        for id, tree in self.get_trees_by_id([id], threads=1):
+            if isinstance(tree, Exception):
+                raise tree
+            return tree
+
+    def _chapter_key(self, id):
+        """The key of a chapter in the parsed chapter cache, or None
+        if it isn't the sort of thing that is cached."""
+        details = self.manifest[id]
+        mimetype = details['mimetype']
+        if mimetype != 'text/html' and 'xml' not in mimetype:
+            return None
+        info = self.store.getinfo(details['url'])
+        return (info.CRC, info.file_size, mimetype)
+
+    def _parse_member(self, id, s, parser=utf8_html_parser):
         name = self.manifest[id]['url']
         mimetype = self.manifest[id]['mimetype']
-        s = self.store.read(name)
-        f = StringIO(s)
         if mimetype == 'text/html':
             if s == '':
                 log('html ID %r is empty! Not parsing' % (id,))
                 tree = empty_html_tree()
             else:
                 try:
-                    tree = lxml.html.parse(f, parser=utf8_html_parser)
+                    #parsing from a string lets lxml release the GIL
+                    tree = etree.fromstring(s, parser=parser).getroottree()
                 except etree.XMLSyntaxError, e:
                     log('Could not parse html ID %r, filename %r, string %r... exception %s' %
                         (id, name, s[:20], e))
                     tree = empty_html_tree()
         elif 'xml' in mimetype: #XXX or is this just asking for trouble?
-            tree = etree.parse(f)
+            tree = etree.parse(StringIO(s))
         else:
-            tree = f.read()
-        f.close()
+            tree = s
         return tree
 
+    def get_trees_by_id(self, ids, threads=config.CONCAT_HTML_THREADS):
+        """Generate (id, tree) pairs for the given manifest IDs, in
+        order.  The zip is read serially, because ZipFile is not thread
+        safe, but the parsing is spread over <threads> threads.  If a
+        chapter can't be read or parsed, the exception takes the place
+        of its tree."""
+        #read() runs in the pool's feeder thread, and fill() in this
+        #one, so the zip is only touched while holding this.
+        store_lock = threading.Lock()
+
+        def parse(item):
+            id, key, s = item
+            if s is None or isinstance(s, Exception):
+                return id, key, s
+            parser = getattr(_thread_parsers, 'parser', None)
+            if parser is None:
+                #lxml parsers can only be used by one thread at a time
+                parser = lxml.html.HTMLParser(encoding='utf-8')
+                _thread_parsers.parser = parser
+            try:
+                tree = self._parse_member(id, s, parser)
+                if key is not None:
+                    _chapter_cache.put(key, tree)
+                return id, key, tree
+            except Exception, e:
+                return id, key, e
+
+        def read(ids):
+            #chapters found in the cache aren't read or parsed.
+            for id in ids:
+                try:
+                    with store_lock:
+                        key = self._chapter_key(id)
+                        if key is not None and key in _chapter_cache:
+                            s = None
+                        else:
+                            s = self.store.read(self.manifest[id]['url'])
+                    yield id, key, s
+                except Exception, e:
+                    yield id, None, e
+
+        def fill(item):
+            #the cached copy is taken here rather than in read(), so
+            #that there aren't too many copies waiting around.
+            id, key, tree = item
+            if tree is None:
+                tree = _chapter_cache.get(key)
+            if tree is None:
+                #it was evicted after read() looked
+                with store_lock:
+                    s = self.store.read(self.manifest[id]['url'])
+                id, key, tree = parse((id, key, s))
+            return id, tree
+
+        if threads <= 1:
+            for item in read(ids):
+                yield fill(parse(item))
+            return
+
+        pool = ThreadPool(threads)
+        try:
+            for item in pool.imap(parse, read(ids)):
+                yield fill(item)
+        finally:
+            pool.terminate()
+
     def filepath(self, fn):
         path = self.workdir + "/" + fn.decode("utf-8")
         return path.encode("utf-8")
@@ -323,7 +470,8 @@ class Book(object):
         return fn
 
     def make_oo_doc(self, cover_url = None):
-        """Make an openoffice document, using the html2odt script."""
+        """Make an openoffice document, using the html2odt server if
+        there is one, or otherwise the html2odt script."""
         self.wait_for_xvfb()
 
         if cover_url:
@@ -335,7 +483,8 @@ class Book(object):
 
         html_text = etree.tostring(self.tree, method="html", encoding="UTF-8")
         save_data(self.body_html_file, html_text)
-        run([config.HTML2ODT, self.workdir, self.body_html_file, self.body_odt_file])
+        if not odtserver.convert(self.workdir, self.body_html_file, self.body_odt_file):
+            run([config.HTML2ODT, self.workdir, self.body_html_file, self.body_odt_file])
 
         log("Publishing %r as %r" % (self.body_odt_file, self.publish_file))
         os.rename(self.body_odt_file, self.publish_file)
@@ -364,27 +513,35 @@ class Book(object):
         return number_of_pages
 
     def _extract_pdf_outline_the_old_way(self):
-        """Try to get the PDF outline using pdftk.  This doesn't work
-        well with all scripts."""
+        """Try to get the PDF outline from the PDF itself, or failing
+        that from the anchors added to the chapter headings by
+        make_body_html.  With pdftk (rather than objavi.pdf_utils)
+        this doesn't work well with all scripts."""
         debugf = self.filepath('extracted-outline.txt')
         self.outline_contents, number_of_pages = \
                 parse_outline(self.body_pdf_file, 1, debugf)
 
+        if not self.outline_contents:
+            self.outline_contents = self._outline_from_heading_anchors()
+
         if not self.outline_contents:
             #probably problems with international text. need a horrible hack
             log('no outline: trying again with ascii headings')
             import copy
             tree = copy.deepcopy(self.tree)
             titlemap = {}
-            for tag in ('h1', 'h2', 'h3', 'h4'):
-                for i, e in enumerate(tree.getiterator(tag)):
-                    key = "%s_%s" % (tag, i)
-                    titlemap[key] = e.text_content().strip(config.WHITESPACE_AND_NULL)
-                    del e[:]
-                    if tag == 'h1':
-                        e = lxml.etree.SubElement(e, "strong", Class="initial")
-                    e.text = key
-                    log("key: %r, text: %r, value: %r" %(key, e.text, titlemap[key]))
+            counts = dict.fromkeys(('h1', 'h2', 'h3', 'h4'), 0)
+            #one pass over the tree for all the heading levels
+            for e in tree.iter(*counts):
+                tag = e.tag
+                key = "%s_%s" % (tag, counts[tag])
+                counts[tag] += 1
+                titlemap[key] = e.text_content().strip(config.WHITESPACE_AND_NULL)
+                del e[:]
+                if tag == 'h1':
+                    e = lxml.etree.SubElement(e, "strong", Class="initial")
+                e.text = key
+                log("key: %r, text: %r, value: %r" %(key, e.text, titlemap[key]))
 
             ascii_html_file = self.filepath('body-ascii-headings.html')
             ascii_pdf_file = self.filepath('body-ascii-headings.pdf')
@@ -410,22 +567,196 @@ class Book(object):
 
         return number_of_pages
 
-    def make_body_html(self):
-        html_text = etree.tostring(self.tree, method="html", encoding="UTF-8")
-        save_data(self.body_html_file, html_text)
+    def _outline_from_heading_anchors(self):
+        """Find the chapters' pages from the named destinations left by
+        the heading anchors, if every one of them made it into the
+        PDF."""
+        anchors = getattr(self, 'heading_anchors', None)
+        if not anchors:
+            return []
+        try:
+            pages = find_anchor_pages(self.body_pdf_file, [x[0] for x in anchors])
+        except Exception, e:
+            log("could not read named destinations: %s" % e)
+            return []
+        if len(pages) != len(anchors):
+            log("found %s of %s heading anchors" % (len(pages), len(anchors)))
+            return []
+        log("found chapter pages from heading anchors")
+        return [(title, 1, pages[name]) for name, title in anchors]
+
+    def _add_heading_anchors(self):
+        """Put an anchor named after config.HEADING_ANCHOR_NAME at the
+        start of each h1, keeping their names and the headings' text in
+        self.heading_anchors.  Returns the anchors, for
+        _remove_anchors."""
+        added = []
+        self.heading_anchors = []
+        for i, h1 in enumerate(self.tree.iter('h1')):
+            name = config.HEADING_ANCHOR_NAME % i
+            title = h1.text_content().strip(config.WHITESPACE_AND_NULL)
+            added.append(_insert_anchor(h1, name))
+            self.heading_anchors.append((name, title))
+        return added
+
+    def _remove_anchors(self, anchors):
+        """Undo _insert_anchor, latest first."""
+        for a in reversed(anchors):
+            parent = a.getparent()
+            parent.text = a.tail
+            parent.remove(a)
+
+    def make_body_html(self, heading_anchors=False):
+        """Save the tree as HTML.  If <heading_anchors> is true, the
+        saved file has anchors in the headings (see
+        _add_heading_anchors), but the tree is left unchanged."""
+        added = []
+        if heading_anchors:
+            added = self._add_heading_anchors()
+        try:
+            html_text = etree.tostring(self.tree, method="html", encoding="UTF-8")
+            save_data(self.body_html_file, html_text)
+        finally:
+            self._remove_anchors(added)
+
+    def _body_chunks(self):
+        """Decide how to split the body for rendering in parts.
+        Returns a list of (start, end) slices of the body's children,
+        each beginning with a section (see add_section_titles), or an
+        empty list if the book should be rendered whole."""
+        if (config.BODY_CHUNKS < 2 or self.maker.columns != 1 or
+            sum(1 for x in self.tree.iter('h1')) < config.BODY_CHUNK_MIN_CHAPTERS):
+            return []
+        body = _find_tag(self.tree, 'body')
+        #parts are weighed by their number of elements
+        weights = [sum(1 for x in e.iter()) for e in body]
+        target = float(sum(weights)) / config.BODY_CHUNKS
+        chunks = []
+        start = 0
+        weight = 0
+        for i, e in enumerate(body):
+            if (i > start and weight >= target * (len(chunks) + 1) and
+                e.get('class') == 'objavi-subsection'):
+                chunks.append((start, i))
+                start = i
+            weight += weights[i]
+        chunks.append((start, len(weights)))
+        if len(chunks) < 2:
+            return []
+        return chunks
+
+    def _save_body_chunks(self, chunks):
+        """Save each chunk of the body as a separate HTML file,
+        returning their names.  Links to elements in other chunks are
+        turned into config.BODY_CHUNK_LINK_PREFIX URIs, with a named
+        anchor at the target, so they can be restored when the PDFs
+        are joined."""
+        body = _find_tag(self.tree, 'body')
+        children = list(body)
+        id_chunk = {}
+        for n, (start, end) in enumerate(chunks):
+            for child in children[start:end]:
+                for e in child.iter():
+                    ID = e.get('id')
+                    if ID is not None and ID not in id_chunk:
+                        id_chunk[ID] = (n, e)
+
+        html_files = []
+        added = self._add_heading_anchors()
+        changed_links = []
+        anchored = set()
+        try:
+            for n, (start, end) in enumerate(chunks):
+                for child in children[start:end]:
+                    for link in child.iter('a'):
+                        href = link.get('href')
+                        if not href or not href.startswith('#'):
+                            continue
+                        target = id_chunk.get(href[1:])
+                        if target is None or target[0] == n:
+                            continue
+                        name = config.BODY_CHUNK_ANCHOR_NAME % href[1:]
+                        if name not in anchored:
+                            added.append(_insert_anchor(target[1], name))
+                            anchored.add(name)
+                        changed_links.append((link, href))
+                        link.set('href', config.BODY_CHUNK_LINK_PREFIX + name)
+
+            for n, (start, end) in enumerate(chunks):
+                body[:] = children[start:end]
+                html_file = self.filepath('body-%s.html' % n)
+                html_text = etree.tostring(self.tree, method="html", encoding="UTF-8")
+                save_data(html_file, html_text)
+                html_files.append(html_file)
+        finally:
+            body[:] = children
+            for link, href in changed_links:
+                link.set('href', href)
+            self._remove_anchors(added)
+        return html_files
+
+    def _make_chunked_body_pdf(self, chunks):
+        """Render the chunks of the body at the same time, without
+        page numbers.  Once their lengths are known, the page numbers
+        are rendered separately (again at the same time) with the
+        right offsets, and drawn over the pages.  Then the chunks are
+        joined into the body PDF."""
+        html_files = self._save_body_chunks(chunks)
+        pdfs = [x[:-5] + '.pdf' for x in html_files]
+        indexes = range(len(pdfs))
+
+        def render(n):
+            self.maker.make_raw_pdf(html_files[n], pdfs[n], outline=True)
+
+        pool = ThreadPool(min(len(pdfs), config.PDF_STAGE_WORKERS))
+        try:
+            pool.map(render, indexes)
+            if self.page_number_style:
+                counts = [count_pdf_pages(x) for x in pdfs]
+                offsets = [sum(counts[:n]) for n in indexes]
+                log("rendered body in chunks of %s pages" % counts)
+
+                def number(n):
+                    numbers_pdf = pdfs[n][:-4] + '-numbers.pdf'
+                    self.maker.make_page_number_pdf(numbers_pdf, counts[n],
+                                                    self.page_number_style,
+                                                    offsets[n])
+                    overlay_pdf(pdfs[n], numbers_pdf)
+
+                pool.map(number, indexes)
+        finally:
+            pool.close()
+            pool.join()
+        concat_pdfs(self.body_pdf_file, *pdfs)
 
     def make_body_pdf(self):
         """Make a pdf of the HTML, using webkit"""
-        #1. Save the html
-        self.make_body_html()
+        chunks = self._body_chunks()
+        n_pages = None
+        if chunks:
+            try:
+                self._make_chunked_body_pdf(chunks)
+                self.notify_watcher('generate_pdf')
+                #the joined PDF has the outlines of all the chunks
+                n_pages = self._extract_pdf_outline_the_old_way()
+                if n_pages is None:
+                    n_pages = count_pdf_pages(self.body_pdf_file)
+            except Exception, e:
+                traceback.print_exc()
+                log("could not render the body in chunks; rendering it whole")
+                n_pages = None
 
-        #2. Make a pdf of it
-        self.maker.make_raw_pdf(self.body_html_file, self.body_pdf_file, outline=True,
-                                outline_file=self.outline_file,
-                                page_num=self.page_number_style)
-        self.notify_watcher('generate_pdf')
+        if n_pages is None:
+            #1. Save the html
+            self.make_body_html(heading_anchors=True)
 
-        n_pages = self.extract_pdf_outline()
+            #2. Make a pdf of it
+            self.maker.make_raw_pdf(self.body_html_file, self.body_pdf_file, outline=True,
+                                    outline_file=self.outline_file,
+                                    page_num=self.page_number_style)
+            self.notify_watcher('generate_pdf')
+
+            n_pages = self.extract_pdf_outline()
 
         log ("found %s pages in pdf" % n_pages)
         #4. resize pages, shift gutters, even pages
@@ -461,12 +792,8 @@ class Book(object):
 
     def make_end_matter_pdf(self):
         """Make an inside back cover and a back cover.  If there is an
-        isbn number its barcode will be put on the back cover."""
-        if self.isbn:
-            self.isbn_pdf_file = self.filepath('isbn.pdf')
-            self.maker.make_barcode_pdf(self.isbn, self.isbn_pdf_file)
-            self.notify_watcher('make_barcode_pdf')
-
+        isbn number its barcode will be put on the back cover (see
+        make_barcode_pdf)."""
         end_matter = self.compose_end_matter()
         #log(end_matter)
         save_data(self.tail_html_file, end_matter.decode('utf-8'))
@@ -476,13 +803,25 @@ class Book(object):
                                centre_end=True, even_pages=False)
         self.notify_watcher()
 
+    def make_barcode_pdf(self):
+        """If there is an isbn number, make a page with its barcode for
+        the back cover."""
+        if self.isbn:
+            self.isbn_pdf_file = self.filepath('isbn.pdf')
+            self.maker.make_barcode_pdf(self.isbn, self.isbn_pdf_file)
+            self.notify_watcher('make_barcode_pdf')
+
     def make_book_pdf(self):
         """A convenient wrapper of a few necessary steps"""
         # now the Xvfb server is needed. make sure it has had long enough to get going
         self.wait_for_xvfb()
-        self.make_body_pdf()
-        self.make_preamble_pdf()
-        self.make_end_matter_pdf()
+        #The preamble contents need the body's page numbers, but the
+        #rest can be made at the same time.
+        run_stages([('body', self.make_body_pdf, ()),
+                    ('end_matter', self.make_end_matter_pdf, ()),
+                    ('barcode', self.make_barcode_pdf, ()),
+                    ('preamble', self.make_preamble_pdf, ('body',)),
+                    ], config.PDF_STAGE_WORKERS)
 
         concat_pdfs(self.pdf_file, self.preamble_pdf_file,
                     self.body_pdf_file, self.tail_pdf_file,
@@ -768,10 +1107,14 @@ class Book(object):
 <body dir="%(dir)s"></body>
 </html>""" % params)
         tocmap = filename_toc_map(self.toc)
-        for ID in self.spine:
+        localiser = LinkLocaliser((ID[6:], self.manifest[ID]['url']) for ID in self.spine)
+        #the chapters are parsed in parallel, but joined in order
+        for ID, tree in self.get_trees_by_id(self.spine):
             details = self.manifest[ID]
             try:
-                root = self.get_tree_by_id(ID).getroot()
+                if isinstance(tree, Exception):
+                    raise tree
+                root = tree.getroot()
             except Exception, e:
                 log("hit %s when trying book.get_tree_by_id(%s).getroot()" % (e, ID))
                 continue
@@ -811,8 +1154,19 @@ class Book(object):
                                                   id=fragment)
                         body.insert(0, marker)
                 point['html_id'] = fragment
-            localise_local_links(root, ID[6:])
+                localiser.set_anchor(ID[6:], fragment)
+            localiser.add_chapter(root, ID[6:])
             add_guts(root, doc)
+
+        #now all the IDs are known, links between chapters can be fixed
+        self.unresolved_links = localiser.resolve()
+        for ID in self.spine:
+            for point in tocmap.get(self.manifest[ID]['url'], ()):
+                if 'html_id' in point:
+                    point['html_id'] = localiser.renamed_id(ID[6:], point['html_id'])
+        if self.unresolved_links:
+            log("%d links could not be resolved; see Book.unresolved_links" %
+                len(self.unresolved_links))
         return doc
 
     def fake_no_break_after(self, tags=config.NO_BREAK_AFTER_TAGS):
@@ -849,6 +1203,7 @@ class Book(object):
         # This is perhaps foolishly early -- throwing away useful boundaries.
         self.unpack_static()
         self.tree = self.concat_html()
+        self.index_ids()
         self.save_tempfile('raw.html', etree.tostring(self.tree, method='html'))
         self.headings = [x for x in self.tree.iter('h1')]
         if self.headings:
@@ -900,6 +1255,37 @@ class Book(object):
         self.notify_watcher()
         return doc
 
+    def index_ids(self):
+        """Make a map of ids to elements in self.tree, so elements can be
+        found without searching the whole tree each time.  If an id is
+        used more than once, the first element wins, as with cssselect."""
+        self.id_index = {}
+        for e in self.tree.iter():
+            ID = e.get('id')
+            if ID is not None and ID not in self.id_index:
+                self.id_index[ID] = e
+
+    def get_element_by_id(self, ID):
+        """Return the element in self.tree with the given id, or None."""
+        e = self.id_index.get(ID)
+        if e is not None:
+            #an element removed from the tree keeps its document, so
+            #getroottree() can't tell; follow its parents instead.
+            top = e
+            parent = e.getparent()
+            while parent is not None:
+                top = parent
+                parent = top.getparent()
+            if top is self.tree:
+                return e
+        #not indexed, or removed from the tree since.
+        found = self.tree.xpath('//*[@id=$id]', id=ID)
+        if found:
+            self.id_index[ID] = found[0]
+            return found[0]
+        self.id_index.pop(ID, None)
+        return None
+
     def add_section_titles(self):
         """Add any section heading pages that the TOC.txt file
         specifies.  These are sub-book, super-chapter groupings.
@@ -923,20 +1309,21 @@ class Book(object):
                     item = etree.SubElement(section, 'div', Class="objavi-chapter")
                     if 'html_title' in child:
                         item.text = child['html_title']
-                        heading = self.tree.cssselect('#'+ child['html_id'])
-                        if heading:
-                            _add_initial_number(heading[0], chapter, localiser)
+                        heading = self.get_element_by_id(child['html_id'])
+                        if heading is not None:
+                            _add_initial_number(heading, chapter, localiser)
                     else:
                         item.text = child['title']
                     _add_initial_number(item, chapter, localiser)
                     log(item.text, debug='HTMLGEN')
                     chapter += 1
-                log("#%s is %s" % (t['html_id'], self.tree.cssselect('#'+ t['html_id'])))
-                location = self.tree.cssselect('#'+ t['html_id'])[0]
+                location = self.get_element_by_id(t['html_id'])
+                log("#%s is %s" % (t['html_id'], location))
                 container = location.getparent()
                 if container.tag == 'div' and container[0] is location:
                     location = container
                 location.addprevious(section)
+                self.id_index[ID] = section
 
 
         self.notify_watcher()
@@ -1287,126 +1674,40 @@ class Book(object):
 
 
     def spawn_x(self):
-        """Start an Xvfb instance, using a new server number.  A
-        reference to it is stored in self.xvfb, which is used to kill
-        it when the pdf is done.
-
-        Note that Xvfb doesn't interact well with dbus which is
-        present on modern desktops.
-        """
-        #Find an unused server number (in case two cgis are running at once)
-        while True:
-            servernum = random.randrange(50, 500)
-            if not os.path.exists('/tmp/.X%s-lock' % servernum):
-                break
-
-        self.xserver_no = ':%s' % servernum
-
-        authfile = self.filepath('Xauthority')
-        os.environ['XAUTHORITY'] = authfile
-
-        #mcookie(1) eats into /dev/random, so avoid that
-        from hashlib import md5
-        m = md5("%r %r %r %r %r" % (self, os.environ, os.getpid(), time.time(), os.urandom(32)))
-        mcookie = m.hexdigest()
-
-        check_call(['xauth', 'add', self.xserver_no, '.', mcookie])
-
-        self.xvfb = Popen(['Xvfb', self.xserver_no,
-                           '-screen', '0', '1024x768x24',
-                           '-pixdepths', '32',
-                           #'-blackpixel', '0',
-                           #'-whitepixel', str(2 ** 24 -1),
-                           #'+extension', 'Composite',
-                           '-dpi', '96',
-                           #'-kb',
-                           '-nolisten', 'tcp',
-                           ])
-
-        # We need to wait a bit before the Xvfb is ready.  but the
-        # downloads are so slow that that probably doesn't matter
-
-        self.xvfb_ready_time = time.time() + 2
-
-        os.environ['DISPLAY'] = self.xserver_no
-        log(self.xserver_no)
+        """Lease an Xvfb display from this process's pool (see
+        objavi.xvfb), and point DISPLAY and XAUTHORITY at it.  The
+        display is stored in self.xvfb, and goes back to the pool when
+        the book is cleaned up."""
+        self.xvfb = xvfb.get_pool().lease()
+        os.environ['XAUTHORITY'] = self.xvfb.authfile
+        os.environ['DISPLAY'] = self.xvfb.name
+        log(self.xvfb.name)
 
     def wait_for_xvfb(self):
-        """wait until a previously set time before continuing.  This
-        is so Xvfb has time to properly start."""
-        if hasattr(self, 'xvfb'):
-            d = self.xvfb_ready_time - time.time()
-            if d > 0:
-                time.sleep(d)
-                self.notify_watcher()
+        """Make sure the leased display is still working before it is
+        used, replacing it if it isn't."""
+        if getattr(self, 'xvfb', None) is not None and not self.xvfb.alive():
+            log("Xvfb %s has gone away; getting another" % self.xvfb.name)
+            xvfb.get_pool().release(self.xvfb)
+            self.spawn_x()
+            self.notify_watcher()
 
     def cleanup_x(self):
-        """Try very hard to kill off Xvfb.  In addition to killing
-        this instance's xvfb, occasionally (randomly) search for
-        escaped Xvfb instances and kill those too."""
-        if not hasattr(self, 'xvfb'):
+        """Give the Xvfb display back to the pool."""
+        if getattr(self, 'xvfb', None) is None:
             return
-        check_call(['xauth', 'remove', self.xserver_no])
-        p = self.xvfb
-        log("trying to kill Xvfb %s" % p.pid)
-        try_to_kill(p.pid, 15)
-        for i in range(10):
-            if p.poll() is not None:
-                log("%s died with %s" % (p.pid, p.poll()))
-                break
-            log("%s not dead yet" % p.pid)
-            time.sleep(0.2)
-        else:
-            log("Xvfb would not die! kill -9! kill -9!")
-            try:
-                try_to_kill(p.pid, 9)
-            except OSError, e:
-                log(e)
-
+        xvfb.get_pool().release(self.xvfb)
+        self.xvfb = None
         del os.environ["XAUTHORITY"]
         del os.environ["DISPLAY"]
 
         if random.random() < 0.1:
-            # occasionally kill old xvfbs and soffices, if there are any.
-            self.kill_old_processes()
-
-    def kill_old_processes(self):
-        """Sometimes, despite everything, Xvfb or soffice instances
-        hang around well after they are wanted -- for example if the
-        cgi process dies particularly badly. So kill them if they have
-        been running for a long time."""
-        log("running kill_old_processes")
-        killable_names = ' '.join(['Xvfb', 'soffice', 'soffice.bin', 'ooffice',
-                                   os.path.basename(config.HTML2ODT),
-                                   os.path.basename(config.WKHTMLTOPDF),
-                                   ])
-        p = Popen(['ps', '-C', killable_names,
-                   '-o', 'pid,etime', '--no-headers'], stdout=PIPE)
-        data = p.communicate()[0].strip()
-        if data:
-            lines = data.split('\n')
-            pids = []
-            for line in lines:
-                log('dealing with ps output "%s"' % line)
-                try:
-                    pid, days, hours, minutes, seconds \
-                         = re.match(r'^\s*(\d+)\s+(\d+-)?(\d{2})?:?(\d{2}):(\d+)\s*$', line).groups()
-                except AttributeError:
-                    log("Couldn't parse that line!")
-                # 50 minutes should be enough xvfb time for anyone
-                if days or hours or int(minutes) > 50:
-                    pid = int(pid)
-                    try_to_kill(pid, 15)
-                    pids.append(pid)
-
-            time.sleep(1.0)
-            for pid in pids:
-                #try again in case any are lingerers
-                try_to_kill(pid, 9)
-        self.notify_watcher()
+            # occasionally stop displays left behind by dead workers.
+            xvfb.reap_orphans()
 
     def cleanup(self):
         self.cleanup_x()
+        self.store.close()
         if not config.KEEP_TEMP_FILES:
             for fn in os.listdir(self.workdir):
                 os.remove(os.path.join(self.workdir, fn))
@@ -1418,54 +1719,60 @@ class Book(object):
         self.notify_watcher()
 
 
-def _read_cached_zip(server, book, max_age):
-    #find a recent zip if possible
-    prefix = '%s/%s' % (config.BOOKI_BOOK_DIR, make_book_name(book, server, '').split('-20', 1)[0])
-    from glob import glob
-    zips = sorted(glob(prefix + '*.zip'))
-    if not zips:
-        log("no cached booki-zips matching %s*.zip" % (prefix,))
-        return None
-    zipname = zips[-1]
-    cutoff = time.time() - max_age * 60
-    log(repr(zipname))
-    try:
-        date = time.mktime(time.strptime(zipname, prefix + '-%Y.%m.%d-%H.%M.%S.zip'))
-        if date > cutoff:
-            f = open(zipname)
-            blob = f.read()
-            f.close()
-            return blob, zipname
-        log("%s is too old, must reload" % zipname)
-        return None
-    except (IOError, IndexError, ValueError), e:
-        log('could not make sense of %s: got exception %s' % (zipname, e))
-        return None
-
-
-def fetch_zip(server, book, save=False, max_age=-1, filename=None):
+def fetch_zip(server, book, max_age=-1, filename=None):
+    """Save the booki-zip for the book, returning the name it is
+    saved under.  Saved zips are recorded in a ZipStore index, which
+    is used to find a local copy younger than <max_age> minutes, or to
+    ask the server whether the local copy is still current.  If
+    <filename> is given the zip ends up there, otherwise in
+    config.BOOKI_BOOK_DIR."""
     interface = get_server_defaults(server).get('interface', 'Booki')
     try:
         url = config.ZIP_URLS[interface] % { 'server' : server, 'book' : book }
     except KeyError:
         raise NotImplementedError("Can't handle '%s' interface" % interface)
 
-    if max_age > 0:
+    store = ZipStore()
+    latest = store.latest(server, book)
+    local = None
+
+    if max_age > 0 and latest is not None:
         log('WARNING: trying to use cached booki-zip')
-        blob_and_name = _read_cached_zip(server, book, max_age)
-        if blob_and_name is not None:
-            return blob_and_name
-
-    log('fetching zip from %s'% url)
-    blob = url_fetch(url)
-    if save:
-        if filename is None:
-            filename = '%s/%s' % (config.BOOKI_BOOK_DIR,
-                                  make_book_name(book, server, '.zip'))
-        f = open(filename, 'w')
-        f.write(blob)
-        f.close()
-    return blob, filename
+        if latest['fetched'] > time.time() - max_age * 60:
+            store.touch(latest['path'])
+            local = latest['path']
+        else:
+            log("%s is too old, must reload" % latest['path'])
+
+    if local is None:
+        #url_save_conditional only writes to <target> if the server
+        #sends a new zip (not on 304 Not Modified).
+        target = filename
+        if target is None:
+            target = '%s/%s' % (config.BOOKI_BOOK_DIR,
+                                make_book_name(book, server, '.zip'))
+        log('fetching zip from %s'% url)
+        if (config.USE_CONDITIONAL_ZIP_FETCH and latest is not None and
+            latest['url'] == url and (latest['etag'] or latest['last_modified'])):
+            saved, validators = url_save_conditional(url, target, latest['etag'],
+                                                     latest['last_modified'])
+        else:
+            saved, validators = url_save_conditional(url, target)
+
+        if saved is None:
+            #304: the saved copy is still good.
+            store.refresh(latest['path'])
+            local = latest['path']
+        else:
+            size, digest = saved
+            store.add(server, book, target, size, digest, url, validators)
+            store.evict()
+            return target
+
+    if filename is not None and filename != local:
+        shutil.copyfile(local, filename)
+        return filename
+    return local
 
 
 def split_html(html, compressed_size=None, fix_markup=False):
@@ -0,0 +1,327 @@
+# Part of Objavi2, which turns html manuals into books.
+# This measures how long the stages of a render take.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Stage timing for renders.
+
+Book.notify_watcher() is called as each stage of a render finishes.
+A StageTimer is a watcher that records, for each notification, the
+time since the previous one, the CPU time used by this process and by
+its finished subprocesses (wkhtmltopdf, pdftk and the like) in that
+time, the largest peak RSS of the commands run in it, and the sizes
+of any of the book's files that changed.  When stages run in parallel
+their times overlap, so a stage's time is really the time since the
+last stage of any kind finished.
+
+The timer also collects the RunResult of each command run by
+book_utils.run() until the book is finished, noting its wall and CPU
+time, peak RSS, and whether it timed out.  These are listed with the
+stage that follows them.  A worker process is assumed to render one
+book at a time.
+
+When the book is finished the record is saved as JSON in
+config.METRICS_DIR, and added to totals in an sqlite database, from
+which prometheus_text() makes counters and histograms in the
+Prometheus text format.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import resource
+import threading
+
+from objavi import config
+from objavi.book_utils import log, add_run_watcher, remove_run_watcher
+
+#the book attributes naming files whose sizes are recorded
+ARTIFACTS = ('bookizip_file', 'body_html_file', 'body_pdf_file',
+             'preamble_pdf_file', 'tail_pdf_file', 'isbn_pdf_file',
+             'cover_pdf_file', 'body_odt_file', 'pdf_file', 'publish_file')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stages (
+    stage TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    cpu REAL NOT NULL,
+    child_cpu REAL NOT NULL,
+    bytes INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS buckets (
+    stage TEXT NOT NULL,
+    le REAL NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (stage, le)
+);
+CREATE TABLE IF NOT EXISTS commands (
+    command TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    cpu REAL NOT NULL,
+    failures INTEGER NOT NULL,
+    timeouts INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    outcome TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    seconds REAL NOT NULL
+);
+"""
+
+
+def _clock():
+    #os.times()[4] counts from a fixed point in the past, and isn't
+    #affected by changes to the system clock.
+    return os.times()[4]
+
+
+def _usage():
+    s = resource.getrusage(resource.RUSAGE_SELF)
+    c = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (s.ru_utime + s.ru_stime, c.ru_utime + c.ru_stime)
+
+
+class StageTimer(object):
+    """A Book watcher that times the stages of its render."""
+    #the timer collecting commands.  If a render failed without
+    #finishing, its timer is replaced by the next one.
+    collecting = None
+    collecting_lock = threading.Lock()
+
+    def __init__(self, name):
+        self.name = name
+        self.book = None
+        self.stages = []
+        self.sizes = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.last = (_clock(),) + _usage()
+        self.start = self.last[0]
+        self.failed = False
+        self.commands = []
+        with StageTimer.collecting_lock:
+            if StageTimer.collecting is not None:
+                remove_run_watcher(StageTimer.collecting.command_finished)
+            StageTimer.collecting = self
+            add_run_watcher(self.command_finished)
+
+    def command_finished(self, result):
+        with self.lock:
+            self.commands.append({
+                'command': os.path.basename(result.cmd[0]),
+                'returncode': int(result),
+                'seconds': result.wall,
+                'cpu': result.user_cpu + result.sys_cpu,
+                'max_rss_kb': result.max_rss_kb,
+                'timed_out': result.timed_out,
+                })
+
+    def _artifacts(self):
+        """The files that have appeared or changed since last time."""
+        changed = {}
+        if self.book is None:
+            return changed
+        for attr in ARTIFACTS:
+            path = getattr(self.book, attr, None)
+            if not isinstance(path, basestring):
+                continue
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            if self.sizes.get(path) != size:
+                self.sizes[path] = size
+                changed[attr] = size
+        return changed
+
+    def __call__(self, message):
+        now = (_clock(),) + _usage()
+        if message.startswith('ERROR'):
+            self.failed = True
+            message = 'ERROR'
+        with self.lock:
+            last = self.last
+            self.last = now
+            #RUSAGE_CHILDREN's ru_maxrss is the largest child of the
+            #worker's whole life, so the stage's own commands are used.
+            rss = [c['max_rss_kb'] for c in self.commands]
+            self.stages.append({
+                'stage': message,
+                'at': now[0] - self.start,
+                'seconds': now[0] - last[0],
+                'cpu': now[1] - last[1],
+                'child_cpu': now[2] - last[2],
+                'max_rss_kb': max(rss) if rss else None,
+                'artifacts': self._artifacts(),
+                'commands': self.commands,
+                })
+            self.commands = []
+        if message == config.FINISHED_MESSAGE:
+            with StageTimer.collecting_lock:
+                remove_run_watcher(self.command_finished)
+                if StageTimer.collecting is self:
+                    StageTimer.collecting = None
+            self.save()
+
+    def report(self):
+        return {
+            'name': self.name,
+            'started': self.started,
+            'seconds': self.last[0] - self.start,
+            'failed': self.failed,
+            'stages': self.stages,
+            }
+
+    def save(self):
+        """Write the JSON report and add the stages to the totals.
+        Failures are logged rather than raised, as they shouldn't
+        spoil the book."""
+        if not config.USE_METRICS:
+            return
+        report = self.report()
+        try:
+            if not os.path.exists(config.METRICS_DIR):
+                os.makedirs(config.METRICS_DIR)
+            fn = os.path.join(config.METRICS_DIR, '%s.json' % self.name)
+            f = open(fn, 'w')
+            json.dump(report, f, indent=1)
+            f.close()
+            record(report)
+            expire_reports()
+        except (IOError, OSError, sqlite3.Error), e:
+            log("could not save metrics for %s: %s" % (self.name, e))
+
+
+def expire_reports(max_age=None):
+    """Remove JSON reports older than <max_age> seconds."""
+    if max_age is None:
+        max_age = config.METRICS_REPORT_MAX_AGE
+    cutoff = time.time() - max_age
+    for fn in os.listdir(config.METRICS_DIR):
+        if fn.endswith('.json'):
+            path = os.path.join(config.METRICS_DIR, fn)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError, e:
+                log(e)
+
+
+def _connect():
+    #a connection per operation, as in zipstore
+    d = os.path.dirname(config.METRICS_DB)
+    if not os.path.exists(d):
+        os.makedirs(d)
+    db = sqlite3.connect(config.METRICS_DB, timeout=30)
+    db.executescript(SCHEMA)
+    return db
+
+
+def record(report):
+    """Add a finished job's report to the totals."""
+    db = _connect()
+    try:
+        with db:
+            outcome = 'failed' if report['failed'] else 'finished'
+            db.execute('INSERT OR IGNORE INTO jobs VALUES (?, 0, 0)', (outcome,))
+            db.execute('UPDATE jobs SET count = count + 1, seconds = seconds + ? '
+                       'WHERE outcome = ?', (report['seconds'], outcome))
+            for s in report['stages']:
+                stage = s['stage']
+                db.execute('INSERT OR IGNORE INTO stages VALUES (?, 0, 0, 0, 0, 0)', (stage,))
+                db.execute('UPDATE stages SET count = count + 1, seconds = seconds + ?, '
+                           'cpu = cpu + ?, child_cpu = child_cpu + ?, bytes = bytes + ? '
+                           'WHERE stage = ?',
+                           (s['seconds'], s['cpu'], s['child_cpu'],
+                            sum(s['artifacts'].values()), stage))
+                for le in config.METRICS_BUCKETS:
+                    if s['seconds'] <= le:
+                        db.execute('INSERT OR IGNORE INTO buckets VALUES (?, ?, 0)', (stage, le))
+                        db.execute('UPDATE buckets SET count = count + 1 '
+                                   'WHERE stage = ? AND le = ?', (stage, le))
+                for c in s.get('commands', ()):
+                    db.execute('INSERT OR IGNORE INTO commands VALUES (?, 0, 0, 0, 0, 0)',
+                               (c['command'],))
+                    db.execute('UPDATE commands SET count = count + 1, seconds = seconds + ?, '
+                               'cpu = cpu + ?, failures = failures + ?, timeouts = timeouts + ? '
+                               'WHERE command = ?',
+                               (c['seconds'], c['cpu'], int(c['returncode'] != 0),
+                                int(c['timed_out']), c['command']))
+    finally:
+        db.close()
+
+
+def _label(s):
+    return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text():
+    """The totals, in the Prometheus text exposition format."""
+    db = _connect()
+    try:
+        stages = db.execute('SELECT stage, count, seconds, cpu, child_cpu, bytes '
+                            'FROM stages ORDER BY stage').fetchall()
+        buckets = {}
+        for stage, le, count in db.execute('SELECT stage, le, count FROM buckets'):
+            buckets[(stage, le)] = count
+        jobs = db.execute('SELECT outcome, count, seconds FROM jobs ORDER BY outcome').fetchall()
+        commands = db.execute('SELECT command, count, seconds, cpu, failures, timeouts '
+                              'FROM commands ORDER BY command').fetchall()
+    finally:
+        db.close()
+
+    lines = ['# HELP objavi_jobs_total Books rendered, by outcome.',
+             '# TYPE objavi_jobs_total counter']
+    for outcome, count, seconds in jobs:
+        lines.append('objavi_jobs_total{outcome="%s"} %d' % (outcome, count))
+    lines += ['# HELP objavi_job_seconds_total Time spent rendering books.',
+              '# TYPE objavi_job_seconds_total counter']
+    for outcome, count, seconds in jobs:
+        lines.append('objavi_job_seconds_total{outcome="%s"} %f' % (outcome, seconds))
+
+    lines += ['# HELP objavi_stage_seconds Time taken by each stage of a render.',
+              '# TYPE objavi_stage_seconds histogram']
+    for stage, count, seconds, cpu, child_cpu, size in stages:
+        label = _label(stage)
+        for le in config.METRICS_BUCKETS:
+            lines.append('objavi_stage_seconds_bucket{stage="%s",le="%s"} %d' %
+                         (label, le, buckets.get((stage, le), 0)))
+        lines.append('objavi_stage_seconds_bucket{stage="%s",le="+Inf"} %d' % (label, count))
+        lines.append('objavi_stage_seconds_sum{stage="%s"} %f' % (label, seconds))
+        lines.append('objavi_stage_seconds_count{stage="%s"} %d' % (label, count))
+
+    for name, column, help in (
+        ('objavi_stage_cpu_seconds_total', 3, 'CPU time used by the worker in each stage.'),
+        ('objavi_stage_child_cpu_seconds_total', 4, 'CPU time used by subprocesses in each stage.'),
+        ('objavi_stage_artifact_bytes_total', 5, 'Size of the files made in each stage.'),
+        ):
+        lines += ['# HELP %s %s' % (name, help), '# TYPE %s counter' % name]
+        for row in stages:
+            lines.append('%s{stage="%s"} %s' % (name, _label(row[0]), row[column]))
+
+    for name, column, help in (
+        ('objavi_command_runs_total', 1, 'External commands run.'),
+        ('objavi_command_seconds_total', 2, 'Time taken by external commands.'),
+        ('objavi_command_cpu_seconds_total', 3, 'CPU time used by external commands.'),
+        ('objavi_command_failures_total', 4, 'External commands that returned non-zero.'),
+        ('objavi_command_timeouts_total', 5, 'External commands killed for taking too long.'),
+        ):
+        lines += ['# HELP %s %s' % (name, help), '# TYPE %s counter' % name]
+        for row in commands:
+            lines.append('%s{command="%s"} %s' % (name, _label(row[0]), row[column]))
+    return '\n'.join(lines) + '\n'
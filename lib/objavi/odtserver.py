@@ -0,0 +1,84 @@
+# Part of Objavi2, which turns html manuals into books.
+# This talks to a resident html2odt conversion server.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Client for `html2odt --server`.
+
+Starting an office takes several seconds, so rather than running
+html2odt for each book, a server (see doc/deployment/
+example-supervisor.conf) keeps some offices running and converts files
+sent to it over a unix socket.  Each request is a line of JSON naming
+the working directory, source, and destination; the reply is a line
+of JSON with an 'ok' key, and an 'error' key if it failed.
+
+The server is asked to write to a temporary file, which is renamed
+into place when it reports success.  If the client gives up waiting,
+an office that is still busy with the file can't overwrite whatever
+the caller puts at the destination instead.
+"""
+
+import os
+import socket
+import tempfile
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from objavi import config
+from objavi.book_utils import log
+
+
+def convert(workdir, src, dest, path=None, timeout=None):
+    """Have the server convert html <src> to odt <dest>.  Return True
+    if it worked, or False if there is no server or it failed, in which
+    case the caller can run html2odt itself."""
+    if path is None:
+        path = config.HTML2ODT_SOCKET
+    if timeout is None:
+        timeout = config.HTML2ODT_TIMEOUT
+    if not path or not os.path.exists(path):
+        return False
+    dest = os.path.join(workdir, dest)
+    fd, tmp = tempfile.mkstemp(suffix='.odt', prefix='html2odt-',
+                               dir=os.path.dirname(dest))
+    os.close(fd)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        try:
+            s.connect(path)
+            s.sendall(json.dumps({'workdir': workdir,
+                                  'src': src,
+                                  'dest': tmp}) + '\n')
+            reply = json.loads(s.makefile('r').readline())
+        except (socket.error, ValueError), e:
+            log("html2odt server at %s is not working: %s" % (path, e))
+            reply = {'ok': False}
+        else:
+            if not reply.get('ok'):
+                log("html2odt server failed to convert %s: %s" % (src, reply.get('error')))
+    finally:
+        s.close()
+    if not reply.get('ok'):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
+    os.rename(tmp, dest)
+    return True
@@ -21,17 +21,61 @@
 
 import os, sys
 import re
+import shutil
+import tempfile
 from subprocess import Popen, PIPE
 import urllib
 
 import bookland
 
 from objavi import config
-from objavi.book_utils import log, run
+from objavi.book_utils import log, run, ObjaviError
 from objavi.cgi_utils import path2url
+from objavi import pdf_utils
+from objavi.pdf_utils import PdfReader
 from constants import POINT_2_MM
 
 
+READY_SCRIPT = ('<script type="text/javascript">'
+                'window.addEventListener("load", function(){'
+                'setTimeout(function(){window.status = "%s";}, 0);'
+                '}, false);</script>')
+
+def add_ready_script(text):
+    """Insert a script that sets window.status to
+    config.WKHTMLTOPDF_READY_STATUS once the page has loaded."""
+    script = READY_SCRIPT % config.WKHTMLTOPDF_READY_STATUS
+    i = text.lower().rfind('</body>')
+    if i == -1:
+        return text + script
+    return text[:i] + script + text[i:]
+
+def javascript_wait(html):
+    """Decide how wkhtmltopdf should wait for the javascript in the
+    html file, returning a tuple of the file to use and the arguments
+    to add to the command.  If there are no scripts there is no need
+    to wait.  Otherwise, if possible, a copy of the file is made with
+    a script that signals through window.status when the page has
+    loaded (see config.WKHTMLTOPDF_USE_WINDOW_STATUS)."""
+    f = open(html)
+    text = f.read()
+    f.close()
+    if not re.search(r'<script\b', text, re.IGNORECASE):
+        return html, ['--javascript-delay', '0']
+
+    if not config.WKHTMLTOPDF_USE_WINDOW_STATUS:
+        return html, ['--javascript-delay', str(config.WKHTMLTOPDF_SCRIPT_DELAY)]
+
+    status = config.WKHTMLTOPDF_READY_STATUS
+    text = add_ready_script(text)
+    base, ext = os.path.splitext(html)
+    html = base + '-ready' + ext
+    f = open(html, 'w')
+    f.write(text)
+    f.close()
+    return html, ['--window-status', status, '--javascript-delay', '0']
+
+
 class PageSettings(object):
     """Calculates and wraps commands for the generation and processing
     of PDFs"""
@@ -91,6 +135,10 @@ class PageSettings(object):
                 f.close()
 
                 #XXX can manipulate footer here, for CSS etc
+                if config.WKHTMLTOPDF_USE_WINDOW_STATUS:
+                    #the boilerplate has scripts, so wkhtmltopdf
+                    #waits for the status.
+                    template_text = add_ready_script(template_text)
 
                 out_path = os.path.join(self.workdir, os.path.basename(templ_path))
                 f = open(out_path, 'w')
@@ -104,8 +152,11 @@ class PageSettings(object):
         return html
 
 
-    def _webkit_command(self, html_url, pdf, outline=False, outline_file=None, page_num=None):
+    def _webkit_command(self, html_url, pdf, outline=False, outline_file=None, page_num=None,
+                        wait_args=None, page_offset=0, background=True):
         m = [str(x) for x in self.margins]
+        if wait_args is None:
+            wait_args = ['--javascript-delay', str(config.WKHTMLTOPDF_SCRIPT_DELAY)]
         outline_args = ['--outline',  '--outline-depth', '2'] * outline
         if outline_file is not None:
             outline_args += ['--dump-outline', outline_file]
@@ -117,8 +168,11 @@ class PageSettings(object):
                 page_num_args += ['--footer-html', footer_url]
             if header_url is not None:
                 page_num_args += ['--header-html', header_url]
+            if page_offset:
+                page_num_args += ['--page-offset', str(page_offset)]
 
         greyscale_args = ['-g'] * self.grey_scale
+        background_args = ['--no-background'] * (not background)
         quiet_args = ['-q']
         cmd = ([config.WKHTMLTOPDF] +
                quiet_args +
@@ -129,11 +183,12 @@ class PageSettings(object):
                 '-d', '100',
                 #'--zoom', '1.2',
                 '--encoding', 'UTF-8',
-                '--javascript-delay', '2000',
                 ] +
+               wait_args +
                page_num_args +
                outline_args +
                greyscale_args +
+               background_args +
                config.WKHTMLTOPDF_EXTRA_COMMANDS +
                [html_url, pdf])
         log(' '.join(cmd))
@@ -142,9 +197,11 @@ class PageSettings(object):
 
     def make_raw_pdf(self, html, pdf, outline=False, outline_file=None, page_num=None):
         if self.columns == 1:
+            html, wait_args = javascript_wait(html)
             html_url = path2url(html)
             func = getattr(self, '_%s_command' % self.engine)
-            cmd = func(html_url, pdf, outline=outline, outline_file=outline_file, page_num=page_num)
+            cmd = func(html_url, pdf, outline=outline, outline_file=outline_file, page_num=page_num,
+                       wait_args=wait_args)
             run(cmd)
         else:
             #For multiple columns, generate a narrower single column pdf, and
@@ -172,38 +229,69 @@ class PageSettings(object):
             columnmaker.make_raw_pdf(html, column_pdf, outline=outline,
                                      outline_file=outline_file, page_num=None)
             columnmaker.reshape_pdf(column_pdf)
+            self.impose_columns(column_pdf, pdf)
+
+    def make_page_number_pdf(self, pdf, n_pages, page_num, page_offset=0):
+        """Make a PDF of <n_pages> empty pages with just the page number
+        footers (and headers), numbered from <page_offset> + 1.  This
+        can be drawn over pages that were made without numbers, using
+        overlay_pdf."""
+        html = pdf[:-4] + '.html'
+        pages = ['<div>&#160;</div>']
+        pages += ['<div style="page-break-before: always">&#160;</div>'] * (n_pages - 1)
+        f = open(html, 'w')
+        f.write('<html><body>%s</body></html>' % '\n'.join(pages))
+        f.close()
+        #no scripts, so no fixed delay before printing
+        html, wait_args = javascript_wait(html)
+        func = getattr(self, '_%s_command' % self.engine)
+        cmd = func(path2url(html), pdf, page_num=page_num, page_offset=page_offset,
+                   wait_args=wait_args, background=False)
+        run(cmd)
+        made = count_pdf_pages(pdf)
+        if made != n_pages:
+            raise ObjaviError("wanted %s numbered pages, got %s" % (n_pages, made))
+
+    def impose_columns(self, column_pdf, pdf):
+        """Put the pages of <column_pdf> side by side, self.columns at
+        a time, making <pdf> with an even number of pages."""
+        if config.USE_NATIVE_PDF:
+            try:
+                pdf_utils.nup(column_pdf, pdf, int(self.columns),
+                              self.width, self.height)
+                return
+            except Exception, e:
+                log("could not make columns natively (%s); trying pdfnup" % e)
+
+        # pdfnup seems to round down to an even number of output
+        # pages.  For example, if a book fills 13 pages, it will
+        # clip it to 12.  So it is necessary to add blank pages to
+        # round it up to an even number of output pages, which is
+        # to say a multiple of (self.columns * 2) input pages.
+
+        column_pages = count_pdf_pages(column_pdf)
+        overflow_pages = column_pages % (self.columns * 2)
+        if overflow_pages:
+            extra_pages = self.columns * 2 - overflow_pages
+        else:
+            extra_pages = 0
+
+        cmd = [config.PDFNUP,
+               '--nup', '%sx1' % int(self.columns),
+               #'--paper', papersize.lower() + 'paper',
+               '--outfile', pdf,
+               '--noautoscale', 'true',
+               '--orient', 'portrait',
+               '--paperwidth', '%smm' % int(self.width * POINT_2_MM),
+               '--paperheight', '%smm' % int(self.height * POINT_2_MM),
+               #'--tidy', 'false',
+               '--pages', '1-last%s' % (',{}' * extra_pages,),
+               #'--columnstrict', 'true',
+               #'--column', 'true',
+               column_pdf
+               ]
 
-            # pdfnup seems to round down to an even number of output
-            # pages.  For example, if a book fills 13 pages, it will
-            # clip it to 12.  So it is necessary to add blank pages to
-            # round it up to an even number of output pages, which is
-            # to say a multiple of (self.columns * 2) input pages.
-
-            column_pages = count_pdf_pages(column_pdf)
-            overflow_pages = column_pages % (self.columns * 2)
-            if overflow_pages:
-                extra_pages = self.columns * 2 - overflow_pages
-            else:
-                extra_pages = 0
-
-            cmd = [config.PDFNUP,
-                   '--nup', '%sx1' % int(self.columns),
-                   #'--paper', papersize.lower() + 'paper',
-                   '--outfile', pdf,
-                   '--noautoscale', 'true',
-                   '--orient', 'portrait',
-                   '--paperwidth', '%smm' % int(self.width * POINT_2_MM),
-                   '--paperheight', '%smm' % int(self.height * POINT_2_MM),
-                   #'--tidy', 'false',
-                   '--pages', '1-last%s' % (',{}' * extra_pages,),
-                   #'--columnstrict', 'true',
-                   #'--column', 'true',
-                   column_pdf
-                   ]
-
-            run(cmd)
-
-
+        run(cmd)
 
     def reshape_pdf(self, pdf, dir=config.DEFAULT_DIR, centre_start=False,
                     centre_end=False, even_pages=True):
@@ -220,6 +308,21 @@ class PageSettings(object):
         if not ops:
             return
 
+        if config.USE_NATIVE_PDF:
+            #like pdfedit, only resize the pages when shifting them
+            size = (None, None)
+            if 'shift' in ops:
+                size = (self.width, self.height)
+            try:
+                pdf_utils.reshape(pdf, pdf, offset=gutter,
+                                  width=size[0], height=size[1],
+                                  centre_start=centre_start,
+                                  centre_end=centre_end,
+                                  even_pages=even_pages)
+                return
+            except Exception, e:
+                log("could not reshape %s natively (%s); trying pdfedit" % (pdf, e))
+
         os.putenv("OBJAVI_SCRIPT_DIR", config.SCRIPT_DIR)
 
         cmd = ['pdfedit', '-s', '%s/wk_objavi.qs' % config.SCRIPT_DIR,
@@ -249,6 +352,13 @@ class PageSettings(object):
             raise bookland.ProductCodeError("what kind of product code is this?")
 
         position = (corner, float(self.width), float(self.height), float(self.side_margin), float(self.bottom_margin))
+        if config.USE_NATIVE_PDF:
+            try:
+                self._native_barcode_pdf(b, str(product_code), position, pdf)
+                return
+            except Exception, e:
+                log("could not make barcode natively (%s); trying ps2pdf" % e)
+
         epslines = b.eps(position=position)
 
         cmd2 = ['ps2pdf',
@@ -261,6 +371,33 @@ class PageSettings(object):
         out, err = p2.communicate(epslines)
 
 
+    def _native_barcode_pdf(self, b, code, position, pdf):
+        #the page depends only on the code and where it goes, so
+        #every render of the same book can share it.
+        cached = os.path.join(config.BARCODE_CACHE_DIR, '%s-%s.pdf' %
+                              (re.sub(r'\W', '', code),
+                               '-'.join(str(x) for x in position)))
+        if not os.path.exists(cached):
+            if not os.path.exists(config.BARCODE_CACHE_DIR):
+                os.makedirs(config.BARCODE_CACHE_DIR)
+            #stages run in threads, so the temporary name must be
+            #unique within the process too.
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=config.BARCODE_CACHE_DIR)
+            try:
+                f = os.fdopen(fd, 'wb')
+                try:
+                    f.write(b.pdf(title=code, position=position))
+                finally:
+                    f.close()
+                os.chmod(tmp, 0644)
+                os.rename(tmp, cached)
+            except:
+                os.remove(tmp)
+                raise
+        else:
+            log("using cached barcode %s" % cached)
+        shutil.copyfile(cached, pdf)
+
     def calculate_cover_size(self, api_key, booksize, page_count):
         import lulu
         return lulu.calculate_cover_size(api_key, booksize, page_count)
@@ -282,7 +419,11 @@ class PageSettings(object):
 
 def count_pdf_pages(pdf):
     """How many pages in the PDF?"""
-    #XXX could also use python-pypdf or python-poppler
+    if config.USE_NATIVE_PDF:
+        try:
+            return PdfReader(pdf).page_count
+        except Exception, e:
+            log("could not count pages in %s (%s); trying pdfinfo" % (pdf, e))
     cmd = ('pdfinfo', pdf)
     p = Popen(cmd, stdout=PIPE, stderr=PIPE)
     out, err = p.communicate()
@@ -290,24 +431,56 @@ def count_pdf_pages(pdf):
     return int(m.group(1))
 
 
+def _concat_native(destination, pdfs, rotate=0):
+    """Try joining the PDFs with objavi.pdf_utils, returning True if
+    it worked."""
+    if config.USE_NATIVE_PDF:
+        try:
+            pdf_utils.concat(destination, pdfs, rotate=rotate,
+                             uri_dest_prefix=config.BODY_CHUNK_LINK_PREFIX)
+            return True
+        except Exception, e:
+            log("could not join %s natively (%s)" % (pdfs, e))
+    return False
+
 def concat_pdfs(destination, *pdfs):
     """Join all the named pdfs together into one and save it as <name>"""
+    pdfs = [x for x in pdfs if x is not None]
+    if _concat_native(destination, pdfs):
+        return
     cmd = ['pdftk']
-    cmd.extend(x for x in pdfs if x is not None)
+    cmd.extend(pdfs)
     cmd += ['cat', 'output', destination]
     run(cmd)
 
 def concat_pdfs_gs(destination, *pdfs):
     """Concatenate all the named PDFs."""
+    pdfs = [x for x in pdfs if x is not None]
+    if _concat_native(destination, pdfs):
+        return
     cmd  = ['gs']
     cmd += ['-dBATCH', '-dNOPAUSE', '-sDEVICE=pdfwrite']
     cmd += ['-sOutputFile=%s' % destination, '-f']
-    cmd.extend(x for x in pdfs if x is not None)
+    cmd.extend(pdfs)
     run(cmd)
 
 
+def overlay_pdf(pdf, over_pdf):
+    """Draw the pages of <over_pdf> on top of the pages of <pdf>."""
+    if config.USE_NATIVE_PDF:
+        try:
+            pdf_utils.overlay(pdf, over_pdf, pdf)
+            return
+        except Exception, e:
+            log("could not overlay %s natively (%s); trying pdftk" % (pdf, e))
+    tmp = pdf + '.stamped.pdf'
+    run(['pdftk', pdf, 'multistamp', over_pdf, 'output', tmp])
+    os.rename(tmp, pdf)
+
 def rotate_pdf(pdfin, pdfout):
     """Turn the PDF on its head"""
+    if _concat_native(pdfout, [pdfin], rotate=180):
+        return
     cmd = ['pdftk', pdfin,
            'cat',
            '1-endD',
@@ -380,6 +553,11 @@ def parse_outline(pdf, level_threshold, debug_filename=None):
     BookmarkLevel: 1
     BookmarkPageNumber: 3
     """
+    if config.USE_NATIVE_PDF:
+        try:
+            return _parse_outline_native(pdf, level_threshold, debug_filename)
+        except Exception, e:
+            log("could not read the outline of %s (%s); trying pdftk" % (pdf, e))
     cmd = ('pdftk', pdf, 'dump_data')
     p = Popen(cmd, stdout=PIPE, stderr=PIPE)
     outline, err = p.communicate()
@@ -426,6 +604,43 @@ def parse_outline(pdf, level_threshold, debug_filename=None):
 
     return contents, page_count
 
+def _parse_outline_native(pdf, level_threshold, debug_filename=None):
+    """Like parse_outline, but without pdftk.  The titles are UTF-8
+    encoded strings, as pdftk gives them."""
+    reader = PdfReader(pdf)
+    page_count = reader.page_count
+    outline = reader.outline(max_depth=level_threshold)
+    contents = []
+    dump = ['NumberOfPages: %s' % page_count]
+    for title, level, pagenum in outline:
+        title = title.encode('utf-8').strip(config.WHITESPACE_AND_NULL)
+        dump.append('BookmarkTitle: %s\nBookmarkLevel: %s\nBookmarkPageNumber: %s'
+                    % (title, level, pagenum))
+        if pagenum is not None:
+            contents.append((title, level, pagenum))
+    if debug_filename is not None:
+        try:
+            f = open(debug_filename, 'w')
+            f.write('\n'.join(dump) + '\n')
+            f.close()
+        except IOError:
+            log("could not write to %s!" % debug_filename)
+    return contents, page_count
+
+def find_anchor_pages(pdf, names):
+    """Return a dictionary mapping those of the <names> that are named
+    destinations in the PDF to their page numbers."""
+    reader = PdfReader(pdf)
+    named = reader.named_destinations()
+    page_numbers = dict((ref.num, i + 1) for i, ref in enumerate(reader.page_refs()))
+    pages = {}
+    for name in names:
+        if name in named:
+            page = reader.dest_page(named[name], page_numbers, named)
+            if page is not None:
+                pages[name] = page
+    return pages
+
 def embed_all_fonts(pdf_file):
     tmp_file = pdf_file + '.pre-embed.pdf'
     os.rename(pdf_file, tmp_file)
@@ -450,6 +665,12 @@ def embed_all_fonts(pdf_file):
     run(cmd)
 
 def resize_pdf(pdf, width, height):
+    if config.USE_NATIVE_PDF:
+        try:
+            pdf_utils.reshape(pdf, pdf, width=width, height=height)
+            return
+        except Exception, e:
+            log("could not resize %s natively (%s); trying pdfedit" % (pdf, e))
     ops = ["resize"]
 
     cmd = ["pdfedit",
@@ -0,0 +1,1275 @@
+# Part of Objavi2, which turns html manuals into books.
+# This reads and rearranges PDF files without external tools.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""A small PDF object reader and writer.
+
+This knows enough about PDF syntax to find objects through the cross
+reference tables (including compressed cross reference and object
+streams), follow the page tree, and read the outline and named
+destinations.  PdfBuilder copies pages between documents object by
+object, renumbering as they go, which is used to join, rotate, resize
+and shift PDFs, and to put pages side by side as columns.  Page
+content is never interpreted.  Encrypted files are not supported;
+anything it can't handle raises PdfError, and the callers in
+objavi.pdf fall back to the external tools.
+
+PDF objects are represented as Python objects:
+
+  name          Name (a str subclass, without the '/')
+  string        String (a str subclass of the raw bytes)
+  number        int or float
+  boolean       True or False
+  null          None
+  array         list
+  dictionary    dict, with Name keys
+  stream        Stream (a dict subclass with a .data attribute)
+  reference     Ref
+"""
+
+import os
+import re
+import zlib
+
+from objavi.book_utils import log
+
+
+class PdfError(Exception):
+    pass
+
+
+class Name(str):
+    """A PDF name, like /Type (stored without the slash)."""
+    pass
+
+
+class String(str):
+    """A PDF string.  The bytes are stored as is; see text()."""
+    pass
+
+
+class Keyword(str):
+    """A bare word that isn't a name, number or boolean (e.g. 'obj')."""
+    pass
+
+
+class Ref(object):
+    """An indirect reference (e.g. '12 0 R')."""
+    __slots__ = ('num', 'gen')
+    def __init__(self, num, gen=0):
+        self.num = num
+        self.gen = gen
+
+    def __eq__(self, other):
+        return (isinstance(other, Ref) and
+                self.num == other.num and self.gen == other.gen)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.num, self.gen))
+
+    def __repr__(self):
+        return 'Ref(%s, %s)' % (self.num, self.gen)
+
+
+class Stream(dict):
+    """A stream's dictionary, with the raw (still encoded) bytes in
+    .data."""
+    def __init__(self, d, data):
+        dict.__init__(self, d)
+        self.data = data
+
+    def decoded(self):
+        """The stream data with its filters undone."""
+        filters = self.get('Filter', [])
+        params = self.get('DecodeParms', [])
+        if not isinstance(filters, list):
+            filters = [filters]
+        if not isinstance(params, list):
+            params = [params]
+        data = self.data
+        for i, f in enumerate(filters):
+            p = params[i] if i < len(params) else None
+            data = _decode(f, data, p or {})
+        return data
+
+
+WS = '\x00\t\n\x0c\r '
+INHERITABLE = ('Resources', 'MediaBox', 'CropBox', 'Rotate')
+_ws_re = re.compile(r'(?:[\x00\t\n\x0c\r ]+|%[^\r\n]*)*')
+_regular_re = re.compile(r'[^\x00\t\n\x0c\r ()<>\[\]{}/%]*')
+_ref_re = re.compile(r'(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+R'
+                     r'(?=[\x00\t\n\x0c\r ()<>\[\]{}/%]|\Z)')
+_int_re = re.compile(r'^[+-]?\d+$')
+_real_re = re.compile(r'^[+-]?(?:\d+\.\d*|\.\d+)$')
+_stream_re = re.compile(r'[\x00\t\n\x0c\r ]*stream(?:\r\n|\n|\r)')
+_endstream_re = re.compile(r'(?:\r\n|\n|\r)?endstream')
+_string_special_re = re.compile(r'[()\\]')
+_obj_header_re = re.compile(r'(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+obj'
+                            r'(?=[\x00\t\n\x0c\r ()<>\[\]{}/%])')
+_obj_scan_re = re.compile(r'(?<![0-9])(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+obj'
+                          r'(?=[\x00\t\n\x0c\r ()<>\[\]{}/%])')
+_xref_entry_re = re.compile(r'[\x00\t\n\x0c\r ]*(\d{1,10})[ ]+(\d{1,5})[ ]+([nf])')
+_xref_section_re = re.compile(r'[\x00\t\n\x0c\r ]*(\d+)[ ]+(\d+)')
+
+_ESCAPES = {'n': '\n', 'r': '\r', 't': '\t', 'b': '\b', 'f': '\f',
+            '(': '(', ')': ')', '\\': '\\'}
+
+
+def _unescape_name(s):
+    if '#' not in s:
+        return s
+    return re.sub(r'#([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)), s)
+
+
+def _parse_literal_string(data, pos):
+    """Parse the string starting after the '(' at <pos>."""
+    out = []
+    depth = 1
+    while True:
+        m = _string_special_re.search(data, pos)
+        if m is None:
+            raise PdfError("unterminated string")
+        out.append(data[pos:m.start()])
+        c = m.group()
+        pos = m.end()
+        if c == '(':
+            depth += 1
+            out.append(c)
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                return String(''.join(out)), pos
+            out.append(c)
+        else:
+            e = data[pos:pos + 1]
+            if e in _ESCAPES:
+                out.append(_ESCAPES[e])
+                pos += 1
+            elif e in '01234567' and e:
+                m = re.compile(r'[0-7]{1,3}').match(data, pos)
+                out.append(chr(int(m.group(), 8) & 0xff))
+                pos = m.end()
+            elif e == '\r':
+                #line continuation
+                pos += 1
+                if data[pos:pos + 1] == '\n':
+                    pos += 1
+            elif e == '\n':
+                pos += 1
+            else:
+                #unknown escape: the backslash is ignored
+                pass
+
+
+def _parse_hex_string(data, pos):
+    """Parse the string starting after the '<' at <pos>."""
+    end = data.find('>', pos)
+    if end == -1:
+        raise PdfError("unterminated hex string")
+    h = re.sub(r'[\x00\t\n\x0c\r ]', '', data[pos:end])
+    if len(h) % 2:
+        h += '0'
+    try:
+        return String(h.decode('hex')), end + 1
+    except TypeError:
+        raise PdfError("bad hex string %r" % h[:20])
+
+
+class Parser(object):
+    """Parses PDF objects from a string.  <resolve> is used to find
+    the /Length of streams when it is an indirect object."""
+    def __init__(self, data, resolve=None):
+        self.data = data
+        self.resolve = resolve
+
+    def parse(self, pos):
+        """Return the object starting at (or after whitespace at)
+        <pos>, and the position after it."""
+        data = self.data
+        pos = _ws_re.match(data, pos).end()
+        c = data[pos:pos + 1]
+        if c == '/':
+            m = _regular_re.match(data, pos + 1)
+            return Name(_unescape_name(m.group())), m.end()
+        if c == '<':
+            if data[pos + 1:pos + 2] == '<':
+                return self._parse_dict(pos + 2)
+            return _parse_hex_string(data, pos + 1)
+        if c == '(':
+            return _parse_literal_string(data, pos + 1)
+        if c == '[':
+            return self._parse_array(pos + 1)
+        if c == '':
+            raise PdfError("unexpected end of data")
+        if c in '0123456789':
+            m = _ref_re.match(data, pos)
+            if m:
+                return Ref(int(m.group(1)), int(m.group(2))), m.end()
+        m = _regular_re.match(data, pos)
+        token = m.group()
+        if not token:
+            raise PdfError("unexpected %r at %s" % (c, pos))
+        pos = m.end()
+        if _int_re.match(token):
+            return int(token), pos
+        if _real_re.match(token):
+            return float(token), pos
+        if token == 'true':
+            return True, pos
+        if token == 'false':
+            return False, pos
+        if token == 'null':
+            return None, pos
+        return Keyword(token), pos
+
+    def _parse_array(self, pos):
+        data = self.data
+        a = []
+        while True:
+            pos = _ws_re.match(data, pos).end()
+            if data[pos:pos + 1] == ']':
+                return a, pos + 1
+            obj, pos = self.parse(pos)
+            a.append(obj)
+
+    def _parse_dict(self, pos):
+        data = self.data
+        d = {}
+        while True:
+            pos = _ws_re.match(data, pos).end()
+            if data[pos:pos + 2] == '>>':
+                pos += 2
+                break
+            k, pos = self.parse(pos)
+            if not isinstance(k, Name):
+                raise PdfError("dictionary key %r is not a name" % (k,))
+            v, pos = self.parse(pos)
+            d[k] = v
+        m = _stream_re.match(data, pos)
+        if m is None:
+            return d, pos
+        return self._parse_stream(d, m.end())
+
+    def _parse_stream(self, d, start):
+        data = self.data
+        length = d.get('Length')
+        if isinstance(length, Ref) and self.resolve is not None:
+            try:
+                length = self.resolve(length)
+            except PdfError:
+                length = None
+        if isinstance(length, (int, long)) and length >= 0:
+            end = start + length
+            m = _endstream_re.match(data, _ws_re.match(data, end).end())
+            if m is None:
+                m = _endstream_re.match(data, end)
+            if m is not None:
+                return Stream(d, data[start:end]), m.end()
+        #the length is wrong or missing, so look for the end.
+        end = data.find('endstream', start)
+        if end == -1:
+            raise PdfError("unterminated stream")
+        stop = end
+        if data[stop - 2:stop] == '\r\n':
+            stop -= 2
+        elif data[stop - 1:stop] in ('\r', '\n'):
+            stop -= 1
+        return Stream(d, data[start:stop]), end + len('endstream')
+
+
+def _png_unpredict(data, columns, bpp=1):
+    """Undo PNG prediction (as used in xref streams)."""
+    rowlen = columns * bpp
+    out = []
+    prev = [0] * rowlen
+    i = 0
+    while i < len(data):
+        ftype = ord(data[i])
+        row = [ord(c) for c in data[i + 1:i + 1 + rowlen]]
+        row += [0] * (rowlen - len(row))
+        i += rowlen + 1
+        if ftype == 1:
+            for j in range(bpp, rowlen):
+                row[j] = (row[j] + row[j - bpp]) & 0xff
+        elif ftype == 2:
+            for j in range(rowlen):
+                row[j] = (row[j] + prev[j]) & 0xff
+        elif ftype == 3:
+            for j in range(rowlen):
+                left = row[j - bpp] if j >= bpp else 0
+                row[j] = (row[j] + ((left + prev[j]) >> 1)) & 0xff
+        elif ftype == 4:
+            for j in range(rowlen):
+                a = row[j - bpp] if j >= bpp else 0
+                b = prev[j]
+                c = prev[j - bpp] if j >= bpp else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                if pa <= pb and pa <= pc:
+                    pred = a
+                elif pb <= pc:
+                    pred = b
+                else:
+                    pred = c
+                row[j] = (row[j] + pred) & 0xff
+        out.append(''.join(chr(x) for x in row))
+        prev = row
+    return ''.join(out)
+
+
+def _decode(f, data, params):
+    if f in ('FlateDecode', 'Fl'):
+        try:
+            data = zlib.decompress(data)
+        except zlib.error:
+            #some writers leave junk at the end
+            data = zlib.decompressobj().decompress(data)
+        predictor = params.get('Predictor', 1)
+        if predictor >= 10:
+            colors = params.get('Colors', 1)
+            bits = params.get('BitsPerComponent', 8)
+            columns = params.get('Columns', 1)
+            bpp = max(1, colors * bits // 8)
+            data = _png_unpredict(data, columns * colors * bits // 8 // bpp, bpp)
+        elif predictor != 1:
+            raise PdfError("unsupported predictor %s" % predictor)
+        return data
+    if f in ('ASCIIHexDecode', 'AHx'):
+        return _parse_hex_string(data.split('>')[0] + '>', 0)[0]
+    raise PdfError("unsupported filter %s" % f)
+
+
+# PDFDocEncoding is latin-1, except for these.
+_PDFDOC = {0x18: u'\u02d8', 0x19: u'\u02c7', 0x1a: u'\u02c6', 0x1b: u'\u02d9',
+           0x1c: u'\u02dd', 0x1d: u'\u02db', 0x1e: u'\u02da', 0x1f: u'\u02dc',
+           0x80: u'\u2022', 0x81: u'\u2020', 0x82: u'\u2021', 0x83: u'\u2026',
+           0x84: u'\u2014', 0x85: u'\u2013', 0x86: u'\u0192', 0x87: u'\u2044',
+           0x88: u'\u2039', 0x89: u'\u203a', 0x8a: u'\u2212', 0x8b: u'\u2030',
+           0x8c: u'\u201e', 0x8d: u'\u201c', 0x8e: u'\u201d', 0x8f: u'\u2018',
+           0x90: u'\u2019', 0x91: u'\u201a', 0x92: u'\u2122', 0x93: u'\ufb01',
+           0x94: u'\ufb02', 0x95: u'\u0141', 0x96: u'\u0152', 0x97: u'\u0160',
+           0x98: u'\u0178', 0x99: u'\u017d', 0x9a: u'\u0131', 0x9b: u'\u0142',
+           0x9c: u'\u0153', 0x9d: u'\u0161', 0x9e: u'\u017e', 0xa0: u'\u20ac'}
+
+def text(s):
+    """Decode a PDF text string (e.g. an outline title) to unicode."""
+    if s.startswith('\xfe\xff'):
+        return s[2:].decode('utf-16-be', 'replace')
+    if s.startswith('\xff\xfe'):
+        return s[2:].decode('utf-16-le', 'replace')
+    if s.startswith('\xef\xbb\xbf'):
+        return s[3:].decode('utf-8', 'replace')
+    return u''.join(_PDFDOC.get(ord(c), unichr(ord(c))) for c in s)
+
+
+class PdfReader(object):
+    """Gives access to the objects of a PDF file."""
+    def __init__(self, filename=None, data=None):
+        if data is None:
+            f = open(filename, 'rb')
+            data = f.read()
+            f.close()
+        self.filename = filename
+        self.data = data
+        self.parser = Parser(data, self.resolve)
+        self.cache = {}
+        self.objstms = {}
+        try:
+            self._read_xref()
+        except (PdfError, ValueError, IndexError, KeyError, zlib.error), e:
+            log("xref of %s is broken (%s); scanning for objects" % (filename, e))
+            self._rebuild_xref()
+        if 'Encrypt' in self.trailer:
+            raise PdfError("%s is encrypted" % filename)
+
+    # cross reference tables
+
+    def _read_xref(self):
+        data = self.data
+        i = data.rfind('startxref')
+        if i == -1:
+            raise PdfError("no startxref")
+        offset, pos = self.parser.parse(i + len('startxref'))
+        self.xref = {}
+        self.trailer = None
+        seen = set()
+        while isinstance(offset, (int, long)) and offset not in seen:
+            seen.add(offset)
+            pos = _ws_re.match(data, offset).end()
+            if data.startswith('xref', pos):
+                trailer = self._read_xref_table(pos + 4)
+                if 'XRefStm' in trailer:
+                    self._read_xref_stream(trailer['XRefStm'])
+            else:
+                trailer = self._read_xref_stream(offset)
+            if self.trailer is None:
+                self.trailer = trailer
+            offset = trailer.get('Prev')
+        if self.trailer is None or 'Root' not in self.trailer:
+            raise PdfError("no trailer")
+
+    def _read_xref_table(self, pos):
+        data = self.data
+        xref = self.xref
+        while True:
+            m = _xref_section_re.match(data, pos)
+            if m is None:
+                break
+            start, count = int(m.group(1)), int(m.group(2))
+            pos = m.end()
+            for num in xrange(start, start + count):
+                e = _xref_entry_re.match(data, pos)
+                if e is None:
+                    raise PdfError("bad xref entry at %s" % pos)
+                pos = e.end()
+                if num not in xref:
+                    if e.group(3) == 'n':
+                        xref[num] = (1, int(e.group(1)), int(e.group(2)))
+                    else:
+                        xref[num] = (0, 0, 0)
+        pos = _ws_re.match(data, pos).end()
+        if not data.startswith('trailer', pos):
+            raise PdfError("no trailer after xref table")
+        trailer, pos = self.parser.parse(pos + len('trailer'))
+        return trailer
+
+    def _read_xref_stream(self, offset):
+        num, gen, stream = self._parse_indirect(offset)
+        if not isinstance(stream, Stream) or stream.get('Type') != 'XRef':
+            raise PdfError("expected an xref stream at %s" % offset)
+        widths = stream['W']
+        size = stream['Size']
+        index = stream.get('Index', [0, size])
+        data = stream.decoded()
+        rowlen = sum(widths)
+        xref = self.xref
+        pos = 0
+        for i in range(0, len(index), 2):
+            start, count = index[i], index[i + 1]
+            for num in xrange(start, start + count):
+                row = data[pos:pos + rowlen]
+                pos += rowlen
+                fields = []
+                j = 0
+                for w in widths:
+                    v = 0
+                    for c in row[j:j + w]:
+                        v = (v << 8) | ord(c)
+                    fields.append(v)
+                    j += w
+                if widths[0] == 0:
+                    fields[0] = 1
+                if num not in xref:
+                    xref[num] = tuple(fields)
+        return dict((k, v) for k, v in stream.iteritems()
+                    if k not in ('W', 'Index', 'Filter', 'DecodeParms', 'Length', 'Type'))
+
+    def _rebuild_xref(self):
+        """Find the objects by looking for 'n g obj' everywhere, for
+        when the xref table is missing or wrong."""
+        data = self.data
+        self.xref = {}
+        self.cache = {}
+        trailer = {}
+        for m in _obj_scan_re.finditer(data):
+            self.xref[int(m.group(1))] = (1, m.start(), int(m.group(2)))
+        for num in list(self.xref):
+            try:
+                obj = self.get_object(num)
+                if isinstance(obj, Stream) and obj.get('Type') == 'ObjStm':
+                    for i, (onum, pos) in self._objstm(num)[1].iteritems():
+                        self.xref.setdefault(onum, (2, num, i))
+            except (PdfError, zlib.error, KeyError):
+                continue
+        self.cache = {}
+        for m in re.finditer(r'trailer[\x00\t\n\x0c\r ]*<<', data):
+            try:
+                d, pos = self.parser.parse(m.start() + len('trailer'))
+                trailer.update(d)
+            except PdfError:
+                pass
+        if 'Root' not in trailer:
+            #perhaps an xref stream has it
+            for num in sorted(self.xref):
+                try:
+                    obj = self.get_object(num)
+                except PdfError:
+                    continue
+                if isinstance(obj, Stream) and obj.get('Type') == 'XRef':
+                    trailer.update((k, v) for k, v in obj.iteritems()
+                                   if k in ('Root', 'Info', 'ID', 'Encrypt'))
+                elif isinstance(obj, dict) and obj.get('Type') == 'Catalog':
+                    trailer.setdefault('Root', Ref(num, self.xref[num][2]))
+        if 'Root' not in trailer:
+            raise PdfError("could not find the document catalog")
+        trailer.pop('Prev', None)
+        trailer.pop('XRefStm', None)
+        self.trailer = trailer
+
+    # objects
+
+    def _parse_indirect(self, offset):
+        m = _obj_header_re.match(self.data, _ws_re.match(self.data, offset).end())
+        if m is None:
+            raise PdfError("no object at %s" % offset)
+        obj, pos = self.parser.parse(m.end())
+        return int(m.group(1)), int(m.group(2)), obj
+
+    def _objstm(self, num):
+        if num not in self.objstms:
+            stream = self.get_object(num)
+            if not isinstance(stream, Stream):
+                raise PdfError("object stream %s is not a stream" % num)
+            data = stream.decoded()
+            first = stream['First']
+            n = stream['N']
+            header = Parser(data)
+            offsets = {}
+            pos = 0
+            for i in range(n):
+                onum, pos = header.parse(pos)
+                off, pos = header.parse(pos)
+                offsets[i] = (onum, first + off)
+            self.objstms[num] = (Parser(data, self.resolve), offsets)
+        return self.objstms[num]
+
+    def get_object(self, num):
+        """Return object number <num>, or None if it doesn't exist."""
+        if num in self.cache:
+            return self.cache[num]
+        entry = self.xref.get(num)
+        if entry is None or entry[0] == 0:
+            obj = None
+        elif entry[0] == 1:
+            onum, gen, obj = self._parse_indirect(entry[1])
+            if onum != num:
+                raise PdfError("object %s is not at %s" % (num, entry[1]))
+        elif entry[0] == 2:
+            parser, offsets = self._objstm(entry[1])
+            onum, pos = offsets[entry[2]]
+            obj = parser.parse(pos)[0]
+        else:
+            obj = None
+        self.cache[num] = obj
+        return obj
+
+    def resolve(self, obj):
+        """Follow references until reaching a direct object."""
+        for i in range(32):
+            if not isinstance(obj, Ref):
+                return obj
+            obj = self.get_object(obj.num)
+        raise PdfError("reference loop")
+
+    # document structure
+
+    @property
+    def catalog(self):
+        return self.resolve(self.trailer['Root'])
+
+    @property
+    def page_count(self):
+        pages = self.resolve(self.catalog['Pages'])
+        return int(self.resolve(pages['Count']))
+
+    def pages(self):
+        """A list of (reference, page dictionary) pairs, in page order.
+        The dictionaries are copies, with any attributes inherited from
+        the page tree filled in."""
+        pages = []
+        seen = set()
+        def walk(ref, inherited):
+            node = self.resolve(ref)
+            if not isinstance(ref, Ref):
+                raise PdfError("page tree node is not indirect")
+            if ref.num in seen:
+                raise PdfError("loop in page tree")
+            seen.add(ref.num)
+            if 'Kids' in node:
+                inherited = inherited.copy()
+                for k in INHERITABLE:
+                    if k in node:
+                        inherited[k] = node[k]
+                for kid in self.resolve(node['Kids']):
+                    walk(kid, inherited)
+            else:
+                page = inherited.copy()
+                page.update(node)
+                pages.append((ref, page))
+        walk(self.catalog['Pages'], {})
+        return pages
+
+    def page_refs(self):
+        """A list of references to the pages, in order."""
+        return [ref for ref, page in self.pages()]
+
+    def named_destinations(self):
+        """A dictionary of the named destinations, mapping names to
+        destination arrays."""
+        dests = {}
+        catalog = self.catalog
+        old = self.resolve(catalog.get('Dests'))
+        if isinstance(old, dict):
+            for k, v in old.iteritems():
+                dests[k] = v
+        names = self.resolve(catalog.get('Names'))
+        if isinstance(names, dict) and 'Dests' in names:
+            seen = set()
+            def walk(node):
+                node = self.resolve(node)
+                if id(node) in seen:
+                    return
+                seen.add(id(node))
+                a = self.resolve(node.get('Names', []))
+                for i in range(0, len(a) - 1, 2):
+                    dests[str(self.resolve(a[i]))] = a[i + 1]
+                for kid in self.resolve(node.get('Kids', [])):
+                    walk(kid)
+            walk(names['Dests'])
+        for k, v in dests.items():
+            v = self.resolve(v)
+            if isinstance(v, dict):
+                v = self.resolve(v.get('D'))
+            dests[k] = v
+        return dests
+
+    def dest_page(self, dest, page_numbers, named=None):
+        """The page number (from 1) that <dest> points to, or None.
+        <page_numbers> maps page object numbers to page numbers, and
+        <named> is the result of named_destinations(), which is read
+        if needed and not given."""
+        dest = self.resolve(dest)
+        if isinstance(dest, (Name, String)):
+            if named is None:
+                named = self.named_destinations()
+            dest = self.resolve(named.get(str(dest)))
+        if isinstance(dest, dict):
+            dest = self.resolve(dest.get('D'))
+        if not isinstance(dest, list) or not dest:
+            return None
+        page = dest[0]
+        if isinstance(page, Ref):
+            return page_numbers.get(page.num)
+        if isinstance(page, (int, long)):
+            return page + 1
+        return None
+
+    def outline_tree(self):
+        """The outline as a list of (item dictionary, children) pairs,
+        where children is a list of the same form."""
+        outlines = self.resolve(self.catalog.get('Outlines'))
+        if not isinstance(outlines, dict):
+            return []
+        seen = set()
+        def walk(ref):
+            items = []
+            while ref is not None:
+                key = ref.num if isinstance(ref, Ref) else id(ref)
+                if key in seen:
+                    raise PdfError("loop in outline")
+                seen.add(key)
+                item = self.resolve(ref)
+                if not isinstance(item, dict):
+                    break
+                items.append((item, walk(item.get('First'))))
+                ref = item.get('Next')
+            return items
+        return walk(outlines.get('First'))
+
+    def item_destination(self, item):
+        """The destination of an outline item or link annotation
+        (following a GoTo action if necessary), or None."""
+        dest = item.get('Dest')
+        if dest is None:
+            action = self.resolve(item.get('A'))
+            if isinstance(action, dict) and action.get('S') == 'GoTo':
+                dest = action.get('D')
+        return dest
+
+    def outline(self, max_depth=None):
+        """Return the outline as a list of (title, depth, page number)
+        tuples in document order.  Titles are unicode, top level items
+        have depth 1, and pages are numbered from 1 (None if the item
+        doesn't point to a page in this document)."""
+        tree = self.outline_tree()
+        if not tree:
+            return []
+        page_numbers = dict((ref.num, i + 1) for i, ref in enumerate(self.page_refs()))
+        named = [None]
+        contents = []
+
+        def destination(item):
+            dest = self.item_destination(item)
+            if dest is None:
+                return None
+            if isinstance(self.resolve(dest), (Name, String)) and named[0] is None:
+                named[0] = self.named_destinations()
+            return self.dest_page(dest, page_numbers, named[0])
+
+        def walk(items, depth):
+            for item, children in items:
+                title = text(self.resolve(item.get('Title', '')))
+                contents.append((title, depth, destination(item)))
+                if max_depth is None or depth < max_depth:
+                    walk(children, depth + 1)
+
+        walk(tree, 1)
+        return contents
+
+
+# Writing
+
+_name_ok = set(chr(x) for x in range(0x21, 0x7f)) - set('()<>[]{}/%#')
+
+def _serialise_name(name):
+    return '/' + ''.join(c if c in _name_ok else '#%02x' % ord(c) for c in name)
+
+def _serialise_string(s):
+    return '(%s)' % (s.replace('\\', '\\\\').replace('(', '\\(')
+                     .replace(')', '\\)').replace('\r', '\\r'))
+
+def _serialise_number(n):
+    if isinstance(n, float):
+        if n == int(n):
+            return str(int(n))
+        return ('%.6f' % n).rstrip('0')
+    return str(n)
+
+def serialise(obj):
+    """The PDF syntax for a (direct) object."""
+    if isinstance(obj, Name):
+        return _serialise_name(obj)
+    if isinstance(obj, Keyword):
+        return obj
+    if isinstance(obj, str):
+        return _serialise_string(obj)
+    if isinstance(obj, unicode):
+        return _serialise_string('\xfe\xff' + obj.encode('utf-16-be'))
+    if obj is True:
+        return 'true'
+    if obj is False:
+        return 'false'
+    if obj is None:
+        return 'null'
+    if isinstance(obj, (int, long, float)):
+        return _serialise_number(obj)
+    if isinstance(obj, Ref):
+        return '%d %d R' % (obj.num, obj.gen)
+    if isinstance(obj, list):
+        return '[%s]' % ' '.join(serialise(x) for x in obj)
+    if isinstance(obj, Stream):
+        d = dict(obj)
+        d[Name('Length')] = len(obj.data)
+        return '%s\nstream\n%s\nendstream' % (serialise(d), obj.data)
+    if isinstance(obj, dict):
+        return '<<%s>>' % ''.join('%s %s' % (_serialise_name(k), serialise(v))
+                                  for k, v in obj.iteritems())
+    raise PdfError("can't serialise %r" % (obj,))
+
+
+class PdfWriter(object):
+    """Collects numbered objects and writes them out as a PDF file."""
+    def __init__(self):
+        self.objects = {}
+        self.next_num = 1
+
+    def allocate(self):
+        """Reserve an object number, for an object added later."""
+        ref = Ref(self.next_num, 0)
+        self.next_num += 1
+        return ref
+
+    def add(self, obj, ref=None):
+        if ref is None:
+            ref = self.allocate()
+        self.objects[ref.num] = obj
+        return ref
+
+    def write(self, filename, root, info=None, version='1.4'):
+        """Write the PDF to <filename> (via a temporary file, so a
+        failure doesn't leave half a PDF)."""
+        tmp = '%s.%s.tmp' % (filename, os.getpid())
+        f = open(tmp, 'wb')
+        try:
+            f.write('%%PDF-%s\n%%\xe2\xe3\xcf\xd3\n' % version)
+            pos = f.tell()
+            offsets = {}
+            for num in sorted(self.objects):
+                offsets[num] = pos
+                s = '%d 0 obj\n%s\nendobj\n' % (num, serialise(self.objects[num]))
+                f.write(s)
+                pos += len(s)
+            size = self.next_num
+            xref = ['xref\n0 %d\n' % size, '0000000000 65535 f \n']
+            for num in range(1, size):
+                if num in offsets:
+                    xref.append('%010d 00000 n \n' % offsets[num])
+                else:
+                    xref.append('0000000000 00000 f \n')
+            trailer = {Name('Size'): size, Name('Root'): root}
+            if info is not None:
+                trailer[Name('Info')] = info
+            f.write(''.join(xref))
+            f.write('trailer\n%s\nstartxref\n%d\n%%%%EOF\n' % (serialise(trailer), pos))
+            f.close()
+            os.rename(tmp, filename)
+        except:
+            f.close()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+
+class _Importer(object):
+    """Copies objects from a reader to a writer, giving them new
+    numbers.  Named destinations are replaced by the arrays they name,
+    so links and outline items keep working when names clash between
+    documents.  URI actions for URIs starting with <uri_dest_prefix>
+    become links to the destination named by the rest of the URI,
+    which lets a document link into another it is joined to."""
+    def __init__(self, reader, writer, uri_dest_prefix=None):
+        self.reader = reader
+        self.writer = writer
+        self.uri_dest_prefix = uri_dest_prefix
+        self.refmap = {}
+        self.queue = []
+        self.named = None
+
+    def ref(self, ref, copy=True):
+        """The new reference for <ref>.  Unless <copy> is false, the
+        object will be copied when flush() is called."""
+        if ref.num not in self.refmap:
+            self.refmap[ref.num] = self.writer.allocate()
+            if copy:
+                self.queue.append(ref.num)
+        return self.refmap[ref.num]
+
+    def named_dest(self, name):
+        if self.named is None:
+            self.named = self.reader.named_destinations()
+        return self.named.get(str(name))
+
+    def copy(self, obj):
+        """Copy a direct object, mapping any references in it."""
+        if isinstance(obj, Ref):
+            return self.ref(obj)
+        if isinstance(obj, list):
+            return [self.copy(x) for x in obj]
+        if isinstance(obj, dict):
+            if self.uri_dest_prefix and obj.get('S') == 'URI':
+                uri = self.reader.resolve(obj.get('URI'))
+                if isinstance(uri, str) and uri.startswith(self.uri_dest_prefix):
+                    return {Name('S'): Name('GoTo'),
+                            Name('D'): String(uri[len(self.uri_dest_prefix):])}
+            d = {}
+            for k, v in obj.iteritems():
+                if k == 'Dest' or (k == 'D' and obj.get('S') == 'GoTo'):
+                    dest = self.reader.resolve(v)
+                    if isinstance(dest, (Name, String)):
+                        v = self.named_dest(dest)
+                d[k] = self.copy(v)
+            if isinstance(obj, Stream):
+                return Stream(d, obj.data)
+            return d
+        return obj
+
+    def flush(self):
+        """Copy everything that has been referred to."""
+        while self.queue:
+            num = self.queue.pop()
+            obj = self.reader.get_object(num)
+            if isinstance(obj, dict) and obj.get('Type') in ('Catalog', 'Pages', 'Outlines'):
+                #document structure is rebuilt, not copied
+                obj = None
+            self.writer.add(self.copy(obj), self.refmap[num])
+
+
+def _pdf_version(reader):
+    m = re.match(r'%PDF-(\d\.\d)', reader.data)
+    if m:
+        return m.group(1)
+    return '1.4'
+
+
+class PdfBuilder(object):
+    """Assembles a new PDF from the pages of existing ones.  See
+    _Importer for <uri_dest_prefix>."""
+    def __init__(self, uri_dest_prefix=None):
+        self.uri_dest_prefix = uri_dest_prefix
+        self.writer = PdfWriter()
+        self.pages_ref = self.writer.allocate()
+        self.kids = []
+        self.outline = []
+        self.dests = {}
+        self.info = None
+        self.version = '1.4'
+        self._sources = {}
+
+    @property
+    def page_count(self):
+        return len(self.kids)
+
+    def add_pdf(self, reader, edit=None, keep=None):
+        """Append the pages of <reader>, and its outline.
+
+        If <keep> is given, it is called with the zero-based number of
+        each page in the original, and pages for which it returns
+        false are left out.  If <edit> is given, it is called as
+        edit(page, n) with each page's new dictionary and its number
+        among the kept pages, and can change the dictionary in place.
+        The page's MediaBox, CropBox, Rotate and Resources (and the
+        XObject dictionary in its resources) are direct objects by then,
+        and any inherited from the page tree are filled in."""
+        writer = self.writer
+        importer = _Importer(reader, writer, self.uri_dest_prefix)
+        pages = reader.pages()
+        if keep is None:
+            kept = pages
+        else:
+            kept = [x for i, x in enumerate(pages) if keep(i)]
+        #allocate numbers for all the pages first, so that links to
+        #later pages find them.  Pages that are left out become nulls.
+        for ref, page in pages:
+            importer.ref(ref, copy=False)
+        for n, (ref, page) in enumerate(kept):
+            page.pop('Parent', None)
+            for k in ('MediaBox', 'CropBox', 'Rotate'):
+                if k in page:
+                    v = reader.resolve(page[k])
+                    if isinstance(v, list):
+                        v = [reader.resolve(x) for x in v]
+                    page[k] = v
+            resources = reader.resolve(page.get('Resources'))
+            if isinstance(resources, dict):
+                resources = dict(resources)
+                if 'XObject' in resources:
+                    resources['XObject'] = reader.resolve(resources['XObject'])
+                page['Resources'] = resources
+            new = importer.copy(page)
+            new[Name('Parent')] = self.pages_ref
+            if edit is not None:
+                edit(new, n)
+            new_ref = importer.refmap[ref.num]
+            writer.add(new, new_ref)
+            self.kids.append(new_ref)
+        for ref, page in pages:
+            new_ref = importer.refmap[ref.num]
+            if new_ref.num not in writer.objects:
+                writer.add(None, new_ref)
+        self._finish(reader, importer)
+
+    def add_nup(self, reader, columns, width, height):
+        """Append the pages of <reader>, placed <columns> at a time
+        side by side on pages of <width> by <height> points.  The row
+        of pages is centred and not scaled, as with `pdfnup --nup Nx1
+        --noautoscale`.  Each original page becomes a form XObject,
+        so its content is not rewritten.  If this makes an odd number
+        of pages, a blank one is added.  Links and the outline point to
+        the new page that the original page was put on."""
+        writer = self.writer
+        importer = _Importer(reader, writer, self.uri_dest_prefix)
+        pages = reader.pages()
+        out_refs = [writer.allocate() for i in range(0, len(pages), columns)]
+        for i, (ref, page) in enumerate(pages):
+            importer.refmap[ref.num] = out_refs[i // columns]
+
+        for j, out_ref in enumerate(out_refs):
+            row = pages[j * columns:(j + 1) * columns]
+            cell_width = _box_size(reader, row[0][1])[0]
+            left = 0.5 * (width - columns * cell_width)
+            xobjects = {}
+            content = []
+            annots = []
+            for k, (ref, page) in enumerate(row):
+                form, box = self._page_form(reader, importer, page)
+                dx = left + k * cell_width - box[0]
+                dy = 0.5 * (height - (box[3] - box[1])) - box[1]
+                name = 'P%d' % k
+                xobjects[Name(name)] = form
+                content.append('q 1 0 0 1 %s %s cm /%s Do Q' %
+                               (_serialise_number(dx), _serialise_number(dy), name))
+
+                for annot in reader.resolve(page.get('Annots')) or []:
+                    a = reader.resolve(annot)
+                    if not isinstance(a, dict):
+                        continue
+                    a = dict(a)
+                    a.pop('P', None)
+                    rect = [float(reader.resolve(x)) for x in reader.resolve(a.pop('Rect', [0, 0, 0, 0]))]
+                    new = importer.copy(a)
+                    new[Name('Rect')] = [rect[0] + dx, rect[1] + dy, rect[2] + dx, rect[3] + dy]
+                    new[Name('P')] = out_ref
+                    annots.append(writer.add(new))
+
+            new = {Name('Type'): Name('Page'),
+                   Name('Parent'): self.pages_ref,
+                   Name('MediaBox'): [0, 0, width, height],
+                   Name('Resources'): {Name('XObject'): xobjects},
+                   Name('Contents'): writer.add(Stream({}, '\n'.join(content)))}
+            if annots:
+                new[Name('Annots')] = annots
+            writer.add(new, out_ref)
+            self.kids.append(out_ref)
+
+        if len(out_refs) & 1:
+            self.add_blank_page(width, height)
+        self._finish(reader, importer)
+
+    def _page_form(self, reader, importer, page):
+        """Add a form XObject with the content of <page>, returning a
+        reference to it and its bounding box."""
+        box = [float(reader.resolve(x)) for x in reader.resolve(page['MediaBox'])]
+        data, filters = _page_content(reader, page)
+        form = {Name('Type'): Name('XObject'),
+                Name('Subtype'): Name('Form'),
+                Name('BBox'): box,
+                Name('Resources'): importer.copy(page.get('Resources', {}))}
+        if 'Group' in page:
+            form[Name('Group')] = importer.copy(page['Group'])
+        form.update(importer.copy(filters))
+        return self.writer.add(Stream(form, data)), box
+
+    def page_form(self, reader, n):
+        """A reference to a form XObject with the content of page <n>
+        (counting from 0) of <reader>, for drawing on other pages.
+        Nothing else from <reader> is added."""
+        if id(reader) not in self._sources:
+            importer = _Importer(reader, self.writer, self.uri_dest_prefix)
+            self._sources[id(reader)] = (importer, reader.pages())
+        importer, pages = self._sources[id(reader)]
+        form, box = self._page_form(reader, importer, pages[n][1])
+        importer.flush()
+        return form
+
+    def draw_form(self, page, form, name='ObjaviOverlay'):
+        """Draw the form XObject <form> over the page dictionary <page>,
+        as given to the edit function of add_pdf()."""
+        writer = self.writer
+        resources = page.setdefault(Name('Resources'), {})
+        xobjects = resources.get('XObject')
+        xobjects = dict(xobjects) if isinstance(xobjects, dict) else {}
+        xobjects[Name(name)] = form
+        resources[Name('XObject')] = xobjects
+        contents = page.get('Contents')
+        if contents is None:
+            contents = []
+        elif not isinstance(contents, list):
+            contents = [contents]
+        page[Name('Contents')] = ([writer.add(Stream({}, 'q\n'))] + contents +
+                                  [writer.add(Stream({}, '\nQ q /%s Do Q\n' % name))])
+
+    def _finish(self, reader, importer):
+        """Take the outline and anything else needed from <reader>."""
+        self.outline.extend(_copy_outline(reader, importer, reader.outline_tree()))
+        for name, dest in reader.named_destinations().iteritems():
+            if name not in self.dests:
+                self.dests[name] = importer.copy(dest)
+        if self.info is None and 'Info' in reader.trailer:
+            self.info = importer.copy(reader.trailer['Info'])
+        importer.flush()
+        self.version = max(self.version, _pdf_version(reader))
+
+    def add_blank_page(self, width, height):
+        self.kids.append(self.writer.add({Name('Type'): Name('Page'),
+                                          Name('Parent'): self.pages_ref,
+                                          Name('MediaBox'): [0, 0, width, height],
+                                          Name('Resources'): {}}))
+
+    def write(self, destination):
+        writer = self.writer
+        writer.add({Name('Type'): Name('Pages'),
+                    Name('Kids'): self.kids,
+                    Name('Count'): len(self.kids)}, self.pages_ref)
+        catalog = {Name('Type'): Name('Catalog'),
+                   Name('Pages'): self.pages_ref}
+        if self.outline:
+            outlines_ref = writer.allocate()
+            first, last, count = _write_outline(writer, self.outline, outlines_ref)
+            writer.add({Name('Type'): Name('Outlines'),
+                        Name('First'): first,
+                        Name('Last'): last,
+                        Name('Count'): count}, outlines_ref)
+            catalog[Name('Outlines')] = outlines_ref
+            catalog[Name('PageMode')] = Name('UseOutlines')
+        if self.dests:
+            names = []
+            for k in sorted(self.dests):
+                names.extend((String(k), self.dests[k]))
+            catalog[Name('Names')] = {Name('Dests'): writer.add({Name('Names'): names})}
+        info = self.info
+        if isinstance(info, dict):
+            info = writer.add(info)
+        writer.write(destination, writer.add(catalog), info, self.version)
+
+
+def concat(destination, pdfs, rotate=0, uri_dest_prefix=None):
+    """Join the PDFs together into <destination>, merging their
+    outlines and named destinations (if a name is used more than once,
+    the first wins).  If <rotate> is set, it is added to the rotation
+    of every page (so 180 turns the document upside down).  The page
+    contents, fonts and images are copied as they are, without being
+    decoded.  See _Importer for <uri_dest_prefix>."""
+    def rotate_page(page, n):
+        r = (page.get('Rotate', 0) + rotate) % 360
+        if r:
+            page[Name('Rotate')] = r
+        else:
+            page.pop('Rotate', None)
+
+    builder = PdfBuilder(uri_dest_prefix)
+    for pdf in pdfs:
+        builder.add_pdf(PdfReader(pdf), edit=rotate_page)
+    builder.write(destination)
+
+
+def nup(pdf, destination, columns, width, height):
+    """Put the pages of <pdf> side by side, <columns> to a page, and
+    save the result as <destination> (see PdfBuilder.add_nup)."""
+    builder = PdfBuilder()
+    builder.add_nup(PdfReader(pdf), columns, width, height)
+    builder.write(destination)
+
+
+def _box_size(reader, page):
+    box = [float(reader.resolve(x)) for x in reader.resolve(page['MediaBox'])]
+    return abs(box[2] - box[0]), abs(box[3] - box[1])
+
+
+def _page_content(reader, page):
+    """The page's content as stream data and the filter entries to go
+    with it.  A single content stream is used as it is; an array of
+    them is decoded, joined and compressed again."""
+    contents = reader.resolve(page.get('Contents'))
+    if contents is None:
+        return '', {}
+    if isinstance(contents, Stream):
+        return contents.data, dict((k, reader.resolve(contents[k]))
+                                   for k in ('Filter', 'DecodeParms')
+                                   if k in contents)
+    parts = [reader.resolve(x).decoded() for x in contents]
+    return zlib.compress('\n'.join(parts)), {Name('Filter'): Name('FlateDecode')}
+
+
+def overlay(pdf, over_pdf, destination):
+    """Draw each page of <over_pdf> on top of the corresponding page
+    of <pdf>, saving the result as <destination>."""
+    builder = PdfBuilder()
+    over = PdfReader(over_pdf)
+    n_over = len(over.page_refs())
+    def edit(page, n):
+        if n < n_over:
+            builder.draw_form(page, builder.page_form(over, n))
+    builder.add_pdf(PdfReader(pdf), edit=edit)
+    builder.write(destination)
+
+
+def _reshape_box(box, offset, width, height):
+    x0, y0, x1, y1 = [float(x) for x in box]
+    x0, x1 = min(x0, x1), max(x0, x1)
+    y0, y1 = min(y0, y1), max(y0, y1)
+    if width:
+        x0 -= 0.5 * (width - (x1 - x0))
+        x1 = x0 + width
+    if height:
+        y0 -= 0.5 * (height - (y1 - y0))
+        y1 = y0 + height
+    return [x0 - offset, y0, x1 - offset, y1]
+
+
+def reshape(pdf, destination, offset=0, width=None, height=None,
+            centre_start=False, centre_end=False, even_pages=False):
+    """Resize and shift the pages of <pdf>, saving the result as
+    <destination> (which can be the same file).
+
+    If <width> or <height> is given, each page is made that size,
+    keeping its content centred.  Then odd pages are moved <offset>
+    points to the right and even pages the same distance to the left,
+    by moving the page's MediaBox rather than touching its content.
+    With <centre_start> or <centre_end>, the first or last page is
+    left in the middle, though the others keep their parity.  If
+    <even_pages> is set and there are an odd number of pages, the last
+    one is dropped (the HTML is expected to have made a spare blank
+    page at the end for this purpose)."""
+    reader = PdfReader(pdf)
+    count = len(reader.page_refs())
+    keep = None
+    if even_pages and count & 1:
+        count -= 1
+        keep = lambda i: i < count
+
+    def edit(page, n):
+        shift = offset
+        if n & 1:
+            shift = -offset
+        if (centre_start and n == 0) or (centre_end and n == count - 1):
+            shift = 0
+        for k in ('MediaBox', 'CropBox'):
+            if k in page:
+                page[k] = _reshape_box(page[k], shift, width, height)
+
+    builder = PdfBuilder()
+    builder.add_pdf(reader, edit=edit, keep=keep)
+    builder.write(destination)
+
+
+def _copy_outline(reader, importer, tree):
+    """Turn an outline tree (see PdfReader.outline_tree) into a list of
+    (item, children) pairs with the links stripped out and the
+    destinations copied."""
+    items = []
+    for item, children in tree:
+        new = {Name('Title'): reader.resolve(item.get('Title', String('')))}
+        dest = importer.copy(reader.item_destination(item))
+        if isinstance(dest, (Name, String)):
+            dest = importer.copy(importer.named_dest(dest))
+        if dest is not None:
+            new[Name('Dest')] = dest
+        for k in ('C', 'F'):
+            if k in item:
+                new[Name(k)] = importer.copy(item[k])
+        new['open'] = reader.resolve(item.get('Count', 0)) >= 0
+        items.append((new, _copy_outline(reader, importer, children)))
+    return items
+
+
+def _write_outline(writer, items, parent):
+    """Add the outline items to the writer, linked to each other and
+    to <parent>.  Returns the first and last references, and the
+    number of visible items."""
+    refs = [writer.allocate() for x in items]
+    visible = 0
+    for i, (item, children) in enumerate(items):
+        is_open = item.pop('open')
+        item[Name('Parent')] = parent
+        if i:
+            item[Name('Prev')] = refs[i - 1]
+        if i + 1 < len(refs):
+            item[Name('Next')] = refs[i + 1]
+        visible += 1
+        if children:
+            first, last, count = _write_outline(writer, children, refs[i])
+            item[Name('First')] = first
+            item[Name('Last')] = last
+            if is_open:
+                item[Name('Count')] = count
+                visible += count
+            else:
+                item[Name('Count')] = -len(children)
+        writer.add(item, refs[i])
+    return refs[0], refs[-1], visible
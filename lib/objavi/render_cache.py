@@ -0,0 +1,250 @@
+# Part of Objavi2, which turns html manuals into books.
+# This keeps finished renders around so they can be served again.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""A content addressed cache of published books.
+
+A render is identified by the SHA1 of the bookizip it was made from,
+the canonicalised request arguments, and config.RENDER_ENGINE_VERSION.
+If all of those are the same, the output will be too, so the stored
+artifact can be published instead of running the whole pipeline
+again.
+
+Note that things fetched from elsewhere at render time (CSS given as
+a url, cover images) are not part of the key.
+
+Entries are removed when they are older than config.RENDER_CACHE_MAX_AGE,
+and the least recently used ones when the cache grows past
+config.RENDER_CACHE_MAX_SIZE (see evict).  The modification time of
+an entry's JSON file records when it was last used.
+"""
+
+import os
+import time
+import shutil
+import tempfile
+from hashlib import sha1
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from objavi import config
+from objavi.book_utils import log
+from objavi.zipstore import ZipStore
+
+
+def file_digest(path, blocksize=1 << 16):
+    """The hex SHA1 digest of the file's contents."""
+    h = sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            s = f.read(blocksize)
+            if not s:
+                break
+            h.update(s)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def canonical_args(args, ignored=config.RENDER_CACHE_IGNORED_ARGS):
+    """Serialise the request arguments in a stable order, leaving out
+    the ones that don't affect the output.  Empty values (None, '',
+    False) are all treated alike."""
+    items = []
+    for k in sorted(args):
+        v = args[k]
+        if k in ignored or v in (None, '', False):
+            continue
+        items.append((k, v))
+    return json.dumps(items, default=repr, sort_keys=True)
+
+
+def make_key(bookizip_file, mode, args):
+    #the zip store usually knows the digest already
+    digest = ZipStore().digest(bookizip_file) or file_digest(bookizip_file)
+    h = sha1()
+    for x in (config.RENDER_ENGINE_VERSION, mode,
+              digest, canonical_args(args)):
+        if isinstance(x, unicode):
+            x = x.encode('utf-8')
+        h.update(x)
+        h.update('\0')
+    return h.hexdigest()
+
+
+def _entry_paths(key):
+    d = os.path.join(config.RENDER_CACHE_DIR, key[:2])
+    return d, os.path.join(d, key), os.path.join(d, key + '.json')
+
+
+def _link_or_copy(src, dest):
+    """Published files are never modified in place, so a hard link is
+    as good as a copy."""
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+def fetch(key, publish_file):
+    """If there is a cached render for <key>, put it where the book
+    would have been published and return the path.  The path may
+    differ from <publish_file> in the way that the original render's
+    did (e.g. templated html gets an extra '.tar.gz').  Return None
+    if there is no usable entry."""
+    d, data_file, meta_file = _entry_paths(key)
+    try:
+        f = open(meta_file)
+        meta = json.load(f)
+        f.close()
+    except (IOError, ValueError):
+        return None
+
+    if time.time() - meta['time'] > config.RENDER_CACHE_MAX_AGE:
+        log("render cache entry %s is too old; removing it" % key)
+        remove(key)
+        return None
+
+    strip = meta['strip']
+    published = publish_file[:len(publish_file) - strip] + meta['tail'].encode('utf-8')
+    try:
+        _link_or_copy(data_file, published)
+    except (IOError, OSError), e:
+        log("could not use render cache entry %s: %s" % (key, e))
+        return None
+    try:
+        os.utime(meta_file, None)
+    except OSError:
+        pass
+    log("render cache hit: %s is %s" % (published, key))
+    return published
+
+
+def _temp_link(src, d):
+    """Hard link (or failing that, copy) <src> to a new temporary file
+    in <d>, and return its name."""
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=d)
+    os.close(fd)
+    try:
+        #os.link won't replace the placeholder; if the name is taken
+        #again in between, it fails rather than overwriting.
+        os.remove(tmp)
+        os.link(src, tmp)
+    except OSError:
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=d)
+        os.close(fd)
+        shutil.copyfile(src, tmp)
+        #mkstemp makes files only the owner can read
+        os.chmod(tmp, 0644)
+    return tmp
+
+
+def store(key, publish_file, published):
+    """Keep a copy of the <published> file, which was going to be
+    <publish_file> before the rendering process renamed it."""
+    if not os.path.isfile(published):
+        #templated html can be published as a directory
+        log("not caching %s: not a regular file" % published)
+        return
+
+    d, data_file, meta_file = _entry_paths(key)
+    if not os.path.exists(d):
+        os.makedirs(d)
+
+    #find the way the name changed, so that fetch() can do the same.
+    common = len(os.path.commonprefix([publish_file, published]))
+    meta = {'strip': len(publish_file) - common,
+            'tail': published[common:].decode('utf-8'),
+            'size': os.path.getsize(published),
+            'time': time.time(),
+            }
+
+    #write under temporary names, then rename, so that a concurrent
+    #fetch() never sees half an entry.
+    tmp = _temp_link(published, d)
+    os.rename(tmp, data_file)
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=d)
+    f = os.fdopen(fd, 'w')
+    json.dump(meta, f)
+    f.close()
+    os.chmod(tmp, 0644)
+    os.rename(tmp, meta_file)
+    log("stored %s in render cache as %s" % (published, key))
+    evict()
+
+
+def evict(max_size=None, max_age=None):
+    """Remove entries older than <max_age> seconds, then the least
+    recently used ones until the total size is under <max_size>
+    bytes.  Temporary files left by interrupted stores are removed
+    after a day."""
+    if max_size is None:
+        max_size = config.RENDER_CACHE_MAX_SIZE
+    if max_age is None:
+        max_age = config.RENDER_CACHE_MAX_AGE
+    now = time.time()
+    entries = []
+    try:
+        subdirs = os.listdir(config.RENDER_CACHE_DIR)
+    except OSError:
+        return
+    for sub in subdirs:
+        d = os.path.join(config.RENDER_CACHE_DIR, sub)
+        try:
+            names = os.listdir(d)
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(d, name)
+            try:
+                mtime = os.path.getmtime(path)
+                if name.endswith('.tmp'):
+                    if mtime < now - 24 * 3600:
+                        os.remove(path)
+                    continue
+                if not name.endswith('.json'):
+                    continue
+                f = open(path)
+                meta = json.load(f)
+                f.close()
+            except (IOError, OSError, ValueError), e:
+                log("render cache: %s: %s" % (path, e))
+                continue
+            entries.append((mtime, meta['time'], meta['size'], name[:-5]))
+
+    total = sum(x[2] for x in entries)
+    entries.sort()
+    for last_used, made, size, key in entries:
+        if made < now - max_age:
+            log("render cache entry %s is too old; removing it" % key)
+        elif max_size and total > max_size:
+            log("render cache is too big; removing %s" % key)
+        else:
+            continue
+        remove(key)
+        total -= size
+
+
+def remove(key):
+    for path in _entry_paths(key)[1:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
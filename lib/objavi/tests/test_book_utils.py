@@ -0,0 +1,147 @@
+# Part of Objavi2, which turns html manuals into books.
+# These are tests for the command and stage runners in objavi.book_utils.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Tests for objavi.book_utils.run and run_stages.  The run() tests
+need sh, sleep and setsid."""
+
+import signal
+import threading
+import time
+import unittest
+
+from objavi import config
+from objavi import book_utils
+from objavi.book_utils import run, run_stages, ObjaviError
+
+
+class RunTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = (config.RUN_KILL_GRACE, config.RUN_CAPTURE_LIMIT)
+
+    def tearDown(self):
+        config.RUN_KILL_GRACE, config.RUN_CAPTURE_LIMIT = self.saved
+
+    def test_capture(self):
+        r = run(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+        self.assertEqual(r, 3)
+        self.assertEqual(r.stdout, 'out\n')
+        self.assertEqual(r.stderr, 'err\n')
+        self.assertFalse(r.truncated)
+        self.assertFalse(r.timed_out)
+
+    def test_capture_limit(self):
+        config.RUN_CAPTURE_LIMIT = 100
+        r = run(['sh', '-c', 'echo start; i=0; while [ $i -lt 200 ]; do '
+                 'echo middle; i=$((i+1)); done; echo end'])
+        self.assertEqual(r, 0)
+        self.assertTrue(r.truncated)
+        self.assertTrue(r.stdout.startswith('start\n'))
+        self.assertTrue(r.stdout.endswith('end\n'))
+        self.assertTrue('bytes dropped' in r.stdout)
+
+    def test_timeout(self):
+        r = run(['sh', '-c', 'sleep 30'], timeout=0.5)
+        self.assertTrue(r.timed_out)
+        self.assertEqual(r, -signal.SIGTERM)
+        self.assertTrue(r.wall < 10)
+
+    def test_timeout_kill(self):
+        #a command that ignores SIGTERM gets SIGKILL after the grace period
+        config.RUN_KILL_GRACE = 0.5
+        r = run(['sh', '-c', 'trap "" TERM; sleep 30'], timeout=0.5)
+        self.assertTrue(r.timed_out)
+        self.assertEqual(r, -signal.SIGKILL)
+        self.assertTrue(r.wall < 10)
+
+    def test_interrupted(self):
+        #a signal arriving while the command runs doesn't abandon it
+        previous = signal.signal(signal.SIGALRM, lambda *args: None)
+        signal.setitimer(signal.ITIMER_REAL, 0.05, 0.05)
+        try:
+            r = run(['sh', '-c', 'sleep 0.5; echo done'])
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+        self.assertEqual(r, 0)
+        self.assertEqual(r.stdout, 'done\n')
+
+    def test_watchers(self):
+        results = []
+        def watcher(result):
+            results.append(result)
+        book_utils.add_run_watcher(watcher)
+        try:
+            r = run(['true'])
+        finally:
+            book_utils.remove_run_watcher(watcher)
+        run(['true'])
+        self.assertEqual(results, [r])
+        self.assertEqual(results[0].cmd, ['true'])
+
+
+class RunStagesTest(unittest.TestCase):
+    def test_order(self):
+        done = []
+        run_stages([('c', lambda: done.append('c'), ('a', 'b')),
+                    ('a', lambda: done.append('a'), ()),
+                    ('b', lambda: done.append('b'), ('a',))])
+        self.assertEqual(done, ['a', 'b', 'c'])
+
+    def test_parallel(self):
+        #b and c can only both finish if they run at the same time
+        arrived = {'b': threading.Event(), 'c': threading.Event()}
+        def meet(me, other):
+            arrived[me].set()
+            if not arrived[other].wait(5):
+                raise AssertionError("stages didn't run in parallel")
+        done = []
+        run_stages([('a', lambda: done.append('a'), ()),
+                    ('b', lambda: meet('b', 'c'), ('a',)),
+                    ('c', lambda: meet('c', 'b'), ('a',)),
+                    ('d', lambda: done.append('d'), ('b', 'c'))],
+                   max_workers=2)
+        self.assertEqual(done, ['a', 'd'])
+
+    def test_max_workers(self):
+        lock = threading.Lock()
+        running = [0, 0]
+        def stage():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+        run_stages([(str(i), stage, ()) for i in range(6)], max_workers=2)
+        self.assertEqual(running[1], 2)
+
+    def test_failure(self):
+        done = []
+        def fail():
+            raise ValueError('broken')
+        self.assertRaises(ValueError, run_stages,
+                          [('a', fail, ()),
+                           ('b', lambda: done.append('b'), ('a',))])
+        self.assertEqual(done, [])
+
+    def test_unknown_dependency(self):
+        self.assertRaises(ObjaviError, run_stages,
+                          [('a', lambda: None, ('z',))])
+
+
+if __name__ == '__main__':
+    unittest.main()
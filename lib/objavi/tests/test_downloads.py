@@ -0,0 +1,81 @@
+# Part of Objavi2, which turns html manuals into books.
+# These are tests for the header handling in objavi.classic.downloads.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Tests for the Range and If-None-Match handling in
+objavi.classic.downloads."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from objavi.classic.downloads import parse_range, etag_matches, describe_file
+
+
+class ParseRangeTest(unittest.TestCase):
+    def test_whole_file(self):
+        for header in (None, '', 'bytes=-', 'bytes=0-1,5-6', 'lines=1-2', 'bytes=x-'):
+            self.assertEqual(parse_range(header, 100), None)
+
+    def test_ranges(self):
+        self.assertEqual(parse_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(parse_range(' bytes=10-  ', 100), (10, 99))
+        #the end is clipped to the file
+        self.assertEqual(parse_range('bytes=90-200', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=99-99', 100), (99, 99))
+
+    def test_suffix(self):
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-500', 100), (0, 99))
+
+    def test_unsatisfiable(self):
+        for header in ('bytes=100-', 'bytes=200-300', 'bytes=5-4', 'bytes=-0'):
+            self.assertRaises(ValueError, parse_range, header, 100)
+        self.assertRaises(ValueError, parse_range, 'bytes=0-', 0)
+
+
+class EtagTest(unittest.TestCase):
+    def test_matches(self):
+        etag = '"64-5"'
+        self.assertTrue(etag_matches('"64-5"', etag))
+        self.assertTrue(etag_matches('W/"64-5"', etag))
+        self.assertTrue(etag_matches('"1-1", "64-5"', etag))
+        self.assertTrue(etag_matches('*', etag))
+
+    def test_no_match(self):
+        etag = '"64-5"'
+        for header in (None, '', '"64-6"', '64-5', '"1-1", W/"2-2"'):
+            self.assertFalse(etag_matches(header, etag))
+
+    def test_described_etag(self):
+        d = tempfile.mkdtemp(prefix='objavi-test-')
+        try:
+            path = os.path.join(d, 'book.pdf')
+            f = open(path, 'wb')
+            f.write('x' * 100)
+            f.close()
+            os.utime(path, (1000000000.5, 1000000000.5))
+            desc = describe_file(path, 'application/pdf')
+            self.assertEqual(desc['etag'], '"64-38d7ea4ce2120"')
+            self.assertEqual(desc['filename'], 'book.pdf')
+            self.assertTrue(etag_matches('W/' + desc['etag'], desc['etag']))
+        finally:
+            shutil.rmtree(d)
+
+
+if __name__ == '__main__':
+    unittest.main()
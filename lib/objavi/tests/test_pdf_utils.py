@@ -0,0 +1,149 @@
+# Part of Objavi2, which turns html manuals into books.
+# These are tests for the PDF reader and writer in objavi.pdf_utils.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Tests for objavi.pdf_utils.  Run from the lib directory with
+
+    python -m unittest discover objavi/tests
+
+The fixtures in data/ are:
+
+  outline.pdf      seven 300x400 pages, with a two level outline
+                   (including a UTF-16 title) and a named destination
+  xref-stream.pdf  two 100x100 pages, with a compressed cross reference
+                   stream and an object stream holding the catalog and
+                   a one item outline titled e-acute
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from objavi import pdf_utils
+from objavi.pdf_utils import PdfReader
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+OUTLINE_PDF = os.path.join(DATA_DIR, 'outline.pdf')
+XREF_STREAM_PDF = os.path.join(DATA_DIR, 'xref-stream.pdf')
+
+OUTLINE = [(u'Intro', 1, 1),
+           (u'\xdcn\xefc\xf6d\xe9 \u2248 title', 2, 2),
+           (u'Chapter 2', 1, 4),
+           (u'Chapter 3', 1, 6),
+           (u'deep', 2, 7)]
+
+
+def page_sizes(pdf):
+    reader = PdfReader(pdf)
+    return [pdf_utils._box_size(reader, page) for ref, page in reader.pages()]
+
+
+class PdfUtilsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='objavi-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def tmp(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def test_page_count(self):
+        self.assertEqual(PdfReader(OUTLINE_PDF).page_count, 7)
+        self.assertEqual(PdfReader(XREF_STREAM_PDF).page_count, 2)
+
+    def test_page_count_with_broken_xref(self):
+        f = open(OUTLINE_PDF, 'rb')
+        data = f.read()
+        f.close()
+        data = data[:data.rfind('startxref')] + 'startxref\n12\n%%EOF\n'
+        reader = PdfReader(data=data)
+        self.assertEqual(reader.page_count, 7)
+        self.assertEqual(reader.outline(), OUTLINE)
+
+    def test_outline(self):
+        self.assertEqual(PdfReader(OUTLINE_PDF).outline(), OUTLINE)
+        self.assertEqual(PdfReader(OUTLINE_PDF).outline(max_depth=1),
+                         [x for x in OUTLINE if x[1] == 1])
+        self.assertEqual(PdfReader(XREF_STREAM_PDF).outline(), [(u'\xe9', 1, 2)])
+
+    def test_named_destinations(self):
+        reader = PdfReader(OUTLINE_PDF)
+        named = reader.named_destinations()
+        self.assertEqual(named.keys(), ['__WKANCHOR_2'])
+        page_numbers = dict((ref.num, i + 1) for i, ref in enumerate(reader.page_refs()))
+        self.assertEqual(reader.dest_page(named['__WKANCHOR_2'], page_numbers), 5)
+
+    def test_concat(self):
+        out = self.tmp('concat.pdf')
+        pdf_utils.concat(out, [OUTLINE_PDF, XREF_STREAM_PDF, OUTLINE_PDF])
+        reader = PdfReader(out)
+        self.assertEqual(reader.page_count, 16)
+        #outlines are merged, with their pages renumbered
+        outline = reader.outline()
+        self.assertEqual(outline[:5], OUTLINE)
+        self.assertEqual(outline[5], (u'\xe9', 1, 9))
+        self.assertEqual(outline[6:], [(t, d, p + 9) for t, d, p in OUTLINE])
+        self.assertEqual(page_sizes(out), [(300, 400)] * 7 + [(100, 100)] * 2 + [(300, 400)] * 7)
+
+    def test_rotate(self):
+        out = self.tmp('rotated.pdf')
+        pdf_utils.concat(out, [OUTLINE_PDF], rotate=180)
+        reader = PdfReader(out)
+        self.assertEqual([page.get('Rotate') for ref, page in reader.pages()], [180] * 7)
+        self.assertEqual(reader.outline(), OUTLINE)
+
+        #turning it again puts it back
+        again = self.tmp('again.pdf')
+        pdf_utils.concat(again, [out], rotate=180)
+        self.assertEqual([page.get('Rotate') for ref, page in PdfReader(again).pages()],
+                         [None] * 7)
+
+    def test_reshape(self):
+        out = self.tmp('reshaped.pdf')
+        pdf_utils.reshape(OUTLINE_PDF, out, offset=10, width=320, height=420,
+                          centre_start=True, even_pages=True)
+        reader = PdfReader(out)
+        self.assertEqual(reader.page_count, 6)
+        boxes = [[float(x) for x in reader.resolve(page['MediaBox'])]
+                 for ref, page in reader.pages()]
+        self.assertEqual(boxes[0], [-10, -10, 310, 410])
+        self.assertEqual(boxes[1], [0, -10, 320, 410])
+        self.assertEqual(boxes[2], [-20, -10, 300, 410])
+        #the outline item on the dropped page points nowhere
+        self.assertEqual(reader.outline()[-1], (u'deep', 2, None))
+
+    def test_reshape_in_place(self):
+        out = self.tmp('in-place.pdf')
+        shutil.copy(XREF_STREAM_PDF, out)
+        pdf_utils.reshape(out, out, width=200)
+        self.assertEqual(page_sizes(out), [(200, 100)] * 2)
+
+    def test_nup(self):
+        out = self.tmp('nup.pdf')
+        pdf_utils.nup(OUTLINE_PDF, out, 2, 700, 400)
+        reader = PdfReader(out)
+        #seven pages make four, and a blank one to make it even
+        self.assertEqual(reader.page_count, 4)
+        self.assertEqual(page_sizes(out), [(700, 400)] * 4)
+        self.assertEqual([p for t, d, p in reader.outline()], [1, 1, 2, 3, 4])
+        xobjects = reader.resolve(reader.resolve(reader.pages()[0][1]['Resources'])['XObject'])
+        self.assertEqual(len(xobjects), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# Part of Objavi2, which turns html manuals into books.
+# These are tests for the render cache in objavi.render_cache.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Tests for objavi.render_cache.  The cache and the booki-zip index
+are put in a temporary directory."""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from objavi import config
+from objavi import render_cache
+from objavi.render_cache import make_key, fetch, store, evict
+from objavi.zipstore import ZipStore
+
+SAVED_CONFIG = ('RENDER_CACHE_DIR', 'RENDER_CACHE_MAX_AGE', 'RENDER_CACHE_MAX_SIZE',
+                'RENDER_ENGINE_VERSION', 'BOOKI_ZIP_INDEX')
+
+
+class RenderCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = dict((k, getattr(config, k)) for k in SAVED_CONFIG)
+        self.tmpdir = tempfile.mkdtemp(prefix='objavi-test-')
+        config.RENDER_CACHE_DIR = self.tmp('cache')
+        os.mkdir(self.tmp('zips'))
+        config.BOOKI_ZIP_INDEX = self.tmp('zips/index.sqlite')
+        self.zip = self.write('book.zip', 'a booki-zip')
+
+    def tearDown(self):
+        for k, v in self.saved.items():
+            setattr(config, k, v)
+        shutil.rmtree(self.tmpdir)
+
+    def tmp(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def write(self, name, data):
+        path = self.tmp(name)
+        d = os.path.dirname(path)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def read(self, path):
+        f = open(path, 'rb')
+        data = f.read()
+        f.close()
+        return data
+
+    def test_key(self):
+        args = {'book': 'x', 'mode': 'book', 'max-age': None, 'title': ''}
+        key = make_key(self.zip, 'book', args)
+        self.assertEqual(len(key), 40)
+        #empty and ignored arguments make no difference
+        self.assertEqual(make_key(self.zip, 'book', {'book': 'x', 'mode': 'book',
+                                                     'destination': 'download'}), key)
+        #the same contents under another name is the same book
+        copy = self.write('copy.zip', 'a booki-zip')
+        self.assertEqual(make_key(copy, 'book', args), key)
+
+        self.assertNotEqual(make_key(self.zip, 'web', args), key)
+        self.assertNotEqual(make_key(self.zip, 'book', dict(args, title=u'\xe9')), key)
+        other = self.write('other.zip', 'another booki-zip')
+        self.assertNotEqual(make_key(other, 'book', args), key)
+        config.RENDER_ENGINE_VERSION = 'new'
+        self.assertNotEqual(make_key(self.zip, 'book', args), key)
+
+    def test_key_uses_index_digest(self):
+        key = make_key(self.zip, 'book', {})
+        ZipStore().add('example.com', 'book', self.zip, 11, sha1='0' * 40)
+        self.assertNotEqual(make_key(self.zip, 'book', {}), key)
+
+    def test_store_and_fetch(self):
+        key = make_key(self.zip, 'book', {})
+        self.assertEqual(fetch(key, self.tmp('out/again.pdf')), None)
+        published = self.write('out/book.pdf', 'a pdf')
+        store(key, published, published)
+        again = fetch(key, self.tmp('out/again.pdf'))
+        self.assertEqual(again, self.tmp('out/again.pdf'))
+        self.assertEqual(self.read(again), 'a pdf')
+
+    def test_changed_name(self):
+        #the publishing process may add to the name it was given
+        key = make_key(self.zip, 'templated_html', {})
+        published = self.write('out/book.tar.gz', 'a tarball')
+        store(key, self.tmp('out/book'), published)
+        again = fetch(key, self.tmp('out/again'))
+        self.assertEqual(again, self.tmp('out/again.tar.gz'))
+        self.assertEqual(self.read(again), 'a tarball')
+
+    def test_too_old(self):
+        key = make_key(self.zip, 'book', {})
+        published = self.write('out/book.pdf', 'a pdf')
+        store(key, published, published)
+        config.RENDER_CACHE_MAX_AGE = -1
+        self.assertEqual(fetch(key, self.tmp('out/again.pdf')), None)
+        config.RENDER_CACHE_MAX_AGE = 3600
+        self.assertEqual(fetch(key, self.tmp('out/again.pdf')), None)
+
+    def test_evict(self):
+        keys = []
+        for i, mode in enumerate(('book', 'web', 'epub')):
+            key = make_key(self.zip, mode, {})
+            published = self.write('out/%s' % mode, 'x' * 100)
+            store(key, published, published)
+            #make the entries' last use times distinct
+            meta_file = render_cache._entry_paths(key)[2]
+            os.utime(meta_file, (time.time() - 100 + i, time.time() - 100 + i))
+            keys.append(key)
+        fetch(keys[0], self.tmp('out/used'))
+        evict(max_size=250, max_age=3600)
+        self.assertEqual([fetch(k, self.tmp('out/check-' + k)) is not None for k in keys],
+                         [True, False, True])
+        evict(max_size=0, max_age=-1)
+        self.assertEqual(os.listdir(os.path.dirname(render_cache._entry_paths(keys[0])[1])), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# Part of Objavi2, which turns html manuals into books.
+# These are tests for the render queue routing in objavi.classic.routing.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Tests for objavi.classic.routing.  Books are looked up in a
+booki-zip index in a temporary directory."""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from objavi import config
+from objavi.classic import routing
+from objavi.classic.routing import estimate_cost, queue_options, TaskRouter
+from objavi.zipstore import ZipStore
+
+SAVED_CONFIG = ('BOOKI_ZIP_INDEX', 'USE_RENDER_QUEUES', 'RENDER_QUEUE_PRIORITY',
+                'RENDER_MODE_COST', 'RENDER_COST_IMAGE_BYTES', 'RENDER_COST_DEFAULT_SIZE',
+                'LIGHT_JOB_MAX_COST', 'DEFAULT_SERVER')
+
+
+class RoutingTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = dict((k, getattr(config, k)) for k in SAVED_CONFIG)
+        self.tmpdir = tempfile.mkdtemp(prefix='objavi-test-')
+        os.mkdir(os.path.join(self.tmpdir, 'index'))
+        config.BOOKI_ZIP_INDEX = os.path.join(self.tmpdir, 'index', 'index.sqlite')
+        config.RENDER_MODE_COST = {'bookizip': 0, 'epub': 0.5, 'book': 2}
+        config.RENDER_COST_IMAGE_BYTES = 1000
+        config.RENDER_COST_DEFAULT_SIZE = 20
+        config.LIGHT_JOB_MAX_COST = 10
+        config.DEFAULT_SERVER = 'example.com'
+        config.USE_RENDER_QUEUES = True
+        config.RENDER_QUEUE_PRIORITY = {}
+
+    def tearDown(self):
+        for k, v in self.saved.items():
+            setattr(config, k, v)
+        shutil.rmtree(self.tmpdir)
+
+    def add_book(self, book, chapters, image_bytes):
+        """Put a booki-zip with <chapters> chapters and <image_bytes>
+        of images in the index."""
+        path = os.path.join(self.tmpdir, '%s.zip' % book)
+        z = zipfile.ZipFile(path, 'w')
+        z.writestr('info.json', json.dumps({'spine': ['ch%d' % i for i in range(chapters)]}))
+        z.writestr('static/picture.png', 'p' * image_bytes)
+        z.writestr('static/style.css', 'c' * 100000)
+        z.close()
+        ZipStore().add('example.com', book, path, os.path.getsize(path))
+
+    def test_book_size(self):
+        self.assertEqual(routing.book_size('example.com', 'unknown'), None)
+        self.add_book('small', 3, 2500)
+        self.assertEqual(routing.book_size('example.com', 'small'), 5.5)
+
+    def test_estimate_cost(self):
+        self.add_book('small', 3, 2000)
+        self.assertEqual(estimate_cost('book', {'book': 'small'}), 10)
+        self.assertEqual(estimate_cost('book', {'book': 'small', 'server': 'example.org'}), 40)
+        self.assertEqual(estimate_cost('epub', {'book': 'unknown'}), 10)
+        self.assertEqual(estimate_cost('bookizip', {'book': 'small'}), 0)
+        #unknown modes count as 1
+        self.assertEqual(estimate_cost('newmode', {}), 20)
+
+    def test_queue_options(self):
+        self.add_book('small', 3, 2000)
+        self.assertEqual(queue_options('book', {'book': 'small'}), {'queue': config.LIGHT_QUEUE})
+        self.assertEqual(queue_options('book', {'book': 'big'}), {'queue': config.HEAVY_QUEUE})
+        config.RENDER_QUEUE_PRIORITY = {config.HEAVY_QUEUE: 3}
+        self.assertEqual(queue_options('book', {'book': 'big'}),
+                         {'queue': config.HEAVY_QUEUE, 'priority': 3})
+        config.USE_RENDER_QUEUES = False
+        self.assertEqual(queue_options('book', {'book': 'big'}), {})
+
+    def test_router(self):
+        router = TaskRouter()
+        self.assertEqual(router.route_for_task('render_epub'), {'queue': config.LIGHT_QUEUE})
+        self.assertEqual(router.route_for_task('render_book'), {'queue': config.HEAVY_QUEUE})
+        self.assertEqual(router.route_for_task('something_else'), None)
+        config.USE_RENDER_QUEUES = False
+        self.assertEqual(router.route_for_task('render_book'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
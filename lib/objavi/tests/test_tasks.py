@@ -0,0 +1,81 @@
+# Part of Objavi2, which turns html manuals into books.
+# These are tests for the task helpers in objavi.classic.tasks.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Tests for objavi.classic.tasks.  The tasks are run eagerly, with
+results kept in memory, so no broker is needed."""
+
+import threading
+import unittest
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure(CACHES = {'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+
+import celery
+celery.current_app.conf.update(CELERY_ALWAYS_EAGER = True,
+                               CELERY_RESULT_BACKEND = 'cache',
+                               CELERY_CACHE_BACKEND = 'memory')
+from celery.result import AsyncResult
+
+from objavi.classic import tasks
+
+
+def notifier():
+    """An ObjaviRequest with just the parts progress_notifier uses."""
+    context = tasks.ObjaviRequest.__new__(tasks.ObjaviRequest)
+    context.task, context.task_id, context.job_key = tasks.current_task_info()
+    return context
+
+
+@celery.task(name = 'objavi.tests.notify_from_thread')
+def notify_from_thread(stage):
+    """Send a progress notification from another thread, as a book's
+    stages do, and return what the result store then says."""
+    context = notifier()
+    errors = []
+    def work():
+        try:
+            context.progress_notifier(stage)
+        except Exception, e:
+            errors.append(e)
+    t = threading.Thread(target = work)
+    t.start()
+    t.join()
+    if errors:
+        raise errors[0]
+    result = AsyncResult(context.task_id)
+    return context.task_id, result.state, result.info
+
+
+class ProgressNotifierTest(unittest.TestCase):
+    def test_notify_from_stage_thread(self):
+        task_id, state, info = notify_from_thread.apply_async(args = ['body']).get()
+        self.assertTrue(task_id)
+        self.assertEqual(state, 'PROGRESS')
+        self.assertEqual(info, {'stage': 'body'})
+
+    def test_no_task(self):
+        context = notifier()
+        self.assertEqual((context.task, context.task_id, context.job_key),
+                         (None, None, None))
+        #outside a task, notifications are ignored
+        context.progress_notifier('body')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# Part of Objavi2, which turns html manuals into books.
+# These are tests for the link rewriting in objavi.xhtml_utils.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Tests for objavi.xhtml_utils.LinkLocaliser."""
+
+import unittest
+
+import lxml.html
+
+from objavi.xhtml_utils import LinkLocaliser
+
+CHAPTERS = {
+    'intro': ('<div><h1 id="top">Intro</h1>'
+              '<p>See <a href="intro#note">the note</a>, '
+              '<a href="more.html#detail">a detail</a>, '
+              '<a href="more">the next chapter</a>, '
+              '<a href="#top">the top</a> and '
+              '<a href="more#missing">nowhere</a>.</p>'
+              '<p id="note">A note.</p><p id="style">Unlinked.</p></div>'),
+    'more': ('<div><h1 id="start">More</h1>'
+             '<p><a name="detail">A detail</a>, '
+             '<a href="./intro.html#note">back</a>, '
+             '<a href="http://example.com/#x">elsewhere</a>.</p>'
+             '<p id="top">Same id as in intro.</p></div>'),
+}
+
+
+class LinkLocaliserTest(unittest.TestCase):
+    def setUp(self):
+        self.localiser = LinkLocaliser([('intro', 'intro.html'), ('more', 'more.html')])
+        self.docs = {}
+        for name in ('intro', 'more'):
+            doc = lxml.html.fragment_fromstring(CHAPTERS[name])
+            self.docs[name] = doc
+            self.localiser.add_chapter(doc, name)
+        self.localiser.set_anchor('more', 'start')
+        self.unresolved = self.localiser.resolve()
+
+    def hrefs(self, name):
+        return [a.get('href') for a in self.docs[name].iter('a') if a.get('href')]
+
+    def ids(self, name):
+        return [e.get('id') for e in self.docs[name].iter() if e.get('id')]
+
+    def test_links(self):
+        #a link to a whole chapter goes to its anchor
+        self.assertEqual(self.hrefs('intro'),
+                         ['#intro_note', '#more_detail', '#start', '#top', '#more_missing'])
+        self.assertEqual(self.hrefs('more'), ['#intro_note', 'http://example.com/#x'])
+
+    def test_targets(self):
+        #only the linked-to elements are renamed
+        self.assertEqual(self.ids('intro'), ['top', 'intro_note', 'style'])
+        self.assertEqual(self.ids('more'), ['start', 'more_detail', 'top'])
+        detail = self.docs['more'].find('.//a[@name]')
+        self.assertEqual(detail.get('name'), 'more_detail')
+        self.assertEqual(self.localiser.renamed_id('intro', 'note'), 'intro_note')
+        self.assertEqual(self.localiser.renamed_id('intro', 'style'), 'style')
+
+    def test_unresolved(self):
+        self.assertEqual(self.unresolved, [{'chapter': u'intro',
+                                            'href': 'more#missing',
+                                            'target': u'more',
+                                            'id': 'missing'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+# Part of Objavi2, which turns html manuals into books.
+# These are tests for the booki-zip index in objavi.zipstore.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Tests for objavi.zipstore.ZipStore, using an index in a temporary
+directory."""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from objavi.zipstore import ZipStore
+
+
+class ZipStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='objavi-test-')
+        self.store = ZipStore(os.path.join(self.tmpdir, 'index.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def add(self, server, book, name, size=100, **kwargs):
+        """Save a fake zip and index it.  The sleep keeps the fetch
+        times in order."""
+        time.sleep(0.01)
+        path = os.path.join(self.tmpdir, name)
+        f = open(path, 'wb')
+        f.write('z' * size)
+        f.close()
+        self.store.add(server, book, path, size, **kwargs)
+        return path
+
+    def test_latest(self):
+        self.assertEqual(self.store.latest('example.com', 'book'), None)
+        self.add('example.com', 'book', 'old.zip')
+        new = self.add('example.com', 'book', 'new.zip', sha1='abc', url='http://x/',
+                       validators={'etag': '"1"', 'last_modified': 'yesterday'})
+        self.add('example.com', 'other', 'other.zip')
+        self.add('example.org', 'book', 'elsewhere.zip')
+        latest = self.store.latest('example.com', 'book')
+        self.assertEqual(latest['path'], new)
+        self.assertEqual(latest['sha1'], 'abc')
+        self.assertEqual(latest['etag'], '"1"')
+        self.assertEqual(latest['last_modified'], 'yesterday')
+        self.assertEqual(latest['size'], 100)
+
+    def test_vanished(self):
+        old = self.add('example.com', 'book', 'old.zip')
+        new = self.add('example.com', 'book', 'new.zip')
+        os.remove(new)
+        self.assertEqual(self.store.latest('example.com', 'book')['path'], old)
+        os.remove(old)
+        self.assertEqual(self.store.latest('example.com', 'book'), None)
+
+    def test_digest(self):
+        path = self.add('example.com', 'book', 'book.zip', sha1='abc')
+        self.assertEqual(self.store.digest(path), 'abc')
+        self.assertEqual(self.store.digest(os.path.join(self.tmpdir, 'unknown.zip')), None)
+
+    def test_refresh(self):
+        old = self.add('example.com', 'book', 'old.zip')
+        self.add('example.com', 'book', 'new.zip')
+        time.sleep(0.01)
+        self.store.refresh(old)
+        self.assertEqual(self.store.latest('example.com', 'book')['path'], old)
+
+    def test_evict_superseded(self):
+        old = self.add('example.com', 'book', 'old.zip')
+        new = self.add('example.com', 'book', 'new.zip')
+        other = self.add('example.com', 'other', 'other.zip')
+        #recently used zips are kept
+        self.store.evict(max_size=None, min_age=3600)
+        self.assertTrue(os.path.exists(old))
+        time.sleep(0.01)
+        self.store.evict(max_size=None, min_age=0)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+        self.assertTrue(os.path.exists(other))
+        self.assertEqual(self.store.latest('example.com', 'book')['path'], new)
+
+    def test_evict_lru(self):
+        a = self.add('example.com', 'a', 'a.zip', size=100)
+        b = self.add('example.com', 'b', 'b.zip', size=100)
+        c = self.add('example.com', 'c', 'c.zip', size=100)
+        time.sleep(0.01)
+        self.store.touch(a)
+        time.sleep(0.01)
+        self.store.evict(max_size=150, min_age=0)
+        self.assertEqual([os.path.exists(x) for x in (a, b, c)], [True, False, False])
+        self.assertEqual(self.store.latest('example.com', 'b'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
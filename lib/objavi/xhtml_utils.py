@@ -370,55 +370,123 @@ def split_tree(tree):
     return chapters
 
 
-def localise_local_links(doc, old_filename=''):
+def _unicode(s):
+    if isinstance(s, str):
+        return s.decode('utf-8')
+    return s
+
+
+class LinkLocaliser(object):
     """Xinha produces document local links (e.g., for footnotes) in
     the form 'filename#local_anchor', which are broken if the filename
     changes.  In practice the filename changes at least twice during
     processing -- once from 'filename' to 'filename.html', when Booki
     makes the bookizip, and again to 'body.html' when all the chapters
-    get concatenated.
+    get concatenated.  Links between chapters ('other.html#id') break
+    in the same way.
 
     Additionally, Xinha will reuse the same IDs in each chapter, so
     when the chapters are all concatenated the IDs are no longer
     unique and the links won't work properly.
 
-    This function will replace links in the form 'filename#id' with
-    '#filename_id', and change the target IDs according.  It avoids
-    altering the ID of elements that aren't locally linked, as these
-    might be used for CSS or external links.
+    This replaces links in the form 'filename#id' with
+    '#filename_id', and changes the target IDs accordingly, for all
+    the chapters of a book at once.  It avoids altering the ID of
+    elements that aren't linked to in that way, as these might be used
+    for CSS or external links.
+
+    Each chapter is looked at once, by add_chapter(), which rewrites
+    the links and notes the elements with IDs.  Then resolve() renames
+    the linked-to elements and reports the links that went nowhere.
     """
-    old_prefix = (old_filename + '#').encode('utf-8')
-    targets = []
-    transformed_ids = {}
-
-    #loop 1: find links and shortlist elements with ID
-    for e in doc.iter():
-        if e.tag == 'a':
-            href = e.get('href')
-            if href and href.startswith(old_prefix):
-                old_id = href[len(old_prefix):]
-                new_id = '%s_%s' % (old_filename, old_id)
-                e.set('href', '#' + new_id)
-                transformed_ids[old_id] = new_id
-            name = e.get('name')
-            if name:
-                targets.append(e)
-                continue
-        ID = e.get('id')
-        if ID is not None:
-            targets.append(e)
-
-    log("transforming these IDs in chapter %s: %s" % (old_filename, transformed_ids))
-
-    for e in targets:
-        old_id = e.get('id')
-        if old_id is None and e.tag == 'a':
-            old_id = e.get('name')
-        if old_id is None:
-            continue
-        if old_id in transformed_ids:
-            new_id = transformed_ids[old_id]
-            e.set('id', new_id)
+    def __init__(self, chapters):
+        """<chapters> is a sequence of (name, url) pairs, where name is
+        what Xinha called the chapter, and url is its name in the
+        bookizip.  New IDs are prefixed with the name."""
+        self.prefixes = {}
+        for name, url in chapters:
+            name = _unicode(name)
+            for k in (name, _unicode(url)):
+                if k:
+                    self.prefixes.setdefault(k, name)
+            if url and url.endswith('.html'):
+                self.prefixes.setdefault(_unicode(url[:-5]), name)
+        self.targets = {}     # {name: {id: [elements]}}
+        self.wanted = {}      # {(name, id): new_id}
+        self.links = []       # [(name, element, href, (target name, id))]
+        self.anchors = {}     # {name: id of the chapter start}
+        self.renamed = {}     # {(name, old id): new id}
+
+    def add_chapter(self, doc, name):
+        """Rewrite the links in <doc>, which is the chapter called
+        <name>, and remember its IDs."""
+        name = _unicode(name)
+        prefixes = self.prefixes
+        targets = self.targets.setdefault(name, {})
+        for e in doc.iter():
             if e.tag == 'a':
-                e.set('name', new_id)
-
+                href = e.get('href')
+                if href:
+                    self._add_link(name, e, href, prefixes)
+                ID = e.get('id') or e.get('name')
+            else:
+                ID = e.get('id')
+            if ID is not None:
+                targets.setdefault(ID, []).append(e)
+
+    def _add_link(self, name, e, href, prefixes):
+        if href.startswith('./'):
+            href = href[2:]
+        if href.startswith('#'):
+            #may need fixing if the target is renamed
+            self.links.append((name, e, href, (name, href[1:])))
+            return
+        filename, hash, fragment = href.partition('#')
+        target = prefixes.get(_unicode(filename))
+        if target is None:
+            return
+        if not fragment:
+            #a link to the start of a chapter
+            self.links.append((name, e, href, (target, None)))
+            return
+        new_id = '%s_%s' % (target, fragment)
+        e.set('href', '#' + new_id)
+        self.wanted[(target, fragment)] = new_id
+        self.links.append((name, e, href, (target, fragment)))
+
+    def set_anchor(self, name, ID):
+        """Links to chapter <name> without a fragment will go to <ID>."""
+        self.anchors.setdefault(_unicode(name), ID)
+
+    def resolve(self):
+        """Rename the elements that are linked to, and point bare
+        '#id' links at the new names.  Return a list of the links that
+        have no target, as dictionaries with 'chapter', 'href',
+        'target', and 'id' keys."""
+        for (target, old_id), new_id in self.wanted.iteritems():
+            for e in self.targets.get(target, {}).get(old_id, ()):
+                e.set('id', new_id)
+                if e.tag == 'a' and e.get('name'):
+                    e.set('name', new_id)
+                self.renamed[(target, old_id)] = new_id
+
+        unresolved = []
+        for name, e, href, (target, ID) in self.links:
+            if ID is None:
+                ID = self.anchors.get(target)
+                if ID is not None:
+                    e.set('href', '#' + self.renamed_id(target, ID))
+                    continue
+            elif ID in self.targets.get(target, ()):
+                if href.startswith('#'):
+                    e.set('href', '#' + self.renamed_id(target, ID))
+                continue
+            unresolved.append({'chapter': name,
+                               'href': href,
+                               'target': target,
+                               'id': ID})
+        return unresolved
+
+    def renamed_id(self, name, ID):
+        """The ID that element <ID> in chapter <name> ended up with."""
+        return self.renamed.get((_unicode(name), ID), ID)
@@ -0,0 +1,308 @@
+# Part of Objavi2, which turns html manuals into books.
+# This keeps a few Xvfb servers running for wkhtmltopdf and soffice.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""A pool of long-lived Xvfb displays.
+
+Starting an X server for every book costs a couple of seconds, and
+killing it reliably is harder than it should be.  Instead each worker
+process keeps a few displays running, and books lease one for the
+duration of their rendering.  Displays are checked before they are
+handed out, and are replaced after config.XVFB_MAX_USES leases in
+case they have grown or gone wrong.
+
+The pool is stopped when the process exits normally, or when a
+celery pool process is shut down (which skips atexit handlers).  Each
+display also has a pidfile in config.XVFB_PID_DIR naming it and the
+process that started it, so that if a worker is killed its displays
+can be found and stopped by reap_orphans(), which runs when a pool is
+made and now and then from Book.cleanup_x.  Processes that the pools
+didn't start are never touched.
+
+Note that Xvfb doesn't interact well with dbus which is present on
+modern desktops.
+"""
+
+import os
+import time
+import random
+import socket
+import shutil
+import atexit
+import tempfile
+import threading
+from hashlib import md5
+from subprocess import Popen, check_call
+
+from objavi import config
+from objavi.book_utils import log, ObjaviError
+from objavi.cgi_utils import try_to_kill
+
+
+def _start_time(pid):
+    """The start time of process <pid> (in clock ticks since boot), or
+    None if there is no such process.  With the pid, this identifies a
+    process even if the pid is later reused."""
+    try:
+        f = open('/proc/%d/stat' % pid)
+        try:
+            stat = f.read()
+        finally:
+            f.close()
+        #the command name, in brackets, can contain spaces
+        return stat[stat.rindex(')') + 2:].split()[19]
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class Display(object):
+    """A running Xvfb server."""
+    def __init__(self):
+        self.authdir = tempfile.mkdtemp(prefix='objavi-xvfb-')
+        self.authfile = os.path.join(self.authdir, 'Xauthority')
+        self.uses = 0
+        for i in range(10):
+            #Find an unused server number (other workers are doing this too)
+            number = random.randrange(50, 500)
+            if os.path.exists('/tmp/.X%s-lock' % number):
+                continue
+            self.number = number
+            self.name = ':%s' % number
+            self._start()
+            if self.wait_until_ready():
+                return
+            self.stop(remove_auth=False)
+        shutil.rmtree(self.authdir, ignore_errors=True)
+        raise ObjaviError("could not start Xvfb")
+
+    def _start(self):
+        #mcookie(1) eats into /dev/random, so avoid that
+        m = md5("%r %r %r %r" % (self.name, os.getpid(), time.time(), os.urandom(32)))
+        env = dict(os.environ, XAUTHORITY=self.authfile)
+        check_call(['xauth', 'add', self.name, '.', m.hexdigest()], env=env)
+        self.process = Popen(['Xvfb', self.name,
+                              '-screen', '0', '1024x768x24',
+                              '-pixdepths', '32',
+                              '-dpi', '96',
+                              '-nolisten', 'tcp',
+                              ])
+        log("started Xvfb %s, pid %s" % (self.name, self.process.pid))
+        self._write_pidfile()
+
+    def _write_pidfile(self):
+        """Record the server and its owner, for reap_orphans()."""
+        self.pidfile = None
+        try:
+            if not os.path.isdir(config.XVFB_PID_DIR):
+                os.makedirs(config.XVFB_PID_DIR)
+            pid, owner = self.process.pid, os.getpid()
+            path = os.path.join(config.XVFB_PID_DIR, '%s.pid' % self.number)
+            f = open(path, 'w')
+            f.write('%s %s %s %s %s\n' % (pid, _start_time(pid), owner,
+                                           _start_time(owner), self.authdir))
+            f.close()
+            self.pidfile = path
+        except (IOError, OSError), e:
+            log("can't record Xvfb %s: %s" % (self.name, e))
+
+    def _socket_path(self):
+        return '/tmp/.X11-unix/X%s' % self.number
+
+    def responds(self):
+        """Is the server accepting connections on its socket?"""
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(self._socket_path())
+            return True
+        except socket.error:
+            return False
+        finally:
+            s.close()
+
+    def alive(self):
+        return self.process.poll() is None and self.responds()
+
+    def wait_until_ready(self, timeout=None):
+        """Wait until the server accepts connections, rather than for
+        a fixed time.  Returns False if it dies or times out."""
+        if timeout is None:
+            timeout = config.XVFB_START_TIMEOUT
+        end = time.time() + timeout
+        while time.time() < end:
+            if self.process.poll() is not None:
+                log("Xvfb %s died with %s" % (self.name, self.process.poll()))
+                return False
+            if self.responds():
+                return True
+            time.sleep(0.05)
+        log("Xvfb %s did not start in %s seconds" % (self.name, timeout))
+        return False
+
+    def stop(self, remove_auth=True):
+        p = self.process
+        log("stopping Xvfb %s (pid %s)" % (self.name, p.pid))
+        try_to_kill(p.pid, 15)
+        for i in range(10):
+            if p.poll() is not None:
+                break
+            time.sleep(0.2)
+        else:
+            log("Xvfb %s would not die! kill -9!" % self.name)
+            try_to_kill(p.pid, 9)
+            p.wait()
+        if getattr(self, 'pidfile', None) is not None:
+            _remove(self.pidfile)
+            self.pidfile = None
+        if remove_auth:
+            shutil.rmtree(self.authdir, ignore_errors=True)
+
+
+class DisplayPool(object):
+    """Keeps up to <size> idle displays.  If all of them are leased,
+    lease() starts another, which is stopped when it is returned."""
+    def __init__(self, size=None, max_uses=None):
+        if size is None:
+            size = config.XVFB_POOL_SIZE
+        if max_uses is None:
+            max_uses = config.XVFB_MAX_USES
+        self.size = size
+        self.max_uses = max_uses
+        self.idle = []
+        self.leased = set()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def lease(self):
+        """Get a working display, starting one if necessary."""
+        display = None
+        while display is None:
+            with self.lock:
+                if not self.idle:
+                    break
+                display = self.idle.pop()
+            if not display.alive():
+                log("Xvfb %s is unhealthy; replacing it" % display.name)
+                display.stop()
+                display = None
+        if display is None:
+            display = Display()
+        display.uses += 1
+        with self.lock:
+            self.leased.add(display)
+        return display
+
+    def release(self, display):
+        """Return a display to the pool, or stop it if it is worn out,
+        broken, or not needed."""
+        with self.lock:
+            self.leased.discard(display)
+            keep = (display.uses < self.max_uses and
+                    len(self.idle) < self.size)
+            if keep:
+                self.idle.append(display)
+        if keep and not display.alive():
+            with self.lock:
+                self.idle.remove(display)
+            keep = False
+        if not keep:
+            display.stop()
+
+    def shutdown(self):
+        with self.lock:
+            displays = self.idle + list(self.leased)
+            self.idle = []
+            self.leased = set()
+        for display in displays:
+            display.stop()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """The pool for this process.  A forked child gets a pool of its
+    own rather than sharing its parent's displays."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            reap_orphans()
+            _pool = DisplayPool()
+            atexit.register(_shutdown, _pool)
+        return _pool
+
+def _shutdown(pool):
+    if pool.pid == os.getpid():
+        pool.shutdown()
+
+def shutdown_pool(**kwargs):
+    """Stop this process's displays, if it has any."""
+    with _pool_lock:
+        pool = _pool
+    if pool is not None:
+        _shutdown(pool)
+
+try:
+    #celery's pool processes leave with os._exit(), so atexit
+    #handlers don't run.
+    from celery.signals import worker_process_shutdown
+    worker_process_shutdown.connect(shutdown_pool, weak=False)
+except ImportError:
+    pass
+
+
+
+def reap_orphans():
+    """Stop the displays recorded in config.XVFB_PID_DIR whose owner
+    has died.  The start times in the pidfile make sure that neither
+    pid has since been reused by some other process."""
+    try:
+        names = os.listdir(config.XVFB_PID_DIR)
+    except OSError:
+        return
+    for name in names:
+        if not name.endswith('.pid'):
+            continue
+        path = os.path.join(config.XVFB_PID_DIR, name)
+        try:
+            f = open(path)
+            try:
+                pid, started, owner, owner_started, authdir = f.read().split()
+            finally:
+                f.close()
+            pid, owner = int(pid), int(owner)
+        except (IOError, ValueError):
+            continue
+        if _start_time(owner) == owner_started:
+            #still in use
+            continue
+        if _start_time(pid) == started:
+            log("stopping Xvfb %s (pid %s), left by dead process %s" % (name[:-4], pid, owner))
+            try_to_kill(pid, 15)
+            for i in range(10):
+                time.sleep(0.2)
+                if _start_time(pid) != started:
+                    break
+            else:
+                try_to_kill(pid, 9)
+        shutil.rmtree(authdir, ignore_errors=True)
+        _remove(path)
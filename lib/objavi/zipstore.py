@@ -0,0 +1,247 @@
+# Part of Objavi2, which turns html manuals into books.
+# This keeps track of the booki-zips saved in BOOKI_BOOK_DIR.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""An sqlite index of locally saved booki-zips.
+
+Each saved zip has a row recording the server and book it came from,
+when it was fetched and last used, its size and SHA1, and the HTTP
+validators (ETag, Last-Modified) that came with it.  Finding the
+latest zip for a book is an indexed lookup rather than a directory
+scan, and old zips can be evicted without guessing at dates from
+file names.
+
+Zips that were saved before there was an index are added to it the
+first time it is opened, using the server and book recorded in their
+metadata, so they can be found and evicted like the others.
+"""
+
+import os
+import time
+import json
+import zipfile
+import sqlite3
+
+from objavi import config
+from objavi.book_utils import log
+
+from booki.bookizip import get_metadata
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS zips (
+    path TEXT PRIMARY KEY,
+    server TEXT NOT NULL,
+    book TEXT NOT NULL,
+    url TEXT,
+    fetched REAL NOT NULL,
+    last_used REAL NOT NULL,
+    size INTEGER NOT NULL,
+    sha1 TEXT,
+    etag TEXT,
+    last_modified TEXT
+);
+CREATE INDEX IF NOT EXISTS zips_by_book ON zips (server, book, fetched);
+CREATE INDEX IF NOT EXISTS zips_by_use ON zips (last_used);
+"""
+
+COLUMNS = ('path', 'server', 'book', 'url', 'fetched', 'last_used',
+           'size', 'sha1', 'etag', 'last_modified')
+
+
+def _decode(s):
+    if isinstance(s, str):
+        return s.decode('utf-8')
+    return s
+
+
+def _zip_origin(path):
+    """The server and book recorded in a booki-zip's metadata."""
+    z = zipfile.ZipFile(path)
+    try:
+        metadata = json.loads(z.read('info.json'))['metadata']
+    finally:
+        z.close()
+    server = get_metadata(metadata, 'server', ns=config.FM, default=[None])[0]
+    book = get_metadata(metadata, 'book', ns=config.FM, default=[None])[0]
+    return server, book
+
+
+class ZipStore(object):
+    def __init__(self, index=None, directory=None):
+        if index is None:
+            index = config.BOOKI_ZIP_INDEX
+        if directory is None:
+            directory = os.path.dirname(index)
+        self.index = index
+        self.directory = directory
+
+    def _connect(self):
+        #A connection per operation.  Celery workers fork, and sqlite
+        #connections must not be shared across processes.
+        db = sqlite3.connect(self.index, timeout=30)
+        db.executescript(SCHEMA)
+        if db.execute('PRAGMA user_version').fetchone()[0] == 0:
+            self._import_existing(db)
+        return db
+
+    def _import_existing(self, db):
+        """Index the zips that were in the directory before the index
+        was.  This happens once, when the index is new (its
+        user_version is still 0)."""
+        with db:
+            #take the write lock first, so only one process does this
+            db.execute('BEGIN IMMEDIATE')
+            if db.execute('PRAGMA user_version').fetchone()[0] != 0:
+                return
+            try:
+                names = os.listdir(self.directory)
+            except OSError, e:
+                log("can't look for unindexed booki-zips: %s" % e)
+                names = []
+            for name in sorted(names):
+                if not name.endswith('.zip'):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    server, book = _zip_origin(path)
+                    st = os.stat(path)
+                except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile), e:
+                    log("can't index old booki-zip %s: %s" % (path, e))
+                    continue
+                #Zips with unknown origins are still indexed, so that
+                #they get evicted.
+                log("indexing old booki-zip %s (%s/%s)" % (path, server, book))
+                db.execute('INSERT OR IGNORE INTO zips (path, server, book, fetched, '
+                           'last_used, size) VALUES (?, ?, ?, ?, ?, ?)',
+                           (_decode(path), _decode(server or ''), _decode(book or ''),
+                            st.st_mtime, st.st_mtime, st.st_size))
+            db.execute('PRAGMA user_version = 1')
+
+    def _row(self, row):
+        if row is None:
+            return None
+        d = dict(zip(COLUMNS, row))
+        d['path'] = d['path'].encode('utf-8')
+        return d
+
+    def latest(self, server, book):
+        """Return a dictionary describing the most recently fetched zip
+        of the book, or None if there is none (or it has gone
+        missing)."""
+        db = self._connect()
+        try:
+            while True:
+                row = self._row(db.execute(
+                    'SELECT %s FROM zips WHERE server = ? AND book = ? '
+                    'ORDER BY fetched DESC LIMIT 1' % ', '.join(COLUMNS),
+                    (_decode(server), _decode(book))).fetchone())
+                if row is None or os.path.exists(row['path']):
+                    return row
+                log("indexed booki-zip %s has vanished" % row['path'])
+                with db:
+                    db.execute('DELETE FROM zips WHERE path = ?', (_decode(row['path']),))
+        finally:
+            db.close()
+
+    def digest(self, path):
+        """The SHA1 hex digest of the zip at <path>, if it is known."""
+        db = self._connect()
+        try:
+            row = db.execute('SELECT sha1 FROM zips WHERE path = ?', (_decode(path),)).fetchone()
+        finally:
+            db.close()
+        if row is not None:
+            return row[0]
+
+    def add(self, server, book, path, size, sha1=None, url=None, validators=None):
+        """Record a newly saved zip as the latest version of the book."""
+        if validators is None:
+            validators = {}
+        now = time.time()
+        db = self._connect()
+        try:
+            with db:
+                db.execute('INSERT OR REPLACE INTO zips (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+                           % ', '.join(COLUMNS),
+                           (_decode(path), _decode(server), _decode(book), _decode(url),
+                            now, now, size, sha1,
+                            validators.get('etag'), validators.get('last_modified')))
+        finally:
+            db.close()
+
+    def refresh(self, path):
+        """The zip at <path> has been found to be current (e.g., the
+        server said 304 Not Modified), so count it as freshly
+        fetched."""
+        now = time.time()
+        db = self._connect()
+        try:
+            with db:
+                db.execute('UPDATE zips SET fetched = ?, last_used = ? WHERE path = ?',
+                           (now, now, _decode(path)))
+        finally:
+            db.close()
+
+    def touch(self, path):
+        """Note that the zip has been used, for LRU eviction."""
+        db = self._connect()
+        try:
+            with db:
+                db.execute('UPDATE zips SET last_used = ? WHERE path = ?',
+                           (time.time(), _decode(path)))
+        finally:
+            db.close()
+
+    def evict(self, max_size=None, min_age=None):
+        """Delete superseded zips, and then the least recently used
+        ones until the total size is under <max_size> bytes.  Zips used
+        in the last <min_age> seconds are left alone, as they might be
+        in use."""
+        if max_size is None:
+            max_size = config.BOOKI_ZIP_STORE_MAX_SIZE
+        if min_age is None:
+            min_age = config.BOOKI_ZIP_STORE_MIN_AGE
+        cutoff = time.time() - min_age
+        db = self._connect()
+        try:
+            total = db.execute('SELECT SUM(size) FROM zips').fetchone()[0] or 0
+            doomed = set()
+            for path, size in db.execute(
+                'SELECT path, size FROM zips AS z WHERE last_used < ? AND fetched < '
+                '(SELECT MAX(fetched) FROM zips WHERE server = z.server AND book = z.book)',
+                (cutoff,)):
+                doomed.add(path)
+                total -= size
+
+            if max_size and total > max_size:
+                for path, size in db.execute('SELECT path, size FROM zips WHERE last_used < ? '
+                                             'ORDER BY last_used', (cutoff,)):
+                    if total <= max_size:
+                        break
+                    if path not in doomed:
+                        doomed.add(path)
+                        total -= size
+
+            for path in sorted(doomed):
+                log("evicting booki-zip %s" % path)
+                try:
+                    os.remove(path.encode('utf-8'))
+                except OSError, e:
+                    log(e)
+                with db:
+                    db.execute('DELETE FROM zips WHERE path = ?', (path,))
+        finally:
+            db.close()